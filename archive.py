@@ -0,0 +1,239 @@
+'''Monthly columnar archive of the diagnostics on the file server.
+
+The camera appends its diagnostics to diagnostics.jsonl (or diagnostics.yaml of older versions), which grows forever.
+Compaction moves all records older than a number of days into one Parquet (or Feather) file per month with typed columns
+and rewrites the append log with the recent records only. The archive is read by month, so the dashboard only downloads
+the months it shows. pyarrow is only needed on the computer running the compaction or the dashboard.
+
+The recent records are uploaded to a temporary file, which replaces the log after its size was checked again. Records
+the camera appends between this check and the rename (a single request) are lost, so compaction should run while the
+camera is not uploading (e.g. with cron between two wake cycles):
+GLACIERCAM_PASSWORD=... python archive.py HOST USERNAME FOLDER [--protocol ftp] [--keep-days 31] [--format parquet]
+'''
+from io import BytesIO
+from datetime import datetime, timedelta, timezone
+from os import environ
+import argparse
+import json
+import logging
+import re
+from data import Data, DiagnosticsRecord
+from fileserver import FileServer
+
+class Archive:
+    '''A class to compact the diagnostics log of a camera into monthly columnar files and to read them.'''
+
+    DIRECTORY = "archive"
+    LOG_FILENAMES = ["diagnostics.yaml", "diagnostics.jsonl"] # Appended plain or compressed with the suffix .gz
+    TAIL_FILENAME = "diagnostics.jsonl" # Receives the recent records after the compaction
+    TEMPORARY_FILENAME = "diagnostics.jsonl.tmp"
+    TIMESTAMP_FORMAT = "%Y-%m-%d %H:%MZ"
+    FORMATS = {'parquet': ".parquet", 'feather': ".feather"}
+
+    def __init__(self, fileserver: FileServer, directory: str = DIRECTORY, file_format: str = "parquet") -> None:
+        if file_format not in self.FORMATS:
+            raise ValueError(f"Unknown archive format {file_format}")
+
+        self.fileserver = fileserver
+        self.directory = directory
+        self.file_format = file_format
+        self.extension = self.FORMATS[file_format]
+
+    def __filename(self, month: str) -> str:
+        return f"{self.directory}/diagnostics-{month}{self.extension}"
+
+    @classmethod
+    def month_of(cls, record: dict) -> str:
+        '''Return the month (YYYY-MM) of a record or None if it has no valid timestamp.'''
+        try:
+            timestamp = record.get('timestamp')
+            if not isinstance(timestamp, datetime):
+                timestamp = datetime.strptime(timestamp, cls.TIMESTAMP_FORMAT)
+            return timestamp.strftime("%Y-%m")
+        except Exception:
+            return None
+
+    @staticmethod
+    def months_between(start: datetime, end: datetime) -> list:
+        '''Return the months (YYYY-MM) from start to end.'''
+        months = []
+        year, month = start.year, start.month
+        while (year, month) <= (end.year, end.month):
+            months.append(f"{year:04d}-{month:02d}")
+            year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+
+        return months
+
+    def months(self) -> dict:
+        '''Return the archived months with the facts of their files (e.g. modify and size), oldest first.'''
+        if self.directory not in self.fileserver.list_files():
+            return {}
+
+        pattern = re.compile(rf"diagnostics-(\d{{4}}-\d{{2}}){re.escape(self.extension)}$")
+        months = {}
+        for filename, facts in self.fileserver.list_directory(self.directory).items():
+            match = pattern.match(filename)
+            if match:
+                months[match.group(1)] = facts
+
+        return dict(sorted(months.items()))
+
+    def read_month(self, month: str):
+        '''Download a month of the archive as a pyarrow table.'''
+        import pyarrow.feather
+        import pyarrow.parquet
+
+        file_data = self.fileserver.get_file_as_bytes(self.__filename(month))
+        file_data.seek(0)
+        if self.file_format == "feather":
+            return pyarrow.feather.read_table(file_data)
+
+        return pyarrow.parquet.read_table(file_data)
+
+    def __records(self, table) -> list:
+        '''Return the records of a table without the columns missing in a record.'''
+        return [{key: value for key, value in record.items() if value is not None} for record in table.to_pylist()]
+
+    def __to_table(self, records: list):
+        '''Create a table with typed columns from records. Columns with values of different types are stored as text.'''
+        import pyarrow
+
+        columns = {}
+        for record in records:
+            for key in record:
+                columns.setdefault(key, [])
+
+        arrays = {}
+        for key in columns:
+            values = [record.get(key) for record in records]
+            if key == "timestamp":
+                values = [value if isinstance(value, datetime) else datetime.strptime(value, self.TIMESTAMP_FORMAT) for value in values]
+                arrays[key] = pyarrow.array(values, pyarrow.timestamp('s'))
+                continue
+
+            try:
+                arrays[key] = pyarrow.array(values)
+            except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError):
+                arrays[key] = pyarrow.array([None if value is None else json.dumps(value, default=str) if isinstance(value, (dict, list)) else str(value) for value in values])
+
+        return pyarrow.table(arrays)
+
+    def __write_month(self, month: str, records: list) -> bool:
+        '''Merge records into the file of a month and upload it.'''
+        import pyarrow.feather
+        import pyarrow.parquet
+
+        if month in self.months():
+            records = self.__records(self.read_month(month)) + records
+
+        # Records are only archived once, even if a compaction is repeated after an error
+        unique_records = {}
+        for record in records:
+            record = {**record, 'timestamp': datetime.strptime(self.__timestamp(record), self.TIMESTAMP_FORMAT)}
+            unique_records.setdefault(json.dumps(record, sort_keys=True, default=str), record)
+        records = sorted(unique_records.values(), key=lambda record: record['timestamp'])
+
+        file_data = BytesIO()
+        if self.file_format == "feather":
+            pyarrow.feather.write_feather(self.__to_table(records), file_data, compression="zstd")
+        else:
+            pyarrow.parquet.write_table(self.__to_table(records), file_data, compression="zstd")
+        file_data.seek(0)
+
+        return self.fileserver.upload_file_from_bytes(self.__filename(month), file_data)
+
+    def __timestamp(self, record: dict) -> str:
+        timestamp = record['timestamp']
+        return timestamp.strftime(self.TIMESTAMP_FORMAT) if isinstance(timestamp, datetime) else timestamp
+
+    def __read_log(self, filename: str, size: str = None) -> str:
+        '''Download a file of the diagnostics log completely, as the records which are not archived are deleted with it.'''
+        file_data = self.fileserver.get_file_as_bytes(filename).getvalue()
+        if size is not None and len(file_data) != int(size):
+            raise Exception(f"Could not download {filename} completely")
+
+        if filename.endswith(self.fileserver.COMPRESSED_SUFFIX):
+            file_data = self.fileserver.decompress(file_data)
+        return file_data.decode('utf-8')
+
+    def compact(self, keep_days: int = 31, now: datetime = None) -> dict:
+        '''Move the records older than keep_days from the diagnostics log into the monthly files and keep the recent records in the log.
+        Returns the number of archived and kept records and the months written.'''
+        now = now or datetime.now(timezone.utc).replace(tzinfo=None)
+        cutoff = (now - timedelta(days=keep_days)).strftime(self.TIMESTAMP_FORMAT)
+        result = {'archived': 0, 'kept': 0, 'months': []}
+
+        # Read the whole log and remember the size of its files
+        listing = self.fileserver.list_directory()
+        log_filenames = [filename for log_filename in self.LOG_FILENAMES
+                         for filename in (log_filename, f"{log_filename}{self.fileserver.COMPRESSED_SUFFIX}")]
+        log_files = {filename: listing[filename].get('size') for filename in log_filenames if filename in listing}
+        records = []
+        for filename, size in log_files.items():
+            records += Data.parse_diagnostics(self.__read_log(filename, size))
+
+        old_records = {}
+        recent_records = []
+        for record in records:
+            month = self.month_of(record) if isinstance(record, dict) else None
+            if month is not None and self.__timestamp(record) < cutoff: # The timestamps sort like the dates
+                old_records.setdefault(month, []).append(record)
+            else:
+                recent_records.append(record)
+
+        if not old_records:
+            result['kept'] = len(recent_records)
+            return result
+
+        if self.directory not in self.fileserver.list_files():
+            self.fileserver.create_directory(self.directory)
+
+        for month, month_records in sorted(old_records.items()):
+            if not self.__write_month(month, month_records):
+                raise Exception(f"Could not upload archive of {month}")
+            result['archived'] += len(month_records)
+            result['months'].append(month)
+
+        # The recent records are uploaded to a temporary file, which only replaces the log if the camera did not append to it
+        # in the meantime (the archive is updated again next time)
+        tail_data = BytesIO("".join(json.dumps(DiagnosticsRecord.from_dict(record).to_row(), separators=(',', ':'), default=str) + "\n"
+                                    for record in recent_records).encode('utf-8'))
+        if not self.fileserver.upload_file_from_bytes(self.TEMPORARY_FILENAME, tail_data):
+            raise Exception("Could not upload the recent records of the diagnostics log")
+
+        self.fileserver.invalidate_listing()
+        listing = self.fileserver.list_directory()
+        if any(listing.get(filename, {}).get('size') != log_files.get(filename) for filename in log_filenames):
+            logging.warning("The diagnostics log changed during the compaction, it is compacted again next time.")
+            self.fileserver.delete_file(self.TEMPORARY_FILENAME)
+            result['archived'] = 0
+            result['kept'] = len(records)
+            return result
+
+        if not self.fileserver.rename_file(self.TEMPORARY_FILENAME, self.TAIL_FILENAME):
+            raise Exception("Could not rewrite the diagnostics log")
+
+        for filename in log_files:
+            if filename != self.TAIL_FILENAME:
+                self.fileserver.delete_file(filename)
+
+        result['kept'] = len(recent_records)
+        return result
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
+    parser = argparse.ArgumentParser(description="Compact the diagnostics of a camera into a monthly archive.")
+    parser.add_argument("host")
+    parser.add_argument("username")
+    parser.add_argument("folder", help="Directory of the camera on the file server")
+    parser.add_argument("--protocol", default="ftp")
+    parser.add_argument("--keep-days", type=int, default=31, help="Number of days kept in the diagnostics log")
+    parser.add_argument("--format", default="parquet", choices=list(Archive.FORMATS))
+    args = parser.parse_args()
+
+    fileserver = FileServer(args.host, args.username, environ.get("GLACIERCAM_PASSWORD", ""), protocol=args.protocol)
+    fileserver.change_directory(args.folder)
+    print(Archive(fileserver, file_format=args.format).compact(args.keep_days))
+    fileserver.quit()
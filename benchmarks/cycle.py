@@ -0,0 +1,339 @@
+'''Benchmark a full wake cycle of main.py without hardware.
+
+The camera, the SIM7600X 4G module and the Witty Pi 4 are replaced by fakes and the files are uploaded to a local
+FTP server (pyftpdlib), which can add latency, throttle the data connections and drop connections. The local_transport
+scenario uploads to a local directory instead, which shows the time spent outside of the network transfers.
+Every scenario runs main.py in a separate process and reports the wall time and the duration of each stage.
+The warnings and errors logged by main.py are printed after the report. A scenario fails if main.py logs an error which
+is not expected in the scenario (e.g. a stage which crashes only shows up as a short stage in the timings otherwise).
+
+Usage: python benchmarks/cycle.py [scenario ...]
+'''
+from os import path, makedirs, environ, pathsep, chmod, listdir
+from shutil import copyfile
+from time import sleep, monotonic
+import json
+import logging
+import random
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import types
+from yaml import safe_load, safe_dump
+
+REPOSITORY_DIRECTORY = path.dirname(path.dirname(path.abspath(__file__)))
+USERNAME = "glaciercam"
+PASSWORD = "benchmark"
+
+# latency: Delay of each FTP command in seconds
+# bandwidth: Maximum transfer rate of the data connection in bytes/s (0 = unlimited)
+# loss: Probability that the server drops the connection on a command
+# backlog: Number of images on the SD card from previous wake cycles
+# cameras: Number of attached cameras
+# settings: Settings which differ from settings.yaml (optional)
+# expected_errors: Regular expressions of the errors expected in the scenario (optional)
+SCENARIOS = {
+    'good_link': {'online': True, 'latency': 0.02, 'bandwidth': 0, 'loss': 0.0, 'backlog': 0, 'cameras': 1},
+    'slow_link': {'online': True, 'latency': 0.5, 'bandwidth': 64 * 1024, 'loss': 0.02, 'backlog': 0, 'cameras': 1,
+                  'expected_errors': ["Failed to upload file", "Failed to append data"]}, # Transfers time out or the connection drops
+    'no_link': {'online': False, 'latency': 0.0, 'bandwidth': 0, 'loss': 0.0, 'backlog': 0, 'cameras': 1,
+                'expected_errors': ["Failed to connect to the file server"]},
+    'backlog': {'online': True, 'latency': 0.02, 'bandwidth': 0, 'loss': 0.0, 'backlog': 500, 'cameras': 1},
+    'multi_camera': {'online': True, 'latency': 0.02, 'bandwidth': 0, 'loss': 0.0, 'backlog': 0, 'cameras': 4},
+    'stream_upload': {'online': True, 'latency': 0.02, 'bandwidth': 0, 'loss': 0.0, 'backlog': 0, 'cameras': 1, 'settings': {'streamUpload': True}},
+    'local_transport': {'online': True, 'latency': 0.0, 'bandwidth': 0, 'loss': 0.0, 'backlog': 500, 'cameras': 1, 'protocol': 'local'},
+    'sensor_sampling': {'online': True, 'latency': 0.02, 'bandwidth': 0, 'loss': 0.0, 'backlog': 0, 'cameras': 1, 'settings': {'sensorSampling': True}},
+}
+
+IMAGE_SIZE = (1920, 1080)
+
+# Log lines of main.py (asctime levelname message)
+LOG_LINE = re.compile(r"^\d{4}-\d{2}-\d{2} [\d:,]+ (WARNING|ERROR|CRITICAL) (.*)$")
+
+# Witty Pi 4 utilities with fixed readings
+UTILITIES_SH = '''
+get_temperature() { echo "21.5°C / 70.7°F"; }
+get_input_voltage() { echo "12.1"; }
+get_output_voltage() { echo "5.1"; }
+get_output_current() { echo "0.4"; }
+get_low_voltage_threshold() { echo "7.5V"; }
+get_recovery_voltage_threshold() { echo "7.7V"; }
+set_low_voltage_threshold() { echo "$1"; }
+set_recovery_voltage_threshold() { echo "$1"; }
+net_to_system() { :; }
+system_to_rtc() { :; }
+'''
+
+RUN_SCRIPT_SH = '''#!/bin/bash
+echo "---------------------------------------"
+echo "Schedule next shutdown at: 2024-01-01 08:04:00"
+echo "Schedule next startup at: 2024-01-01 08:30:00"
+'''
+
+SUDO = '''#!/bin/bash
+exec "$@"
+'''
+
+# Responses of the SIM7600X to the AT commands used by main.py
+AT_RESPONSES = {
+    'AT+CSQ': '\r\n+CSQ: 20,99\r\n\r\nOK\r\n',
+    'AT+CNMP?': '\r\n+CNMP: 38\r\n\r\nOK\r\n',
+    'AT+CGPSINFO': '\r\n+CGPSINFO: 4627.1234,N,00931.5678,E,010124,120000.0,1500.0,0.0,0.0\r\n\r\nOK\r\n',
+}
+
+def create_image(filename, size: tuple = IMAGE_SIZE) -> None:
+    '''Write a synthetic JPEG image to a file or file-like object.'''
+    from PIL import Image
+    Image.effect_noise(size, 32).convert('RGB').save(filename, 'JPEG', quality=90)
+
+###########################
+# Fakes (used in the wake cycle process)
+###########################
+class FakePicamera2:
+    '''Fake of picamera2.Picamera2 which writes a synthetic JPEG image.'''
+
+    CAMERAS = 1 # Number of attached cameras
+
+    def __init__(self, camera_num: int = 0):
+        self.camera_num = camera_num
+        self.config = None
+
+    @classmethod
+    def global_camera_info(cls) -> list:
+        '''Return the list of attached cameras.'''
+        return [{'Num': i, 'Model': 'fake'} for i in range(cls.CAMERAS)]
+
+    def create_still_configuration(self, main: dict = None) -> dict:
+        '''Return a still configuration.'''
+        return {'main': main or {'size': IMAGE_SIZE}}
+
+    def start_and_capture_file(self, name, delay: float = 1, capture_mode: dict = None, show_preview: bool = False) -> None:
+        '''Wait for the exposure and write the image.'''
+        sleep(delay)
+        create_image(name, capture_mode['main']['size'] if capture_mode else IMAGE_SIZE)
+
+    def start(self, config: dict = None, show_preview: bool = False) -> None:
+        '''Start the camera.'''
+        self.config = config
+
+    def capture_file(self, file_output, format: str = None) -> None:
+        '''Write the image to a file or file-like object.'''
+        create_image(file_output, self.config['main']['size'] if self.config else IMAGE_SIZE)
+
+    def stop(self) -> None:
+        '''Stop the camera.'''
+
+class LoopbackSerial:
+    '''Fake of serial.Serial which answers the AT commands of the SIM7600X.'''
+
+    def __init__(self, port: str = None, baudrate: int = 9600, timeout: float = None):
+        self.buffer = b''
+        self.is_open = True
+
+    def write(self, data: bytes) -> int:
+        '''Queue the response to an AT command.'''
+        command = data.decode().strip().upper()
+        self.buffer += AT_RESPONSES.get(command, '\r\nOK\r\n').encode()
+        return len(data)
+
+    def inWaiting(self) -> int:
+        '''Return the number of bytes in the receive buffer.'''
+        return len(self.buffer)
+
+    def read(self, size: int = 1) -> bytes:
+        '''Read from the receive buffer.'''
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def flushInput(self) -> None:
+        '''Clear the receive buffer.'''
+        self.buffer = b''
+
+    def close(self) -> None:
+        '''Close the connection.'''
+        self.is_open = False
+
+def run_cycle(work_directory: str, port: int, cameras: int) -> None:
+    '''Run main.py against the fakes and print the timings as JSON.'''
+    sys.path.insert(0, REPOSITORY_DIRECTORY)
+    FakePicamera2.CAMERAS = cameras
+
+    picamera2 = types.ModuleType('picamera2')
+    picamera2.Picamera2 = FakePicamera2
+    sys.modules['picamera2'] = picamera2
+
+    import serial
+    serial.Serial = LoopbackSerial
+
+    import ftplib
+    ftplib.FTP.port = port
+
+    from witty_pi_4 import WittyPi4
+    WittyPi4.WITTYPI_DIRECTORY = path.join(work_directory, "wittypi")
+    WittyPi4.SCHEDULE_FILE_PATH = path.join(work_directory, "wittypi", "schedule.wpi")
+    WittyPi4.get_remaining_on_time = lambda self: self.MAX_DURATION_MINUTES * 60 # Freshly booted
+
+    environ["GLACIERCAM_FILE_PATH"] = work_directory + "/"
+
+    import runpy
+    start = monotonic()
+    main = runpy.run_path(path.join(REPOSITORY_DIRECTORY, "main.py"), run_name="__main__")
+    wall_time = monotonic() - start
+
+    print(json.dumps({'wall_time': wall_time, 'timings': main['runner'].timings, 'skipped': main['runner'].skipped}))
+
+###########################
+# File server
+###########################
+def start_server(root: str, latency: float, bandwidth: int, loss: float, seed: int = 0):
+    '''Start a local FTP server in a background thread and return it.'''
+    from pyftpdlib.authorizers import DummyAuthorizer
+    from pyftpdlib.handlers import FTPHandler, ThrottledDTPHandler
+    from pyftpdlib.servers import ThreadedFTPServer
+
+    rng = random.Random(seed)
+
+    authorizer = DummyAuthorizer()
+    authorizer.add_user(USERNAME, PASSWORD, root, perm="elradfmwMT")
+
+    class DTPHandler(ThrottledDTPHandler):
+        '''Data connection with limited bandwidth.'''
+        read_limit = bandwidth
+        write_limit = bandwidth
+
+    class Handler(FTPHandler):
+        '''Control connection with latency and dropped connections.'''
+
+        def pre_process_command(self, line, cmd, arg):
+            sleep(latency)
+
+            if rng.random() < loss:
+                self.close()
+                return
+
+            super().pre_process_command(line, cmd, arg)
+
+    Handler.authorizer = authorizer
+    Handler.dtp_handler = DTPHandler
+
+    server = ThreadedFTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, kwargs={'timeout': 0.1, 'handle_exit': False}, daemon=True).start()
+    return server
+
+def get_free_port() -> int:
+    '''Return a port on which no server is listening.'''
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+###########################
+# Scenarios
+###########################
+def run_scenario(name: str, scenario: dict) -> dict:
+    '''Prepare the SD card and the file server and run one wake cycle.'''
+    with tempfile.TemporaryDirectory() as directory:
+        work_directory = path.join(directory, "pi")
+        server_directory = path.join(directory, "server")
+        bin_directory = path.join(directory, "bin")
+        for d in (work_directory, server_directory, bin_directory, path.join(work_directory, "wittypi")):
+            makedirs(d)
+
+        # Witty Pi 4 and sudo
+        with open(path.join(work_directory, "wittypi", "utilities.sh"), 'w', encoding='utf-8') as f:
+            f.write(UTILITIES_SH)
+
+        for filename, content in ((path.join(work_directory, "wittypi", "runScript.sh"), RUN_SCRIPT_SH), (path.join(bin_directory, "sudo"), SUDO)):
+            with open(filename, 'w', encoding='utf-8') as f:
+                f.write(content)
+            chmod(filename, 0o755)
+
+        for log in ("wittyPi.log", "schedule.log"):
+            with open(path.join(work_directory, "wittypi", log), 'w', encoding='utf-8') as f:
+                f.write("Witty Pi 4 log\n" * 100)
+
+        # Configuration and settings
+        with open(path.join(work_directory, "config.yaml"), 'w', encoding='utf-8') as f:
+            protocol = scenario.get('protocol', "ftp")
+            safe_dump({'protocol': protocol, 'ftpServerAddress': server_directory if protocol == "local" else "127.0.0.1", 'username': USERNAME,
+                       'password': PASSWORD, 'ftpDirectory': "", 'multipleCamerasOnServer': False, 'localOnly': False}, f)
+
+        with open(path.join(REPOSITORY_DIRECTORY, "settings.yaml"), 'r', encoding='utf-8') as f:
+            settings = safe_load(f)
+
+        settings.update({'enableGPS': True, 'uploadExtendedDiagnostics': True, 'shutdown': False})
+        settings.update(scenario.get('settings', {}))
+
+        for settings_path in (work_directory, server_directory):
+            with open(path.join(settings_path, "settings.yaml"), 'w', encoding='utf-8') as f:
+                safe_dump(settings, f)
+
+        # Images from previous wake cycles
+        if scenario['backlog'] > 0:
+            backlog_image = path.join(directory, "backlog.jpg")
+            create_image(backlog_image, (640, 480))
+            for i in range(scenario['backlog']):
+                copyfile(backlog_image, path.join(work_directory, f"20240101_{i:04d}Z_backlog.jpg"))
+
+        server = None
+        if scenario['online'] and scenario.get('protocol', "ftp") == "ftp":
+            server = start_server(server_directory, scenario['latency'], scenario['bandwidth'], scenario['loss'])
+            port = server.address[1]
+        else:
+            port = get_free_port()
+
+        try:
+            env = dict(environ, PATH=bin_directory + pathsep + environ.get("PATH", ""))
+            process = subprocess.run([sys.executable, path.abspath(__file__), "--run-cycle", work_directory, str(port), str(scenario['cameras'])],
+                                     env=env, capture_output=True, text=True, timeout=600, check=False)
+        finally:
+            if server:
+                server.close_all()
+
+        if process.returncode != 0:
+            raise RuntimeError(f"Scenario {name} failed:\n{process.stderr}")
+
+        result = json.loads(process.stdout.strip().splitlines()[-1])
+        result['uploaded_images'] = len([f for f in listdir(server_directory) if f.endswith(".jpg")])
+
+        # Stages catch their exceptions and log them, so a failed stage is only visible in the log
+        result['log'] = [f"{match.group(1)} {match.group(2)}" for match in map(LOG_LINE.match, process.stderr.splitlines()) if match]
+        result['errors'] = [line for line in result['log'] if not line.startswith("WARNING")
+                            and not any(re.search(pattern, line) for pattern in scenario.get('expected_errors', []))]
+        return result
+
+def print_report(results: dict) -> None:
+    '''Print the wall time and the duration of each stage.'''
+    stages = []
+    for result in results.values():
+        stages += [stage for stage in result['timings'] if stage not in stages]
+
+    print(f"{'':20}" + "".join(f"{name:>16}" for name in results))
+    print(f"{'wall time':20}" + "".join(f"{result['wall_time']:>16.2f}" for result in results.values()))
+    print(f"{'uploaded images':20}" + "".join(f"{result['uploaded_images']:>16}" for result in results.values()))
+    for stage in stages:
+        print(f"{stage:20}" + "".join(f"{result['timings'].get(stage, float('nan')):>16.2f}" for result in results.values()))
+    print(f"{'skipped stages':20}" + "".join(f"{len(result['skipped']):>16}" for result in results.values()))
+    print(f"{'warnings':20}" + "".join(f"{len([line for line in result['log'] if line.startswith('WARNING')]):>16}" for result in results.values()))
+    print(f"{'errors':20}" + "".join(f"{len(result['errors']):>16}" for result in results.values()))
+
+    for name, result in results.items():
+        if result['log']:
+            print(f"\n{name}:")
+            for line in result['log']:
+                print(f"  {'(unexpected) ' if line in result['errors'] else ''}{line}")
+
+if __name__ == "__main__":
+    if len(sys.argv) == 5 and sys.argv[1] == "--run-cycle":
+        run_cycle(sys.argv[2], int(sys.argv[3]), int(sys.argv[4]))
+    else:
+        logging.basicConfig(level=logging.WARNING) # Also keeps the FTP server quiet
+        selected_scenarios = sys.argv[1:] or list(SCENARIOS)
+        results = {name: run_scenario(name, SCENARIOS[name]) for name in selected_scenarios}
+        print_report(results)
+
+        failed = [name for name, result in results.items() if result['errors']]
+        if failed:
+            sys.exit(f"Unexpected errors in {', '.join(failed)}")
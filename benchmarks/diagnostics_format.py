@@ -0,0 +1,62 @@
+'''Benchmark the local diagnostics of a camera which was offline for a long time, as main.py handles them in a wake cycle.
+
+For every size a diagnostics file with the given number of records (one every 30 minutes) is created, either as JSON Lines
+or as the YAML file of an older version. Then the steps of main.py are measured: appending the record of the wake cycle,
+downsampling the local records (which also converts the YAML file) and reading and removing the newest chunk for the upload.
+
+Usage: python benchmarks/diagnostics_format.py [records ...]
+'''
+from os import path
+from datetime import datetime, timedelta
+from time import perf_counter
+import sys
+import tempfile
+
+sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+from data import Data # pylint: disable=wrong-import-position
+
+DEFAULT_SIZES = [1000, 10000, 100000]
+CHUNK_BYTES = 256 * 1024 # DIAGNOSTICS_CHUNK_BYTES of main.py
+NOW = datetime(2024, 6, 1, 12, 0)
+
+def record(index: int, size: int) -> dict:
+    '''Return a typical diagnostics record of a wake cycle.'''
+    return {
+        'version': '1.0.0', 'timestamp': (NOW - timedelta(minutes=30 * (size - index))).strftime(Data.TIMESTAMP_FORMAT),
+        'temperature': 21.5 + index % 10, 'battery_voltage': 12.4, 'signal_quality': 18.0, 'next_startup_time': "2024-01-01 08:30:00Z",
+        'latitude': 46.5, 'longitude': 7.9, 'height': 3100.0, 'uploaded_bytes': 350000 + index,
+        'timings': {'capture': 3.1, 'upload': 8.4, 'diagnostics': 0.6},
+    }
+
+def benchmark(extension: str, size: int) -> tuple:
+    '''Return the seconds to append one record, to downsample the local records and to read and remove the chunk for the upload.'''
+    with tempfile.TemporaryDirectory() as directory:
+        existing = Data(path.join(directory, f"diagnostics.{extension}"))
+        existing.diagnostics = [record(index, size) for index in range(size)]
+        existing.append_diagnostics_to_file()
+
+        data = Data(path.join(directory, "diagnostics.jsonl"))
+        data.diagnostics = [record(size, size)]
+        start = perf_counter()
+        data.append_diagnostics_to_file()
+        append_seconds = perf_counter() - start
+
+        start = perf_counter()
+        data.downsample_local_diagnostics(NOW)
+        downsample_seconds = perf_counter() - start
+
+        start = perf_counter()
+        chunk = data.get_local_chunk(CHUNK_BYTES)
+        data.remove_local_chunk(chunk)
+        chunk_seconds = perf_counter() - start
+        assert chunk.getvalue()
+
+    return append_seconds, downsample_seconds, chunk_seconds
+
+if __name__ == "__main__":
+    sizes = [int(size) for size in sys.argv[1:]] or DEFAULT_SIZES
+    print(f"{'format':<8}{'records':>10}{'append (ms)':>16}{'downsample (ms)':>18}{'chunk (ms)':>16}")
+    for size in sizes:
+        for extension in ("yaml", "jsonl"):
+            append_seconds, downsample_seconds, chunk_seconds = benchmark(extension, size)
+            print(f"{extension:<8}{size:>10}{append_seconds * 1000:>16.2f}{downsample_seconds * 1000:>18.1f}{chunk_seconds * 1000:>16.2f}")
@@ -0,0 +1,78 @@
+'''Benchmark the backends of the Witty Pi 4 module.
+
+The readings of a wake cycle (temperature, voltages, current and the voltage thresholds) are read a number of times
+with every backend and the mean time per reading is reported. Without a directory, the Witty Pi 4 utilities are replaced
+by a fake utilities.sh with fixed readings (as in the cycle benchmark), which only shows the cost of starting bash.
+On a Raspberry Pi use the installed utilities, where sourcing utilities.sh and its i2cget calls add to every reading.
+The i2c backend is only measured if smbus2 (or smbus) and the I2C bus are available.
+
+Usage: python benchmarks/witty_pi_backends.py [--directory /home/pi/wittypi] [--rounds 10]
+'''
+from os import path
+from time import perf_counter
+import argparse
+import logging
+import sys
+import tempfile
+
+sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+from cycle import UTILITIES_SH # pylint: disable=wrong-import-position
+from witty_pi_4 import WittyPi4 # pylint: disable=wrong-import-position
+
+def read_all(witty_pi: WittyPi4) -> int:
+    '''Read everything which is read in a wake cycle and return the number of readings.'''
+    witty_pi.get_temperature()
+    witty_pi.get_battery_voltage()
+    witty_pi.get_internal_voltage()
+    witty_pi.get_internal_current()
+    witty_pi.get_low_voltage_threshold()
+    witty_pi.get_recovery_voltage_threshold()
+    return 6
+
+def benchmark(backend: str, rounds: int) -> tuple:
+    '''Return the seconds of the first reading (including the start of the backend) and the mean seconds per reading after it
+    or None if the backend is not available.'''
+    witty_pi = WittyPi4(backend)
+    if witty_pi.backend != backend:
+        return None
+
+    try:
+        start = perf_counter()
+        witty_pi.get_temperature()
+        first_seconds = perf_counter() - start
+
+        readings = 0
+        start = perf_counter()
+        for _ in range(rounds):
+            readings += read_all(witty_pi)
+        return first_seconds, (perf_counter() - start) / readings
+    finally:
+        witty_pi.close()
+
+def main() -> None:
+    '''Run the benchmark and print the results.'''
+    parser = argparse.ArgumentParser(description="Benchmark the backends of the Witty Pi 4 module.")
+    parser.add_argument("--directory", help="Directory of the Witty Pi 4 utilities (default: fake utilities)")
+    parser.add_argument("--rounds", type=int, default=10, help="Number of times the readings of a wake cycle are read")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR) # The readings are logged as info
+
+    with tempfile.TemporaryDirectory() as directory:
+        if args.directory:
+            WittyPi4.WITTYPI_DIRECTORY = args.directory
+        else:
+            with open(path.join(directory, "utilities.sh"), 'w', encoding='utf-8') as f:
+                f.write(UTILITIES_SH)
+            WittyPi4.WITTYPI_DIRECTORY = directory
+
+        print(f"{'backend':<12}{'first reading (ms)':>20}{'per reading (ms)':>20}")
+        for backend in WittyPi4.BACKENDS:
+            result = benchmark(backend, args.rounds)
+            if result is None:
+                print(f"{backend:<12}{'not available':>20}")
+            else:
+                print(f"{backend:<12}{result[0] * 1000:>20.2f}{result[1] * 1000:>20.3f}")
+
+if __name__ == "__main__":
+    main()
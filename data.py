@@ -1,11 +1,125 @@
-from os import path, remove
+from os import path, remove, replace, truncate
+from datetime import datetime, timedelta, timezone
 from io import BytesIO
+import json
 import logging
 from yaml import safe_load, safe_dump
 
+# Fields of the diagnostics record of each schema version (in the order of the rows)
+# New fields are only appended in a new version, so older rows can still be read
+SCHEMAS = {
+    1: {
+        'version': str,
+        'timestamp': str,
+        'settings_changed': bool,
+        'battery_voltage': float,
+        'next_startup_time': str,
+        'network_mode': str,
+        'image_quality': int,
+        'image_scale': float,
+        'temperature': float,
+        'signal_quality': float,
+        'latitude': float,
+        'longitude': float,
+        'height': float,
+        'connect_outcome': str,
+        'connect_latency': float,
+        'connect_attempts': int,
+        'uploaded_bytes': int,
+        'outbox_files': int,
+        'outbox_bytes': int,
+        'skipped_stages': list,
+        'timings': dict,
+        'transfers': dict,
+        'compression': dict,
+        'backlog_upload': dict,
+        'sensor_samples': dict,
+    },
+}
+SCHEMAS[2] = {**SCHEMAS[1], 'aggregate': dict} # Resolution, number of records, minimum and maximum of downsampled records
+SCHEMAS[3] = {**SCHEMAS[2], 'image_levels': dict} # Quality and scale of the image of each camera
+SCHEMA_VERSION = max(SCHEMAS)
+
+class DiagnosticsRecord:
+    '''The diagnostics of one wake cycle with the fields of the current schema. Values of unknown fields
+    (or values which do not match the type of their field) are kept in extra.
+    A record is serialized as a compact row: schema version, the values in the order of the fields and extra (if not empty).'''
+
+    FIELDS = SCHEMAS[SCHEMA_VERSION]
+    __slots__ = tuple(FIELDS) + ('extra',)
+
+    # Column types of the fields for pandas (nullable, as every field may be missing)
+    DTYPES = {str: 'object', bool: 'boolean', int: 'Int64', float: 'float64', list: 'object', dict: 'object'}
+
+    def __init__(self) -> None:
+        for field in self.FIELDS:
+            setattr(self, field, None)
+        self.extra = {}
+
+    def set(self, key: str, value) -> None:
+        '''Set a field and convert the value to the type of the field (e.g. an int to a float).'''
+        field_type = self.FIELDS.get(key)
+        if field_type is None:
+            self.extra[key] = value
+            return
+
+        try:
+            if value is not None and not isinstance(value, field_type):
+                if field_type in (dict, list, bool):
+                    raise TypeError(f"expected {field_type.__name__}")
+                value = field_type(value)
+            setattr(self, key, value)
+        except Exception as e:
+            logging.warning("Diagnostics field %s has an invalid value (%s): %s", key, str(e), value)
+            setattr(self, key, None)
+            self.extra[key] = value
+
+    @classmethod
+    def from_dict(cls, values: dict):
+        '''Create a record from a dictionary.'''
+        record = cls()
+        for key, value in values.items():
+            record.set(key, value)
+        return record
+
+    @classmethod
+    def from_row(cls, row: list):
+        '''Create a record from a row of any known schema version.'''
+        if row[0] not in SCHEMAS:
+            raise ValueError(f"Unknown diagnostics schema version {row[0]}")
+
+        fields = list(SCHEMAS[row[0]])
+        record = cls()
+        for field, value in zip(fields, row[1:]):
+            if value is not None:
+                record.set(field, value)
+
+        if len(row) > len(fields) + 1:
+            for key, value in row[len(fields) + 1].items():
+                record.set(key, value)
+
+        return record
+
+    def to_dict(self) -> dict:
+        '''Return the fields which are set and the extra values as dictionary.'''
+        values = {field: getattr(self, field) for field in self.FIELDS if getattr(self, field) is not None}
+        return {**values, **self.extra}
+
+    def to_row(self) -> list:
+        '''Return the record as row. Missing values at the end are omitted.'''
+        row = [SCHEMA_VERSION] + [getattr(self, field) for field in self.FIELDS]
+        if self.extra:
+            return row + [self.extra]
+
+        while len(row) > 1 and row[-1] is None:
+            row.pop()
+        return row
+
 class Data:
-    '''Class to handle diagnostics and sensor data storage and retrieval.'''
-    def __init__(self, diagnostics_filepath="diagnostics.yaml"):
+    '''Class to handle diagnostics and sensor data storage and retrieval.
+    Files ending with .jsonl are written as JSON Lines (one record per line, so appending does not need to read the file),
+    other files as a YAML list.'''
+    def __init__(self, diagnostics_filepath="diagnostics.jsonl"):
         self.diagnostics_filepath = diagnostics_filepath
         self.diagnostics = [{}]
 
@@ -13,27 +127,247 @@ class Data:
         '''Add a data point to the current diagnostics dictionary.'''
         self.diagnostics[-1][key] = value
 
+    @staticmethod
+    def parse_diagnostics(text: str) -> list:
+        '''Parse diagnostics in the JSON Lines (rows or dictionaries of older versions) or the YAML format.'''
+        if not text.lstrip().startswith(('[', '{')):
+            return safe_load(text) or []
+
+        diagnostics = []
+        for line in text.splitlines():
+            if line.strip():
+                values = json.loads(line)
+                if not isinstance(values, list):
+                    diagnostics.append(values)
+                elif values and values[0] == SCHEMA_VERSION and len(values) <= len(DiagnosticsRecord.FIELDS) + 1: # No extra values
+                    diagnostics.append({field: value for field, value in zip(DiagnosticsRecord.FIELDS, values[1:]) if value is not None})
+                else:
+                    diagnostics.append(DiagnosticsRecord.from_row(values).to_dict())
+
+        return diagnostics
+
+    @staticmethod
+    def parse_table(text: str) -> tuple:
+        '''Parse diagnostics like parse_diagnostics, but as columns (the fields of the current schema and all extra values)
+        and rows with a value for every column, e.g. for pandas.DataFrame(rows, columns=columns).
+        Rows of the current schema without extra values are not converted to records.'''
+        columns = list(DiagnosticsRecord.FIELDS)
+        width = len(columns) + 1
+        rows = []
+        extras = []
+
+        if text.lstrip().startswith(('[', '{')):
+            lines = [json.loads(line) for line in text.splitlines() if line.strip()]
+        else: # YAML of older versions
+            lines = safe_load(text) or []
+
+        for line in lines:
+            if isinstance(line, list) and line and line[0] == SCHEMA_VERSION and len(line) <= width:
+                rows.append(line[1:] + [None] * (width - len(line)))
+                extras.append(None)
+            else:
+                record = DiagnosticsRecord.from_row(line) if isinstance(line, list) else DiagnosticsRecord.from_dict(line)
+                rows.append([getattr(record, field) for field in columns])
+                extras.append(record.extra)
+
+        # Invalid values of schema fields are kept as <field>_raw, so every column name is unique
+        extras = [{f"{key}_raw" if key in DiagnosticsRecord.FIELDS else key: value for key, value in extra.items()} if extra else None for extra in extras]
+        extra_columns = []
+        for extra in extras:
+            extra_columns += [key for key in (extra or {}) if key not in extra_columns]
+
+        if extra_columns:
+            rows = [row + [(extra or {}).get(key) for key in extra_columns] for row, extra in zip(rows, extras)]
+
+        return columns + extra_columns, rows
+
+    REMOTE_FILENAMES = ("diagnostics.yaml", "diagnostics.yaml.gz", "diagnostics.jsonl", "diagnostics.jsonl.gz")
+
+    @classmethod
+    def read_appended_diagnostics(cls, server, sizes: dict) -> tuple:
+        '''Download only the diagnostics appended to the files on the server since they were read with the given sizes
+        (which are updated). If a file shrank or was deleted (e.g. by the compaction), sizes are reset and everything is read again.
+        Returns if the files were replaced and the tables (columns and rows) of the new diagnostics.'''
+        listing = server.list_directory()
+        remote_sizes = {filename: int(listing[filename].get('size') or server.get_file_size(filename) or 0)
+                        for filename in cls.REMOTE_FILENAMES if filename in listing}
+
+        replaced = any(remote_sizes.get(filename, 0) < size for filename, size in sizes.items())
+        if replaced:
+            sizes.clear()
+
+        tables = []
+        for filename, remote_size in remote_sizes.items():
+            if remote_size > sizes.get(filename, 0):
+                try: # Every append is a complete YAML list or complete JSON lines (and a gzip member), so the new data can be parsed on its own
+                    new_data = server.get_file_as_bytes(filename, sizes.get(filename, 0)).getvalue()
+                    text = server.decompress(new_data) if filename.endswith(".gz") else new_data
+                    tables.append(cls.parse_table(text.decode('utf-8')))
+                    sizes[filename] = sizes.get(filename, 0) + len(new_data)
+                except Exception as e: # E.g. the camera is still appending, try again next time
+                    logging.warning("Could not read new diagnostics: %s", str(e))
+
+        return replaced, tables
+
+    @staticmethod
+    def __is_json_lines(filepath: str) -> bool:
+        return filepath.endswith(".jsonl")
+
+    def __serialize(self, diagnostics: list, json_lines: bool) -> str:
+        '''Serialize diagnostics as JSON Lines or as a YAML list.'''
+        if json_lines: # Compact rows of the diagnostics schema
+            return "".join(json.dumps(DiagnosticsRecord.from_dict(record).to_row(), separators=(',', ':'), default=str) + "\n" for record in diagnostics)
+
+        return safe_dump(diagnostics, default_flow_style=False)
+
+    def __local_filepaths(self) -> list:
+        '''Return the local diagnostics file and the YAML file written by older versions.'''
+        filepaths = [self.diagnostics_filepath]
+        if self.__is_json_lines(self.diagnostics_filepath):
+            filepaths.insert(0, f"{path.splitext(self.diagnostics_filepath)[0]}.yaml")
+
+        return [filepath for filepath in filepaths if path.exists(filepath)]
+
     def load_diagnostics(self):
         '''Load the diagnostics dictionary from a local file.'''
         try:
-            if path.exists(self.diagnostics_filepath):
-                with open(self.diagnostics_filepath, 'r', encoding='utf-8') as yaml_file:
-                    self.diagnostics = safe_load(yaml_file) + self.diagnostics
-                remove(self.diagnostics_filepath) # Delete the file after loading
+            for filepath in self.__local_filepaths():
+                with open(filepath, 'r', encoding='utf-8') as diagnostics_file:
+                    self.diagnostics = self.parse_diagnostics(diagnostics_file.read()) + self.diagnostics
+                remove(filepath) # Delete the file after loading
         except Exception as e:
             logging.warning("Could not open diagnostics file: %s", str(e))
 
     def save_diagnostics(self):
         '''Save the current diagnostics dictionary to a local file.'''
-        with open(self.diagnostics_filepath, 'w', encoding='utf-8') as yaml_file:
-            safe_dump(self.diagnostics, yaml_file)
+        with open(self.diagnostics_filepath, 'w', encoding='utf-8') as diagnostics_file:
+            diagnostics_file.write(self.__serialize(self.diagnostics, self.__is_json_lines(self.diagnostics_filepath)))
 
     def append_diagnostics_to_file(self):
         '''Append the diagnostics to a local file.'''
-        with open(self.diagnostics_filepath, 'a', encoding='utf-8') as yaml_file:
-            safe_dump(self.diagnostics, yaml_file, encoding='utf-8')
+        with open(self.diagnostics_filepath, 'a', encoding='utf-8') as diagnostics_file:
+            diagnostics_file.write(self.__serialize(self.diagnostics, self.__is_json_lines(self.diagnostics_filepath)))
+
+    ###########################
+    # Local backlog
+    ###########################
+    FULL_RESOLUTION_DAYS = 7 # Newer records are kept as they are
+    HOURLY_RESOLUTION_DAYS = 30 # Newer records are kept as hourly, older records as daily aggregates
+    MAX_LOCAL_RECORDS = 5000 # The oldest records are dropped if there are more
+    DOWNSAMPLE_BYTES = 256 * 1024 # The local diagnostics are only downsampled if they are larger
+    TIMESTAMP_FORMAT = "%Y-%m-%d %H:%MZ"
+
+    @staticmethod
+    def __aggregate(records: list, timestamp: str, resolution: str) -> dict:
+        '''Combine records (which may be aggregates themselves) into one record with the mean of the numeric fields,
+        the minimum and maximum of the float fields and the last value of the other fields.'''
+        weights = [record.get('aggregate', {}).get('records', 1) for record in records]
+        aggregate = {'resolution': resolution, 'records': sum(weights), 'min': {}, 'max': {}}
+        aggregated_record = {}
+
+        for field, field_type in DiagnosticsRecord.FIELDS.items():
+            values = [(record[field], weight, record) for record, weight in zip(records, weights) if record.get(field) is not None]
+            if not values or field in ('timestamp', 'aggregate'):
+                continue
+
+            if field_type in (int, float) and all(isinstance(value, (int, float)) for value, _, _ in values):
+                mean = sum(value * weight for value, weight, _ in values) / sum(weight for _, weight, _ in values)
+                aggregated_record[field] = round(mean, 3) if field_type is float else round(mean)
+                if field_type is float:
+                    aggregate['min'][field] = min(record.get('aggregate', {}).get('min', {}).get(field, value) for value, _, record in values)
+                    aggregate['max'][field] = max(record.get('aggregate', {}).get('max', {}).get(field, value) for value, _, record in values)
+            elif field_type is not dict: # Details like the stage timings are not aggregated
+                aggregated_record[field] = values[-1][0]
+
+        return {'timestamp': timestamp, **aggregated_record, 'aggregate': aggregate}
+
+    def downsample_local_diagnostics(self, now: datetime = None, min_bytes: int = DOWNSAMPLE_BYTES) -> int:
+        '''Replace old local records by hourly and daily aggregates and drop the oldest records above MAX_LOCAL_RECORDS, so the backlog of
+        a camera which is offline for a long time stays bounded. Only done if the local file is larger than min_bytes (or an older version
+        left a YAML file). Returns the number of local records or None if nothing was done.'''
+        filepaths = self.__local_filepaths()
+        if not filepaths or (filepaths == [self.diagnostics_filepath] and path.getsize(self.diagnostics_filepath) <= min_bytes):
+            return None
+
+        records = []
+        for filepath in filepaths:
+            with open(filepath, 'r', encoding='utf-8') as diagnostics_file:
+                records += self.parse_diagnostics(diagnostics_file.read())
+
+        now = now or datetime.now(timezone.utc).replace(tzinfo=None)
+        full_resolution_start = (now - timedelta(days=self.FULL_RESOLUTION_DAYS)).strftime(self.TIMESTAMP_FORMAT)
+        hourly_resolution_start = (now - timedelta(days=self.HOURLY_RESOLUTION_DAYS)).strftime(self.TIMESTAMP_FORMAT)
+
+        # Group the old records by hour or day (the timestamps sort like the dates)
+        buckets = {}
+        downsampled_records = []
+        for record in sorted(records, key=lambda record: str(record.get('timestamp', ''))):
+            timestamp = record.get('timestamp')
+            try:
+                datetime.strptime(timestamp, self.TIMESTAMP_FORMAT)
+            except Exception:
+                timestamp = None
+
+            if timestamp is None or timestamp >= full_resolution_start:
+                downsampled_records.append(record)
+            elif timestamp >= hourly_resolution_start:
+                buckets.setdefault((f"{timestamp[:13]}:00Z", "hour"), []).append(record)
+            else:
+                buckets.setdefault((f"{timestamp[:10]} 00:00Z", "day"), []).append(record)
+
+        downsampled_records = [self.__aggregate(bucket_records, timestamp, resolution) if len(bucket_records) > 1 or resolution == "day" else bucket_records[0]
+                               for (timestamp, resolution), bucket_records in buckets.items()] + downsampled_records
+
+        if len(downsampled_records) > self.MAX_LOCAL_RECORDS:
+            logging.warning("Dropping the %s oldest local diagnostics.", len(downsampled_records) - self.MAX_LOCAL_RECORDS)
+            downsampled_records = downsampled_records[-self.MAX_LOCAL_RECORDS:]
+
+        # Replace the file at once, so the records are not lost if the power is cut
+        temporary_filepath = f"{self.diagnostics_filepath}.tmp"
+        with open(temporary_filepath, 'w', encoding='utf-8') as diagnostics_file:
+            diagnostics_file.write(self.__serialize(downsampled_records, self.__is_json_lines(self.diagnostics_filepath)))
+        replace(temporary_filepath, self.diagnostics_filepath)
+
+        for filepath in filepaths:
+            if filepath != self.diagnostics_filepath:
+                remove(filepath)
+
+        logging.info("Downsampled %s local diagnostics to %s records.", len(records), len(downsampled_records))
+        return len(downsampled_records)
+
+    def get_local_chunk(self, max_bytes: int) -> BytesIO:
+        '''Return the newest local JSON lines up to max_bytes (at least one line), e.g. to upload the backlog in chunks across several
+        wake cycles. The chunk is removed with remove_local_chunk after it was uploaded.'''
+        if not path.exists(self.diagnostics_filepath):
+            return BytesIO()
+
+        with open(self.diagnostics_filepath, 'rb') as diagnostics_file:
+            size = diagnostics_file.seek(0, 2)
+            start = max(size - max_bytes, 0)
+            diagnostics_file.seek(start)
+            chunk = diagnostics_file.read()
+
+            if start > 0: # Remove the incomplete first line
+                diagnostics_file.seek(start - 1)
+                if diagnostics_file.read(1) != b'\n':
+                    newline = chunk.find(b'\n', 0, len(chunk) - 1)
+                    if newline >= 0:
+                        chunk = chunk[newline + 1:]
+                    else: # The last line is longer than max_bytes
+                        diagnostics_file.seek(0)
+                        content = diagnostics_file.read()
+                        chunk = content[content.rfind(b'\n', 0, len(content) - 1) + 1:]
+
+        return BytesIO(chunk)
+
+    def remove_local_chunk(self, chunk: BytesIO) -> None:
+        '''Remove an uploaded chunk from the end of the local file.'''
+        size = path.getsize(self.diagnostics_filepath) - len(chunk.getvalue())
+        if size > 0:
+            truncate(self.diagnostics_filepath, size)
+        else:
+            remove(self.diagnostics_filepath)
 
     def get_data_as_bytes(self):
-        '''Return the current diagnostics dictionary as bytes.'''
-        data_string = safe_dump(self.diagnostics, default_flow_style=False)
-        return BytesIO(data_string.encode('utf-8'))
+        '''Return the current diagnostics dictionary as bytes (in the format of the diagnostics file).'''
+        return BytesIO(self.__serialize(self.diagnostics, self.__is_json_lines(self.diagnostics_filepath)).encode('utf-8'))
@@ -0,0 +1,121 @@
+'''Choose how the image is encoded for the upload depending on the link quality and the backlog.'''
+from os import path, makedirs
+from shutil import move
+from io import BytesIO
+import logging
+
+class EncodingPolicy:
+    '''A class to choose the JPEG quality and downscale factor of the uploaded image, so the upload time stays bounded on poor links.'''
+
+    # Encoding levels from best to smallest with the expected file size relative to the original image
+    LEVELS = [
+        {'quality': None, 'scale': 1.0, 'size_ratio': 1.0}, # Original image
+        {'quality': 85, 'scale': 1.0, 'size_ratio': 0.6},
+        {'quality': 80, 'scale': 0.75, 'size_ratio': 0.3},
+        {'quality': 75, 'scale': 0.5, 'size_ratio': 0.12},
+        {'quality': 70, 'scale': 0.25, 'size_ratio': 0.03},
+    ]
+
+    BACKLOG_LIMIT = 20 * 1024 * 1024 # Use one level smaller if more bytes are waiting in the outbox
+    THUMBNAIL_WIDTH = 640 # Width of the preview images in pixels
+
+    @staticmethod
+    def estimate_throughput(signal_quality: float) -> float:
+        '''Estimate the upload throughput in bytes/s from the signal quality if it was never measured.'''
+        # 0...31 (higher is better), 99 not known or not detectable
+        if signal_quality >= 99 or signal_quality < 10:
+            return 20 * 1024
+        if signal_quality < 20:
+            return 100 * 1024
+        return 500 * 1024
+
+    def __init__(self, signal_quality: float = 99, throughput: float = None, outbox_bytes: int = 0, max_upload_seconds: float = 15) -> None:
+        '''Initialize the policy with the signal quality, the measured throughput in bytes/s and the size of the backlog in bytes.'''
+        self.signal_quality = signal_quality
+        self.throughput = throughput or self.estimate_throughput(signal_quality)
+        self.outbox_bytes = outbox_bytes
+        self.max_upload_seconds = max_upload_seconds
+
+    def choose(self, image_bytes: int) -> dict:
+        '''Choose the best encoding level whose expected upload time fits the time limit.'''
+        index = len(self.LEVELS) - 1
+
+        for i, level in enumerate(self.LEVELS):
+            if image_bytes * level['size_ratio'] / self.throughput <= self.max_upload_seconds:
+                index = i
+                break
+
+        # Keep some throughput for the backlog
+        if self.outbox_bytes > self.BACKLOG_LIMIT:
+            index = min(index + 1, len(self.LEVELS) - 1)
+
+        return self.LEVELS[index]
+
+    @staticmethod
+    def create_thumbnail(source, width: int = THUMBNAIL_WIDTH) -> BytesIO:
+        '''Create a small preview of an image (file or file-like object), which can be uploaded before the full image.'''
+        from PIL import Image
+
+        if hasattr(source, 'seek'):
+            source.seek(0)
+
+        thumbnail_data = BytesIO()
+        with Image.open(source) as image:
+            image.thumbnail((width, image.height)) # Keeps the aspect ratio
+            image.save(thumbnail_data, "JPEG", quality=80)
+
+        return thumbnail_data
+
+    @staticmethod
+    def __reencode(source, destination, level: dict) -> None:
+        '''Re-encode an image (file or file-like object) with the quality and scale of an encoding level.'''
+        from PIL import Image
+
+        with Image.open(source) as image:
+            if level['scale'] < 1.0:
+                image = image.resize((int(image.width * level['scale']), int(image.height * level['scale'])))
+            image.save(destination, "JPEG", quality=level['quality'])
+
+    def encode(self, filename: str, local_file_path: str = "", originals_path: str = "originals/") -> dict:
+        '''Re-encode an image for the upload. The original image is moved to the originals directory.'''
+        local_path = f"{local_file_path}{filename}"
+        level = self.choose(path.getsize(local_path))
+
+        if level['quality'] is None:
+            logging.info("Uploading original image.")
+            return level
+
+        original_directory = f"{local_file_path}{originals_path}"
+        makedirs(original_directory, exist_ok=True)
+        original_path = f"{original_directory}{filename}"
+        move(local_path, original_path)
+
+        try:
+            self.__reencode(original_path, local_path, level)
+        except Exception:
+            move(original_path, local_path) # Upload the original image instead
+            raise
+
+        logging.info("Encoded image with quality %s and scale %s.", level['quality'], level['scale'])
+        return level
+
+    def encode_bytes(self, filename: str, image_data: BytesIO, local_file_path: str = "", originals_path: str = "originals/") -> tuple:
+        '''Re-encode an image in memory for the upload. The original image is only written to the originals directory if it was re-encoded.
+        Returns the encoding level and the image to upload.'''
+        level = self.choose(image_data.getbuffer().nbytes)
+
+        if level['quality'] is None:
+            logging.info("Uploading original image.")
+            return level, image_data
+
+        encoded_data = BytesIO()
+        image_data.seek(0)
+        self.__reencode(image_data, encoded_data, level)
+
+        original_directory = f"{local_file_path}{originals_path}"
+        makedirs(original_directory, exist_ok=True)
+        with open(f"{original_directory}{filename}", 'wb') as original_file:
+            original_file.write(image_data.getbuffer())
+
+        logging.info("Encoded image with quality %s and scale %s.", level['quality'], level['scale'])
+        return level, encoded_data
@@ -1,37 +1,122 @@
 """ The fileserver module is used to connect to a file server and perform operations such as downloading and uploading files. """
-from ftplib import FTP
 from io import BytesIO
 from datetime import datetime
-from time import sleep
-from os import remove
+from time import sleep, monotonic
+from random import uniform
+from threading import Lock
+from queue import Queue
+from concurrent.futures import ThreadPoolExecutor
+import socket
+from os import remove, replace, path, SEEK_END
+from tempfile import SpooledTemporaryFile
+from shutil import copyfileobj
+import gzip
+import zlib
+from hashlib import sha256
+import posixpath
 import logging
+from yaml import safe_load, safe_dump
+from transport import Transport, AuthenticationError, create_transport
+
+class TransferAborted(Exception):
+    """Raised by the progress callback to stop a transfer, e.g. if there is no time left."""
 
 class FileServer:
     """A class to connect to a file server and perform operations such as downloading and uploading files."""
     
-    def __init__(self, host: str, username: str, password: str) -> None:
-        """Initialize and connect to the file server."""
+    def __init__(self, host: str, username: str, password: str, upload_state_filepath: str = "uploads.yaml", timeout: float = 60, block_size: int = 8192, protocol: str = "ftp") -> None:
+        """Initialize and connect to the file server within timeout seconds with a protocol (ftp, sftp, http, https or local)."""
         self.MAX_RETRIES = 5
-        self.RETRY_INTERVAL = 5  # seconds
-
-        self.ftp = None
-        self.connected_to_server = self.connect_to_server(host, username, password)
+        self.RETRY_INTERVAL = 1  # seconds, doubled after every failed attempt
+        self.MAX_RETRY_INTERVAL = 8 # seconds
+        self.ATTEMPT_TIMEOUT = 15 # seconds
+        self.MIN_ATTEMPT_TIMEOUT = 1 # seconds, a timeout of 0 or less is rejected by the sockets
+        self.MAX_SESSIONS = 4 # Maximum number of concurrent upload sessions
+        self.LISTING_TTL = 60 # seconds until a cached directory listing is refreshed
+        self.COMPRESSED_SUFFIX = ".gz"
+        self.MAX_COMPRESSED_MEMORY = 1024 * 1024 # bytes, larger compressed files are buffered on disk
+        self.MAX_REPAIR_BYTES = 1024 * 1024 # bytes, larger files are not rewritten to remove an interrupted append
+        self.TEMPORARY_SUFFIX = ".tmp"
+
+        self.upload_state_filepath = upload_state_filepath # Partial uploads which can be resumed after a reboot
+        self.append_state_filepath = path.join(path.dirname(upload_state_filepath), "appends.yaml") # Appends which were not verified yet
+        self.upload_state_lock = Lock()
+        self.protocol = protocol
+        self.transport = None
+
+        # Files are streamed from disk in blocks of block_size bytes, so the memory use does not depend on the file size
+        # progress(filename, sent_bytes, total_bytes) is called after every block, e.g. to check the deadline (it can raise TransferAborted)
+        self.block_size = block_size
+        self.progress = None
+        self.bytes_sent = 0 # Total bytes sent in all sessions
+        self.bytes_sent_lock = Lock()
+
+        # Measurements of every transfer (bytes, duration, throughput, time to first byte and retries)
+        self.transfers = []
+        self.transfers_lock = Lock()
+
+        # Size of the compressed files before and after compression and the time spent compressing them in seconds
+        self.compression = {'raw_bytes': 0, 'compressed_bytes': 0, 'seconds': 0.0}
+        self.address = None
+        self.username = username
+        self.password = password
+
+        # Cached directory listings by path relative to the login directory: (time of listing, {name: facts})
+        self.listings = {}
+        self.current_directory = "."
+
+        # Outcome of the connection ("connected", "auth_failed", "dns_failed" or "unreachable"), its duration in seconds and the number of attempts
+        self.connect_outcome = None
+        self.connect_latency = None
+        self.connect_attempts = 0
+        self.connected_to_server = self.connect_to_server(host, username, password, timeout)
+
+    def connect_to_server(self, host: str, username: str, password: str, timeout: float = 60) -> bool:
+        """Connect to the file server with exponential backoff until the timeout in seconds is reached."""
+        start = monotonic()
+        deadline = start + timeout
+        retry_interval = self.RETRY_INTERVAL
+        self.address = None # Resolved once for all attempts
 
-    def connect_to_server(self, host: str, username: str, password: str) -> bool:
-        """Connect to the file server with retries."""
         for attempt in range(self.MAX_RETRIES):
+            self.connect_attempts = attempt + 1
             try:
-                self.ftp = FTP(host, username, password, timeout=15)
+                self.transport = create_transport(self.protocol)
+
+                if self.address is None:
+                    self.address = socket.getaddrinfo(host, None, type=socket.SOCK_STREAM)[0][4][0] if self.transport.RESOLVE_HOST else host
+
+                attempt_timeout = max(min(self.ATTEMPT_TIMEOUT, deadline - monotonic()), self.MIN_ATTEMPT_TIMEOUT)
+                self.transport.connect(self.address, username, password, attempt_timeout)
+
                 logging.info("Connected to file server.")
+                self.connect_outcome = "connected"
+                self.connect_latency = round(monotonic() - start, 3)
                 return True
+            except AuthenticationError as e: # Wrong username or password, retrying does not help
+                logging.error("Could not log in to fileserver: %s", str(e))
+                self.connect_outcome = "auth_failed"
+                break
+            except ValueError as e: # Unknown protocol
+                logging.error("Could not connect to fileserver: %s", str(e))
+                self.connect_outcome = "unreachable"
+                break
             except Exception as e:
+                self.connect_outcome = "dns_failed" if self.address is None else "unreachable"
                 if attempt > 1:
                     logging.warning("Could not connect to fileserver: %s, attempt %s/%s failed.", str(e), attempt+1, self.MAX_RETRIES)
                 else:
                     logging.info("Could not connect to fileserver: %s, attempt %s/%s failed.", str(e), attempt+1, self.MAX_RETRIES)
-                sleep(self.RETRY_INTERVAL) # Wait and try again
 
-        logging.error("Failed to connect to the file server after maximum retries.")
+            # Wait with jitter and try again if there is enough time left for another attempt
+            delay = uniform(retry_interval / 2, retry_interval)
+            if attempt + 1 == self.MAX_RETRIES or monotonic() + delay >= deadline:
+                break
+            sleep(delay)
+            retry_interval = min(retry_interval * 2, self.MAX_RETRY_INTERVAL)
+
+        self.connect_latency = round(monotonic() - start, 3)
+        logging.error("Failed to connect to the file server: %s", self.connect_outcome)
         return False
 
     def connected(self) -> bool:
@@ -41,80 +126,565 @@ class FileServer:
     def change_directory(self, directory: str, create: bool = False) -> None:
         """Change the current directory on the file server"""
         try:
-            directory_list = self.list_files()
-
-            if create and directory not in directory_list:
-                self.ftp.mkd(directory)
+            if create:
+                self.create_directory(directory)
 
-            self.ftp.cwd(directory)
+            self.transport.cwd(directory)
+            self.current_directory = self.__directory_key(directory)
 
         except Exception as e:
             logging.warning("Could not change directory on file server: %s", str(e))
 
-    def download_file(self, filename: str, local_file_path: str = "") -> None:
-        """Download a file from the file server and save it locally."""
+    def __directory_key(self, directory: str = None) -> str:
+        """Return the path of a directory relative to the login directory, which is used to cache its listing."""
+        return posixpath.normpath(posixpath.join(self.current_directory, directory or "."))
+
+    def invalidate_listing(self, filename: str = "") -> None:
+        """Remove the cached listing of the directory containing a file, e.g. after it was changed."""
+        self.listings.pop(self.__directory_key(posixpath.dirname(filename)), None)
+
+    def list_directory(self, directory: str = None) -> dict:
+        """List the files in the current or specified directory with their facts (type, size and modify, e.g. if the FTP server supports MLSD).
+        The listing is cached for LISTING_TTL seconds."""
+        key = self.__directory_key(directory)
+        cached = self.listings.get(key)
+        if cached is not None and monotonic() - cached[0] < self.LISTING_TTL:
+            return cached[1]
+
+        entries = self.transport.list(directory)
+        self.listings[key] = (monotonic(), entries)
+        return entries
+
+    def open_session(self) -> Transport:
+        """Open another session to the same file server and directory, e.g. to upload files concurrently."""
+        transport = create_transport(self.protocol)
+        transport.connect(self.address, self.username, self.password, self.ATTEMPT_TIMEOUT)
+        transport.cwd(self.transport.pwd())
+        return transport
+
+    def create_directory(self, directory: str) -> None:
+        """Create a directory in the current directory on the file server if it does not exist."""
+        try:
+            if directory not in self.list_files():
+                self.transport.mkd(directory)
+                self.invalidate_listing()
+
+        except Exception as e:
+            logging.warning("Could not create directory on file server: %s", str(e))
+
+    def download_file(self, filename: str, local_file_path: str = "", size: int = None) -> bool:
+        """Download a file from the file server and save it locally. The local file is only replaced if the download is complete
+        (and has the given size). Returns if the file was downloaded."""
         local_path = f"{local_file_path}{filename}"
+        temporary_path = f"{local_path}.tmp"
+        transfer = self.__start_transfer("download", filename)
         try:
-            with open(local_path, 'wb') as local_file:
-                self.ftp.retrbinary(f"RETR {filename}", local_file.write)
+            with open(temporary_path, 'wb') as local_file:
+                self.transport.get(filename, self.__counter(transfer, local_file.write), block_size=self.block_size)
+
+            if size is not None and path.getsize(temporary_path) != size:
+                raise Exception(f"Downloaded {path.getsize(temporary_path)} of {size} bytes")
+
+            replace(temporary_path, local_path)
+            self.__finish_transfer(transfer, True)
             logging.info("Successfully downloaded %s to %s", filename, local_path)
+            return True
         except Exception as e:
+            self.__finish_transfer(transfer, False)
             logging.error("Failed to download file: %s", str(e))
+            if path.exists(temporary_path):
+                remove(temporary_path)
+        return False
 
-    def upload_file(self, filename: str, local_file_path: str = "", delete_after_upload = False) -> None:
-        """Upload a file to the file server."""
+    def download_file_if_changed(self, filename: str, local_file_path: str = "", manifest_filepath: str = "manifest.yaml") -> bool:
+        """Download a file from the current directory only if its size or modification time on the server or the local copy changed
+        since the last download. The size, modification time and hash of downloaded files are kept in a local manifest.
+        Returns if the file was downloaded."""
         local_path = f"{local_file_path}{filename}"
         try:
+            facts = self.list_directory().get(filename, {})
+            remote = {'size': int(facts['size']) if 'size' in facts else self.get_file_size(filename),
+                      'modify': facts.get('modify', '')[:14] or self.transport.mtime(filename).strftime('%Y%m%d%H%M%S')}
+
+            manifest = {}
+            if path.exists(manifest_filepath):
+                with open(manifest_filepath, 'r', encoding='utf-8') as yaml_file:
+                    manifest = safe_load(yaml_file) or {}
+
+            entry = manifest.get(filename, {})
+            if path.exists(local_path) and entry.get('size') == remote['size'] and entry.get('modify') == remote['modify']:
+                with open(local_path, 'rb') as local_file:
+                    if sha256(local_file.read()).hexdigest() == entry.get('hash'):
+                        logging.info("%s did not change.", filename)
+                        return False
+
+            # The manifest is only updated with a complete download, so an incomplete file is downloaded again next time
+            if not self.download_file(filename, local_file_path, remote['size']):
+                return False
+
             with open(local_path, 'rb') as local_file:
-                response = self.ftp.storbinary(f"STOR {filename}", local_file)
+                manifest[filename] = {**remote, 'hash': sha256(local_file.read()).hexdigest()}
 
-            if not response.startswith('226'):
-                raise Exception(f"Failed to upload file: {response}")
+            with open(manifest_filepath, 'w', encoding='utf-8') as yaml_file:
+                safe_dump(manifest, yaml_file)
+            return True
+        except Exception as e:
+            logging.error("Failed to check if %s changed: %s", filename, str(e))
+            return self.download_file(filename, local_file_path)
 
-            logging.info("Successfully uploaded %s", local_file)
+    def __load_upload_state(self, filepath: str = None) -> dict:
+        """Load the partial uploads (or appends) from the local state file."""
+        filepath = filepath or self.upload_state_filepath
+        try:
+            if path.exists(filepath):
+                with open(filepath, 'r', encoding='utf-8') as yaml_file:
+                    state = safe_load(yaml_file) or {}
+                # Older versions saved only the size of a file
+                return {filename: entry if isinstance(entry, dict) else {'size': entry} for filename, entry in state.items()}
+        except Exception as e:
+            logging.warning("Could not open upload state: %s", str(e))
+        return {}
+
+    def __save_upload_state(self, filename: str, size: int = None) -> int:
+        """Record a started upload of a file with its size or remove it if size is None. Returns the number of attempts to upload the file."""
+        attempts = 0
+        try:
+            with self.upload_state_lock:
+                upload_state = self.__load_upload_state()
+                if size is None:
+                    if filename not in upload_state:
+                        return attempts
+                    upload_state.pop(filename)
+                else:
+                    entry = upload_state.get(filename, {})
+                    attempts = entry.get('attempts', 0) + 1 if entry.get('size') == size else 1
+                    upload_state[filename] = {'size': size, 'attempts': attempts}
+
+                with open(self.upload_state_filepath, 'w', encoding='utf-8') as yaml_file:
+                    safe_dump(upload_state, yaml_file)
+        except Exception as e:
+            logging.warning("Could not save upload state: %s", str(e))
+
+        return attempts
+
+    def __save_append_state(self, filename: str, offset: int = None, size: int = None) -> None:
+        """Record an append of size bytes at offset to a file or remove it if offset is None."""
+        try:
+            with self.upload_state_lock:
+                append_state = self.__load_upload_state(self.append_state_filepath)
+                if offset is None:
+                    if filename not in append_state:
+                        return
+                    append_state.pop(filename)
+                else:
+                    append_state[filename] = {'offset': offset, 'size': size}
+
+                with open(self.append_state_filepath, 'w', encoding='utf-8') as yaml_file:
+                    safe_dump(append_state, yaml_file)
+        except Exception as e:
+            logging.warning("Could not save append state: %s", str(e))
+
+    def __remove_interrupted_append(self, filename: str) -> bool:
+        """Cut the data of an interrupted append off the end of a file on the server, as everything appended after a partial gzip member
+        or JSON line could not be read otherwise. The file is rewritten to a temporary file, which replaces it, so the file is never truncated
+        by another interruption. Files larger than MAX_REPAIR_BYTES are not rewritten, the partial gzip member is skipped when reading them.
+        Returns if the file can be appended to."""
+        with self.upload_state_lock:
+            entry = self.__load_upload_state(self.append_state_filepath).get(filename)
+        if entry is None:
+            return True
+
+        remote_size = self.get_file_size(filename)
+        if remote_size is not None and entry['offset'] < remote_size < entry['offset'] + entry['size']:
+            if remote_size > self.MAX_REPAIR_BYTES:
+                logging.warning("%s is too large to remove the interrupted append (%s of %s bytes).", filename, remote_size - entry['offset'], entry['size'])
+            else:
+                logging.warning("Removing interrupted append from %s (%s of %s bytes).", filename, remote_size - entry['offset'], entry['size'])
+                temporary_filename = f"{filename}{self.TEMPORARY_SUFFIX}"
+                transfer = self.__start_transfer("upload", temporary_filename)
+                try:
+                    if self.progress is not None: # Stops before the download if there is no time left
+                        self.progress(filename, 0, entry['offset'])
+
+                    file_data = self.get_file_as_bytes(filename).getvalue()
+                    if len(file_data) != remote_size:
+                        raise Exception(f"Could not download {filename}")
+
+                    self.transport.put(temporary_filename, BytesIO(file_data[:entry['offset']]), 0, self.block_size,
+                                       self.__reporter(temporary_filename, 0, entry['offset'], transfer))
+                    if self.get_file_size(temporary_filename) != entry['offset']:
+                        raise Exception(f"Could not upload {temporary_filename}")
+
+                    self.transport.rename(temporary_filename, filename)
+                    self.__finish_transfer(transfer, True)
+                except Exception as e:
+                    self.__finish_transfer(transfer, False)
+                    logging.error("Could not remove interrupted append from %s: %s", filename, str(e))
+                    return False
+                finally:
+                    self.invalidate_listing(filename)
+
+                if self.get_file_size(filename) != entry['offset']:
+                    logging.error("Could not remove interrupted append from %s.", filename)
+                    return False
+
+        self.__save_append_state(filename)
+        return True
+
+    @staticmethod
+    def decompress(file_data: bytes) -> bytes:
+        """Decompress concatenated gzip members. A partial member of an interrupted append, which could not be removed, is skipped."""
+        members = []
+        start = 0
+        while start < len(file_data):
+            decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+            try:
+                member = decompressor.decompress(file_data[start:])
+                if decompressor.eof:
+                    members.append(member)
+                    start = len(file_data) - len(decompressor.unused_data)
+                    continue
+            except zlib.error:
+                pass
+
+            # Continue with the next member
+            next_start = file_data.find(b'\x1f\x8b\x08', start + 1)
+            logging.warning("Skipping %s bytes of a partial gzip member.", (next_start if next_start >= 0 else len(file_data)) - start)
+            if next_start < 0:
+                break
+            start = next_start
+
+        return b"".join(members)
+
+    def get_file_size(self, filename: str, transport: Transport = None) -> int:
+        """Get the size of a file on the file server in bytes or None if it does not exist."""
+        try:
+            return (transport or self.transport).size(filename)
+        except Exception:
+            return None
+
+    def __start_transfer(self, direction: str, filename: str, retries: int = 0) -> dict:
+        """Start measuring a transfer (upload, append or download)."""
+        return {'file': filename, 'direction': direction, 'start': monotonic(), 'bytes': 0, 'first_byte_seconds': None, 'retries': retries}
+
+    def __finish_transfer(self, transfer: dict, success: bool) -> None:
+        """Finish measuring a transfer and keep the measurement."""
+        seconds = monotonic() - transfer.pop('start')
+        transfer.update(seconds=round(seconds, 3), throughput=round(transfer['bytes'] / seconds) if seconds > 0 else 0, success=success)
+        with self.transfers_lock:
+            self.transfers.append(transfer)
+
+    def __counter(self, transfer: dict, write = None):
+        """Return a callback which counts the bytes of every block of a transfer and passes the block on to write."""
+        def count(block: bytes) -> None:
+            if transfer['first_byte_seconds'] is None:
+                transfer['first_byte_seconds'] = round(monotonic() - transfer['start'], 3)
+            transfer['bytes'] += len(block)
+            if write is not None:
+                write(block)
+
+        return count
+
+    def __reporter(self, filename: str, sent_bytes: int, total_bytes: int, transfer: dict):
+        """Return a callback which counts the bytes sent in every block and reports the progress."""
+        count = self.__counter(transfer)
+
+        def report(block: bytes) -> None:
+            nonlocal sent_bytes
+            count(block)
+            sent_bytes += len(block)
+            with self.bytes_sent_lock:
+                self.bytes_sent += len(block)
+            if self.progress is not None:
+                self.progress(filename, sent_bytes, total_bytes)
+
+        return report
+
+    def __upload(self, filename: str, file_data, transport: Transport = None) -> None:
+        """Upload a file object to the file server. An interrupted upload of the same file is resumed from the size on the server."""
+        transport = transport or self.transport
+        file_data.seek(0, SEEK_END)
+        size = file_data.tell()
+        offset = 0
+
+        # Only resume uploads this device started (the file on the server may be from an older upload otherwise)
+        with self.upload_state_lock:
+            upload_state = self.__load_upload_state()
+        if upload_state.get(filename, {}).get('size') == size:
+            remote_size = self.get_file_size(filename, transport) or 0
+            if remote_size == size:
+                logging.info("%s was already uploaded completely.", filename)
+                self.__save_upload_state(filename)
+                return
+            if remote_size < size:
+                offset = remote_size
+
+        attempts = self.__save_upload_state(filename, size)
+        file_data.seek(offset)
+        transfer = self.__start_transfer("upload", filename, max(attempts - 1, 0))
+
+        try:
+            try:
+                if offset > 0:
+                    logging.info("Resuming upload of %s at %s/%s bytes.", filename, offset, size)
+                transport.put(filename, file_data, offset, self.block_size, self.__reporter(filename, offset, size, transfer))
+            finally:
+                self.invalidate_listing(filename)
+
+            remote_size = self.get_file_size(filename, transport)
+            if remote_size is not None and remote_size != size:
+                raise Exception(f"Size of uploaded file is {remote_size} instead of {size} bytes")
+        except Exception:
+            self.__finish_transfer(transfer, False)
+            raise
+
+        self.__finish_transfer(transfer, True)
+        self.__save_upload_state(filename)
+
+    def upload_file(self, filename: str, local_file_path: str = "", delete_after_upload = False) -> bool:
+        """Upload a file to the file server and return if it was successful."""
+        local_path = f"{local_file_path}{filename}"
+        try:
+            with open(local_path, 'rb') as local_file:
+                self.__upload(filename, local_file)
+
+            logging.info("Successfully uploaded %s", local_path)
 
             if delete_after_upload:
                 logging.info("Deleting local file: %s", local_path)
                 remove(local_path)
+
+            return True
         except Exception as e:
             logging.error("Failed to upload file: %s", str(e))
+            return False
+
+    def upload_files(self, filenames: list, local_file_path: str = "", delete_after_upload = False, sessions: int = 1, should_continue = None) -> dict:
+        """Upload files concurrently over up to sessions connections. Files are only started while should_continue() returns True.
+        Returns the uploaded files, the error of each failed file and the throughput of all sessions and of a single session."""
+        start = monotonic()
+        sessions = max(1, min(sessions, self.MAX_SESSIONS, len(filenames)))
+
+        # Each session uploads one file at a time
+        pool = Queue()
+        pool.put(self.transport)
+        additional_sessions = []
+        for _ in range(sessions - 1):
+            try:
+                additional_sessions.append(self.open_session())
+                pool.put(additional_sessions[-1])
+            except Exception as e:
+                logging.warning("Could not open additional upload session: %s", str(e))
+                break
+
+        result = {'uploaded': [], 'errors': {}, 'sessions': len(additional_sessions) + 1, 'bytes': 0, 'transfer_seconds': 0.0}
+        result_lock = Lock()
+
+        def upload(filename: str) -> None:
+            if should_continue is not None and not should_continue():
+                return
+
+            local_path = f"{local_file_path}{filename}"
+            transport = pool.get()
+            try:
+                file_start = monotonic()
+                with open(local_path, 'rb') as local_file:
+                    self.__upload(filename, local_file, transport)
+                    num_bytes = local_file.tell()
+
+                with result_lock:
+                    result['uploaded'].append(filename)
+                    result['bytes'] += num_bytes
+                    result['transfer_seconds'] += monotonic() - file_start
+                logging.info("Successfully uploaded %s", local_path)
+
+                if delete_after_upload:
+                    remove(local_path)
+            except Exception as e:
+                logging.error("Failed to upload file %s: %s", filename, str(e))
+                with result_lock:
+                    result['errors'][filename] = str(e)
+            finally:
+                pool.put(transport)
+
+        with ThreadPoolExecutor(max_workers=result['sessions']) as executor:
+            list(executor.map(upload, filenames))
+
+        for transport in additional_sessions:
+            try:
+                transport.close()
+            except Exception as e:
+                logging.warning("Could not close upload session: %s", str(e))
+
+        result['seconds'] = monotonic() - start
+        result['throughput'] = result['bytes'] / result['seconds'] if result['seconds'] > 0 else 0 # All sessions in bytes/s
+        result['session_throughput'] = result['bytes'] / result['transfer_seconds'] if result['transfer_seconds'] > 0 else 0 # Single session in bytes/s
+        return result
+
+    def upload_file_from_bytes(self, filename: str, file_data: BytesIO) -> bool:
+        """Upload a file from memory to the file server and return if it was successful."""
+        try:
+            self.__upload(filename, file_data)
+            logging.info("Successfully uploaded %s", filename)
+            return True
+        except Exception as e:
+            logging.error("Failed to upload file: %s", str(e))
+            return False
+
+    def __compress(self, file_data):
+        """Compress a file object as a gzip member. Concatenated gzip members are a valid gzip file, so they can be appended."""
+        start = monotonic()
+        compressed_data = SpooledTemporaryFile(max_size=self.MAX_COMPRESSED_MEMORY)
+
+        file_data.seek(0)
+        with gzip.GzipFile(fileobj=compressed_data, mode='wb', mtime=0) as gzip_file:
+            copyfileobj(file_data, gzip_file, self.block_size)
+
+        self.compression['raw_bytes'] += file_data.tell()
+        self.compression['compressed_bytes'] += compressed_data.tell()
+        self.compression['seconds'] += monotonic() - start
+        return compressed_data
 
-    def append_file(self, filename: str, local_file_path: str = "", delete_after_upload = False) -> None:
-        """Append a file to the file server."""
+    def append_file(self, filename: str, local_file_path: str = "", delete_after_upload = False, compress = False) -> bool:
+        """Append a file to the file server (streamed from disk) and return if it was successful.
+        If compress is True, the file is appended gzip compressed to filename.gz."""
         local_path = f"{local_file_path}{filename}"
         try:
             with open(local_path, 'rb') as local_file:
-                self.append_file_from_bytes(filename, BytesIO(local_file.read()))
+                if not self.append_file_from_bytes(filename, local_file, compress):
+                    return False
             logging.info("Successfully appended %s", local_path)
 
             if delete_after_upload:
                 logging.info("Deleting local file: %s", local_path)
                 remove(local_path)
+
+            return True
         except Exception as e:
             logging.error("Failed to append file: %s", str(e))
+            return False
 
-    def append_file_from_bytes(self, filename: str, file_data: BytesIO) -> None:
-        """Append a file to the file server."""
+    def append_file_from_bytes(self, filename: str, file_data, compress = False) -> bool:
+        """Append a file object to the file server and return if it was successful.
+        If compress is True, the data is appended gzip compressed to filename.gz."""
         try:
-            self.ftp.storbinary(f"APPE {filename}", file_data)
+            if compress:
+                file_data = self.__compress(file_data)
+                filename = f"{filename}{self.COMPRESSED_SUFFIX}"
+
+            file_data.seek(0, SEEK_END)
+            total_bytes = file_data.tell()
+            file_data.seek(0)
+
+            # Nothing is appended after an interrupted append, the size of the file is checked after every append
+            if not self.__remove_interrupted_append(filename):
+                raise Exception(f"{filename} ends with an interrupted append")
+            offset = self.get_file_size(filename) or 0
+            self.__save_append_state(filename, offset, total_bytes)
+
+            transfer = self.__start_transfer("append", filename)
+            try:
+                try:
+                    self.transport.append(filename, file_data, self.block_size, self.__reporter(filename, 0, total_bytes, transfer))
+                finally:
+                    self.invalidate_listing(filename)
+
+                remote_size = self.get_file_size(filename)
+                if remote_size is not None and remote_size != offset + total_bytes:
+                    raise Exception(f"Size of {filename} is {remote_size} instead of {offset + total_bytes} bytes after the append")
+            except Exception as e:
+                self.__finish_transfer(transfer, False)
+                if not isinstance(e, TransferAborted): # There is no time left otherwise, it is removed before the next append
+                    self.__remove_interrupted_append(filename)
+                raise
+
+            self.__finish_transfer(transfer, True)
+            self.__save_append_state(filename)
+
             logging.info("Successfully appended data to %s", filename)
+            return True
         except Exception as e:
             logging.error("Failed to append data: %s", str(e))
+            return False
 
-    def get_file_as_bytes(self, filename: str) -> BytesIO:
-        """Retrieve a file from the file server as a BytesIO object."""
+    def delete_file(self, filename: str) -> bool:
+        """Delete a file on the file server and return if it was successful."""
+        try:
+            self.transport.delete(filename)
+            logging.info("Deleted %s on the file server", filename)
+            return True
+        except Exception as e:
+            logging.error("Failed to delete file: %s", str(e))
+            return False
+        finally:
+            self.invalidate_listing(filename)
+
+    def rename_file(self, filename: str, new_filename: str) -> bool:
+        """Rename a file on the file server (replacing an existing file) and return if it was successful."""
+        try:
+            self.transport.rename(filename, new_filename)
+            logging.info("Renamed %s to %s on the file server", filename, new_filename)
+            return True
+        except Exception as e:
+            logging.error("Failed to rename file: %s", str(e))
+            return False
+        finally:
+            self.invalidate_listing(filename)
+            self.invalidate_listing(new_filename)
+
+    def get_file_as_bytes(self, filename: str, offset: int = 0) -> BytesIO:
+        """Retrieve a file (from offset on, e.g. only the data appended since the last download) from the file server as a BytesIO object."""
         file_data = BytesIO()
+        transfer = self.__start_transfer("download", filename)
         try:
-            self.ftp.retrbinary(f"RETR {filename}", file_data.write)
+            self.transport.get(filename, self.__counter(transfer, file_data.write), offset, self.block_size)
+            self.__finish_transfer(transfer, True)
             return file_data
         except Exception as e:
+            self.__finish_transfer(transfer, False)
             logging.error("Failed to retrieve file: %s", str(e))
             return BytesIO()
 
-    def list_files(self) -> list:
+    def get_transfer_summary(self) -> dict:
+        """Summarize the transfers of this session: number of transfers and failed transfers, bytes, duration in seconds,
+        throughput in bytes/s, median time to first byte in seconds and retries."""
+        with self.transfers_lock:
+            transfers = list(self.transfers)
+
+        total_bytes = sum(transfer['bytes'] for transfer in transfers)
+        total_seconds = sum(transfer['seconds'] for transfer in transfers)
+        first_byte_seconds = sorted(transfer['first_byte_seconds'] for transfer in transfers if transfer['first_byte_seconds'] is not None)
+
+        return {
+            'count': len(transfers),
+            'failed': len([transfer for transfer in transfers if not transfer['success']]),
+            'bytes': total_bytes,
+            'seconds': round(total_seconds, 3),
+            'throughput': round(total_bytes / total_seconds) if total_seconds > 0 else 0,
+            'first_byte_seconds': first_byte_seconds[len(first_byte_seconds) // 2] if first_byte_seconds else None,
+            'retries': sum(transfer['retries'] for transfer in transfers),
+        }
+
+    def get_file_as_text(self, filename: str) -> str:
+        """Retrieve a text file, which may also (or only) be appended compressed as filename.gz, from the file server."""
+        text = ""
+        try:
+            filenames = self.list_files(posixpath.dirname(filename) or None)
+            if posixpath.basename(filename) in filenames:
+                text += self.get_file_as_bytes(filename).getvalue().decode('utf-8')
+
+            if f"{posixpath.basename(filename)}{self.COMPRESSED_SUFFIX}" in filenames:
+                compressed_data = self.get_file_as_bytes(f"{filename}{self.COMPRESSED_SUFFIX}").getvalue()
+                text += self.decompress(compressed_data).decode('utf-8')
+        except Exception as e:
+            logging.error("Failed to retrieve text file: %s", str(e))
+
+        return text
+
+    def list_files(self, directory: str = None) -> list:
         """List files in the current or specified directory"""
         try:
-            return self.ftp.nlst()
+            return list(self.list_directory(directory))
         except Exception as e:
             logging.error("Failed to list files: %s", str(e))
             return []
@@ -122,8 +692,12 @@ class FileServer:
     def get_file_last_modified_date(self, filename: str) -> datetime:
         """Get the last modification date of a file on the file server."""
         try:
-            response = self.ftp.sendcmd(f"MDTM {filename}")
-            return datetime.strptime(response[4:], '%Y%m%d%H%M%S') # Convert to datetime
+            cached = self.listings.get(self.__directory_key(posixpath.dirname(filename)))
+            facts = cached[1].get(posixpath.basename(filename), {}) if cached is not None else {}
+            if 'modify' in facts: # From the cached listing
+                return datetime.strptime(facts['modify'][:14], '%Y%m%d%H%M%S')
+
+            return self.transport.mtime(filename)
         except Exception as e:
             logging.error("Failed to get file last modified date: %s", str(e))
             return datetime.now()
@@ -131,7 +705,7 @@ class FileServer:
     def quit(self) -> None:
         """Close the file server connection."""
         try:
-            self.ftp.quit()
+            self.transport.close()
             logging.info("File server connection closed.")
         except Exception as e:
             logging.error("Failed to close file server connection: %s", str(e))
@@ -1,7 +1,10 @@
 '''GlacierCam firmware - see https://github.com/Eagleshot/GlacierCam for more information'''
 
-from os import listdir, system
+from os import system, environ, makedirs, path, replace
+from io import BytesIO
 from datetime import datetime, time
+from time import monotonic, sleep
+from concurrent.futures import ThreadPoolExecutor
 import logging
 from logging.handlers import RotatingFileHandler
 from picamera2 import Picamera2
@@ -10,6 +13,8 @@ from yaml import safe_load
 ###########################
 # Configuration and filenames
 ###########################
+CONFIG_START = monotonic()
+
 try:
     VERSION = "1.0.7"
 
@@ -31,10 +36,10 @@ try:
         return cpuserial
 
     CAMERA_NAME = get_cpu_serial() # Unique hardware serial number
-    FILE_PATH = "/home/pi/"  # Path where files are saved
+    FILE_PATH = environ.get("GLACIERCAM_FILE_PATH", "/home/pi/")  # Path where files are saved
 
     from data import Data
-    data = Data()
+    data = Data(f"{FILE_PATH}diagnostics.jsonl")
     data.add('version', VERSION)
 except Exception as e:
     logging.critical("Could not setup configuration: %s", str(e))
@@ -54,272 +59,786 @@ try: # Read config file from SD card
 except Exception as e:
     logging.critical("Could not open config.yaml: %s", str(e))
 
+CONFIG_DURATION = round(monotonic() - CONFIG_START, 3)
+
+# Shared state of the stages below
+CONNECTED_TO_SERVER = False
+SETTINGS_CHANGED = True # Settings changed since the last wake cycle
+signal_quality = 99 # Not known
+cameras = {} # Camera index: (camera, configuration)
+image_filenames = [] # Images of this wake cycle
+image_buffers = {} # Images of this wake cycle which are kept in memory
+thumbnail_buffers = {} # Previews of the images of this wake cycle
+THUMBNAIL_DIRECTORY = "thumbs" # Directory on the file server for the previews
+sampler = None # Background sensor sampling (if enabled)
+
 ###########################
 # Connect to fileserver
 ###########################
-try:
-    from fileserver import FileServer
+def connect_to_fileserver():
+    '''Connect to the file server and change to the camera directory.'''
+    global fileserver, CONNECTED_TO_SERVER
+    try:
+        from fileserver import FileServer
 
-    fileserver = FileServer(config["ftpServerAddress"], config["username"], config["password"])
-    CONNECTED_TO_SERVER = fileserver.connected()
+        fileserver = FileServer(config["ftpServerAddress"], config["username"], config["password"], f"{FILE_PATH}uploads.yaml",
+                                min(CONNECT_TIMEOUT, runner.remaining()), protocol=config.get("protocol", "ftp"))
+        CONNECTED_TO_SERVER = fileserver.connected()
 
-    # Go to custom fileserver directory if specified
-    if config["ftpDirectory"] != "" and CONNECTED_TO_SERVER:
-        fileserver.change_directory(config["ftpDirectory"], True)
+        # Go to custom fileserver directory if specified
+        if config["ftpDirectory"] != "" and CONNECTED_TO_SERVER:
+            fileserver.change_directory(config["ftpDirectory"], True)
 
-    # Custom camera directory
-    if config["multipleCamerasOnServer"] and CONNECTED_TO_SERVER:
-        fileserver.change_directory(CAMERA_NAME, True)
-except Exception as e:
-    logging.warning("Could not change directory on fileserver: %s", str(e))
+        # Custom camera directory
+        if config["multipleCamerasOnServer"] and CONNECTED_TO_SERVER:
+            fileserver.change_directory(CAMERA_NAME, True)
+    except Exception as e:
+        logging.warning("Could not change directory on fileserver: %s", str(e))
 
 ###########################
 # Settings
 ###########################
-try:
-    if CONNECTED_TO_SERVER:
-        file_list = fileserver.list_files()
+def read_local_settings():
+    '''Read the settings from the last wake cycle, so the camera doesn't have to wait for the file server.'''
+    global camera_settings
+    try:
+        from settings import Settings
+        camera_settings = Settings(f"{FILE_PATH}settings.yaml")
+    except Exception as e:
+        logging.critical("Could not open local settings.yaml: %s", str(e))
+
+def update_settings():
+    '''Download the settings file from the file server if it changed and read it.'''
+    global settings, SETTINGS_CHANGED
+    try:
+        if CONNECTED_TO_SERVER:
+            file_list = fileserver.list_files()
+
+            # Check if settings file exists
+            if "settings.yaml" in file_list:
+                fileserver.download_file_if_changed("settings.yaml", FILE_PATH, f"{FILE_PATH}manifest.yaml")
+            else:
+                logging.warning("No settings file on server. Creating new file with default settings.")
+                fileserver.upload_file("settings.yaml", FILE_PATH)
+    except Exception as e:
+        logging.critical("Could not download settings file from FTP server: %s", str(e))
 
-        # Check if settings file exists
-        if "settings.yaml" in file_list:
-            fileserver.download_file("settings.yaml", FILE_PATH)
-        else:
-            logging.warning("No settings file on server. Creating new file with default settings.")
-            fileserver.upload_file("settings.yaml", FILE_PATH)
-except Exception as e:
-    logging.critical("Could not download settings file from FTP server: %s", str(e))
+    try: # Read settings file
+        from settings import Settings
+        settings = Settings(f"{FILE_PATH}settings.yaml")
+    except Exception as e:
+        logging.critical("Could not open settings.yaml: %s", str(e))
 
-try: # Read settings file
-    from settings import Settings
-    settings = Settings(f"{FILE_PATH}settings.yaml")
-except Exception as e:
-    logging.critical("Could not open settings.yaml: %s", str(e))
+    try: # Compare with the settings of the last wake cycle
+        SETTINGS_CHANGED = settings.get_hash() != camera_settings.get_hash()
+        data.add('settings_changed', SETTINGS_CHANGED)
+    except Exception as e:
+        logging.warning("Could not compare settings: %s", str(e))
 
-try: # Set log level according to settings
-    logging.getLogger().setLevel(settings.get("logLevel"))
-except Exception as e:
-    logging.warning("Could not change log level: %s", str(e))
+    try: # Set log level according to settings
+        logging.getLogger().setLevel(settings.get("logLevel"))
+    except Exception as e:
+        logging.warning("Could not change log level: %s", str(e))
 
 ###########################
 # Time synchronization
 ###########################
-try:
-    from witty_pi_4 import WittyPi4
-    wittyPi = WittyPi4()
-
-    if settings.get("timeSync") and CONNECTED_TO_SERVER:
-        wittyPi.sync_time_with_network()
-except Exception as e:
-    logging.warning("Could not synchronize time with network: %s", str(e))
+def setup_witty_pi():
+    '''Set up the Witty Pi 4 with the backend of the local settings.'''
+    global wittyPi
+    try:
+        from witty_pi_4 import WittyPi4
+        wittyPi = WittyPi4(camera_settings.get("wittyPiBackend"))
+    except Exception as e:
+        logging.warning("Could not set up Witty Pi 4: %s", str(e))
 
-try:
-    TIMESTAMP_CSV = datetime.today().strftime('%Y-%m-%d %H:%MZ') # UTC-Time
-    TIMESTAMP_FILENAME = datetime.today().strftime('%Y%m%d_%H%MZ') # UTC-Time
-    data.add('timestamp', TIMESTAMP_CSV)
-except Exception as e:
-    logging.warning("Could not get timestamp: %s", str(e))
+def synchronize_time():
+    '''Synchronize the time of the Witty Pi 4 with the network.'''
+    try:
+        if settings.get("timeSync") and CONNECTED_TO_SERVER:
+            wittyPi.sync_time_with_network()
+    except Exception as e:
+        logging.warning("Could not synchronize time with network: %s", str(e))
+
+def get_timestamp():
+    '''Get the timestamp of this wake cycle, which is used for the diagnostics and the image filename.'''
+    global TIMESTAMP_CSV, TIMESTAMP_FILENAME
+    try:
+        TIMESTAMP_CSV = datetime.today().strftime('%Y-%m-%d %H:%MZ') # UTC-Time
+        TIMESTAMP_FILENAME = datetime.today().strftime('%Y%m%d_%H%MZ') # UTC-Time
+        data.add('timestamp', TIMESTAMP_CSV)
+    except Exception as e:
+        logging.warning("Could not get timestamp: %s", str(e))
 
 ###########################
 # Generate schedule
 ###########################
-try:
-    wittyPi.set_interval_length(settings.get("intervalMinutes"), settings.get("intervalHours"))
+def generate_and_apply_schedule():
+    '''Generate the schedule from the settings and battery voltage and apply it.'''
+    try:
+        wittyPi.set_interval_length(settings.get("intervalMinutes"), settings.get("intervalHours"))
 
-    if settings.get("enableSunriseSunset"): # TODO
-        wittyPi.set_start_end_time_sunrise(settings.get("latitude"), settings.get("longitude"))
-    else:
-        wittyPi.set_start_time(time(settings.get("startTimeHour"), settings.get("startTimeMinute")))
-        wittyPi.set_end_time(time(settings.get("endTimeHour"), settings.get("endTimeMinute")))
-except Exception as e:
-    logging.warning("Could not set schedule: %s", str(e))
-
-try: # Get battery voltage and adjust schedule
-    battery_voltage = wittyPi.get_battery_voltage()
-    data.add('battery_voltage', battery_voltage)
-
-    battery_voltage_half = settings.get("batteryVoltageHalf")
-    battery_voltage_quarter = (battery_voltage_half + settings.get("lowVoltageThreshold")) / 2
+        if settings.get("enableSunriseSunset"): # TODO
+            wittyPi.set_start_end_time_sunrise(settings.get("latitude"), settings.get("longitude"))
+        else:
+            wittyPi.set_start_time(time(settings.get("startTimeHour"), settings.get("startTimeMinute")))
+            wittyPi.set_end_time(time(settings.get("endTimeHour"), settings.get("endTimeMinute")))
+    except Exception as e:
+        logging.warning("Could not set schedule: %s", str(e))
 
-    # Battery voltage between 50% and 25%
-    if battery_voltage_quarter < battery_voltage < battery_voltage_half:
-        wittyPi.double_interval_length()
-        logging.warning("Battery voltage <50%.")
-    elif battery_voltage <= battery_voltage_quarter: # Battery voltage <=25%
-        wittyPi.single_startup_interval()
-        logging.warning("Battery voltage <=25%.")
+    try: # Get battery voltage and adjust schedule
+        battery_voltage = wittyPi.get_battery_voltage()
+        data.add('battery_voltage', battery_voltage)
 
-except Exception as e:
-    logging.warning("Could not get battery voltage: %s", str(e))
+        battery_voltage_half = settings.get("batteryVoltageHalf")
+        battery_voltage_quarter = (battery_voltage_half + settings.get("lowVoltageThreshold")) / 2
 
-try:
-    wittyPi.generate_schedule()
-except Exception as e:
-    logging.warning("Failed to generate schedule: %s", str(e))
+        # Battery voltage between 50% and 25%
+        if battery_voltage_quarter < battery_voltage < battery_voltage_half:
+            wittyPi.double_interval_length()
+            logging.warning("Battery voltage <50%.")
+        elif battery_voltage <= battery_voltage_quarter: # Battery voltage <=25%
+            wittyPi.single_startup_interval()
+            logging.warning("Battery voltage <=25%.")
 
-###########################
-# Apply schedule
-###########################
-try:
-    next_startup_time = wittyPi.apply_schedule()
-    data.add('next_startup_time', f"{next_startup_time}Z")
-except Exception as e:
-    logging.critical("Could not apply schedule: %s", str(e))
+    except Exception as e:
+        logging.warning("Could not get battery voltage: %s", str(e))
 
-    try: # Try to set default schedule
-        logging.critical("Trying again with default schedule.")
-        wittyPi.set_interval_length(30, 0)
-        wittyPi.set_start_time(time(8, 0))
-        wittyPi.set_end_time(time(20, 0))
+    try:
         wittyPi.generate_schedule()
+    except Exception as e:
+        logging.warning("Failed to generate schedule: %s", str(e))
+
+    ###########################
+    # Apply schedule
+    ###########################
+    try:
         next_startup_time = wittyPi.apply_schedule()
         data.add('next_startup_time', f"{next_startup_time}Z")
     except Exception as e:
-        logging.critical("Could not set default schedule: %s", str(e))
+        logging.critical("Could not apply schedule: %s", str(e))
+
+        try: # Try to set default schedule
+            logging.critical("Trying again with default schedule.")
+            wittyPi.set_interval_length(30, 0)
+            wittyPi.set_start_time(time(8, 0))
+            wittyPi.set_end_time(time(20, 0))
+            wittyPi.generate_schedule()
+            next_startup_time = wittyPi.apply_schedule()
+            data.add('next_startup_time', f"{next_startup_time}Z")
+        except Exception as e:
+            logging.critical("Could not set default schedule: %s", str(e))
 
 ##########################
 # SIM7600G-H 4G module
 ###########################
-try:
-    from sim7600x import SIM7600X
-    sim7600 = SIM7600X()
-except Exception as e:
-    logging.warning("Could not open serial connection with 4G module: %s", str(e))
+def setup_modem():
+    '''Open the serial connection with the 4G module and set it to 4G only.'''
+    global sim7600
+    try:
+        from sim7600x import SIM7600X
+        sim7600 = SIM7600X()
+    except Exception as e:
+        logging.warning("Could not open serial connection with 4G module: %s", str(e))
 
-# Set to 4G only
-try:
-    sim7600.send_at_command("at+cnmp=38")
-    data.add('network_mode', sim7600.send_at_command("at+cnmp?"))
-except Exception as e:
-    logging.warning("Could not set network mode: %s", str(e))
+    # Set to 4G only
+    try:
+        sim7600.send_at_command("at+cnmp=38")
+        data.add('network_mode', sim7600.send_at_command("at+cnmp?"))
+    except Exception as e:
+        logging.warning("Could not set network mode: %s", str(e))
 
-# Enable GPS to read out position later
-try:
-    if settings.get("enableGPS"):
-        sim7600.start_gps_session()
-except Exception as e:
-    logging.warning("Could not start GPS: %s", str(e))
+def start_gps():
+    '''Enable GPS to read out position later.'''
+    try:
+        if settings.get("enableGPS"):
+            sim7600.start_gps_session()
+    except Exception as e:
+        logging.warning("Could not start GPS: %s", str(e))
 
 ###########################
-# Setup camera
+# Setup camera(s)
 ###########################
-try:
-    camera = Picamera2()
-    cameraConfig = camera.create_still_configuration() # Selects highest resolution by default
-
+def get_resolution(camera_index: int) -> tuple:
+    '''Get the resolution of a camera from the settings or None for the highest resolution.'''
     # https://datasheets.raspberrypi.com/camera/picamera2-manual.pdf
     # Table 6. Stream- specific configuration parameters
     MIN_RESOLUTION = 64
     MAX_RESOLUTION = (4608, 2592)
-    resolution = settings.get("resolution")
+    resolution = camera_settings.get("resolution")
+
+    # Separate resolution for each camera, e.g. [[1920, 1080], [0, 0]]
+    if resolution and isinstance(resolution[0], list):
+        resolution = resolution[camera_index] if camera_index < len(resolution) else [0, 0]
 
     if MIN_RESOLUTION < resolution[0] < MAX_RESOLUTION[0] and MIN_RESOLUTION < resolution[1] < MAX_RESOLUTION[1]:
-        size = (resolution[0], resolution[1])
-        cameraConfig = camera.create_still_configuration({"size": size})
+        return (resolution[0], resolution[1])
 
-except Exception as e:
-    logging.critical("Could not setup camera: %s", str(e))
+    return None
+
+def setup_camera(camera_index: int) -> tuple:
+    '''Open and configure a camera.'''
+    try:
+        camera = Picamera2(camera_index)
+        size = get_resolution(camera_index)
+
+        if size:
+            return camera, camera.create_still_configuration({"size": size})
+
+        return camera, camera.create_still_configuration() # Selects highest resolution by default
+
+    except Exception as e:
+        logging.critical("Could not setup camera %s: %s", camera_index, str(e))
+        return None
+
+def setup_cameras():
+    '''Open and configure all attached cameras at the same time.'''
+    global cameras
+    try:
+        camera_indices = range(len(Picamera2.global_camera_info()))
+
+        if not camera_indices:
+            logging.critical("No camera found.")
+
+        with ThreadPoolExecutor(max_workers=max(len(camera_indices), 1)) as executor:
+            cameras = {index: camera for index, camera in zip(camera_indices, executor.map(setup_camera, camera_indices)) if camera}
+
+    except Exception as e:
+        logging.critical("Could not setup cameras: %s", str(e))
 
 ###########################
-# Capture image
+# Capture image(s)
 ###########################
-try:
-    image_filename = f'{TIMESTAMP_FILENAME}_{settings.get("cameraName")}.jpg'
-    camera.start_and_capture_file(FILE_PATH + image_filename, capture_mode=cameraConfig, delay=2, show_preview=False)
-except Exception as e:
-    logging.critical("Could not start camera and capture image: %s", str(e))
+def capture_with_camera(camera_index: int) -> str:
+    '''Capture an image with a camera and stop it. Returns the image filename or None if the capture failed.'''
+    camera, camera_config = cameras[camera_index]
+    filename = f'{CAPTURE_TIMESTAMP}_{camera_settings.get("cameraName")}_{camera_index}.jpg'
 
-try:
-    camera.stop()
-except Exception as e:
-    logging.warning("Could not stop camera: %s", str(e))
+    try:
+        if camera_settings.get("streamUpload"): # Keep the image in memory and upload it directly
+            image_data = BytesIO()
+            camera.start(camera_config)
+            sleep(2)
+            camera.capture_file(image_data, format="jpeg")
+            image_buffers[filename] = image_data
+        else:
+            camera.start_and_capture_file(FILE_PATH + filename, capture_mode=camera_config, delay=2, show_preview=False)
+    except Exception as e:
+        logging.critical("Could not start camera %s and capture image: %s", camera_index, str(e))
+        filename = None
+
+    try:
+        camera.stop()
+    except Exception as e:
+        logging.warning("Could not stop camera %s: %s", camera_index, str(e))
+
+    return filename
+
+def capture_images():
+    '''Capture an image with all cameras at the same time.'''
+    global image_filenames, CAPTURE_TIMESTAMP
+    try:
+        # The clock may not be synchronized yet, the images are renamed with the timestamp of the wake cycle afterwards
+        CAPTURE_TIMESTAMP = datetime.today().strftime('%Y%m%d_%H%MZ') # UTC-Time
+
+        with ThreadPoolExecutor(max_workers=max(len(cameras), 1)) as executor:
+            image_filenames = [filename for filename in executor.map(capture_with_camera, cameras) if filename]
+    except Exception as e:
+        logging.critical("Could not capture images: %s", str(e))
+
+def rename_images():
+    '''Rename the images with the timestamp of the wake cycle, which is taken after the time synchronization.'''
+    global image_filenames
+    try:
+        if TIMESTAMP_FILENAME == CAPTURE_TIMESTAMP:
+            return
+
+        renamed_filenames = []
+        for filename in image_filenames:
+            new_filename = filename.replace(CAPTURE_TIMESTAMP, TIMESTAMP_FILENAME, 1)
+            try:
+                if filename in image_buffers:
+                    image_buffers[new_filename] = image_buffers.pop(filename)
+                else:
+                    replace(f"{FILE_PATH}{filename}", f"{FILE_PATH}{new_filename}")
+                renamed_filenames.append(new_filename)
+            except Exception as e:
+                logging.warning("Could not rename image %s: %s", filename, str(e))
+                renamed_filenames.append(filename)
+
+        image_filenames = renamed_filenames
+    except Exception as e:
+        logging.warning("Could not rename images: %s", str(e))
+
+###########################
+# Outbox
+###########################
+def load_outbox():
+    '''Load the outbox and add the images of previous wake cycles.'''
+    global outbox
+    try:
+        from outbox import Outbox
+        outbox = Outbox(f"{FILE_PATH}outbox.yaml")
+        outbox.scan(FILE_PATH)
+    except Exception as e:
+        logging.warning("Could not load outbox: %s", str(e))
+
+###########################
+# Create preview(s)
+###########################
+def create_thumbnails():
+    '''Create a small preview of each image, which is uploaded before the full images.'''
+    try:
+        if settings.get("uploadThumbnails") and CONNECTED_TO_SERVER:
+            from encoding_policy import EncodingPolicy
+
+            for filename in image_filenames:
+                thumbnail_buffers[filename] = EncodingPolicy.create_thumbnail(image_buffers.get(filename, f"{FILE_PATH}{filename}"))
+    except Exception as e:
+        logging.warning("Could not create preview image: %s", str(e))
+
+###########################
+# Encode image for upload
+###########################
+def encode_images():
+    '''Re-encode the images depending on the link quality and the backlog. The original images stay on the SD card.'''
+    try:
+        if settings.get("adaptiveEncoding") and CONNECTED_TO_SERVER:
+            from encoding_policy import EncodingPolicy
+            policy = EncodingPolicy(signal_quality, outbox.throughput, outbox.size(), IMAGE_UPLOAD_COST)
+
+            levels = {}
+            for filename in image_filenames:
+                try:
+                    if filename in image_buffers:
+                        level, image_buffers[filename] = policy.encode_bytes(filename, image_buffers[filename], FILE_PATH)
+                    else:
+                        level = policy.encode(filename, FILE_PATH)
+                    levels[filename] = {'quality': level['quality'], 'scale': level['scale']}
+                except Exception as e:
+                    logging.warning("Could not encode image %s: %s", filename, str(e))
+
+            if levels: # The level of the first camera and the levels of all cameras
+                level = next(iter(levels.values()))
+                data.add('image_quality', level['quality'])
+                data.add('image_scale', level['scale'])
+                data.add('image_levels', levels)
+    except Exception as e:
+        logging.warning("Could not encode image: %s", str(e))
 
 ###########################
 # Upload image(s) to file server
 ###########################
-try:
-    if CONNECTED_TO_SERVER:
-        for file in listdir(FILE_PATH): # Upload all images
-            if file.endswith(".jpg"):
-                fileserver.upload_file(file, FILE_PATH, delete_after_upload=True)
-except Exception as e:
-    logging.critical("Could not upload image to fileserver: %s", str(e))
+def upload_from_outbox(filename: str) -> None:
+    '''Upload a file from the outbox and update the outbox.'''
+    num_bytes = outbox.files[filename]['size']
+    start = monotonic()
+
+    if fileserver.upload_file(filename, FILE_PATH, delete_after_upload=True):
+        outbox.record_throughput(num_bytes, monotonic() - start)
+        outbox.mark_uploaded(filename)
+    else:
+        outbox.mark_failed(filename)
+
+def save_image_buffer(filename: str) -> None:
+    '''Write an image which is kept in memory to the SD card, so it is uploaded during the next wake cycle.'''
+    from outbox import Outbox
+    with open(f"{FILE_PATH}{filename}", 'wb') as image_file:
+        image_file.write(image_buffers[filename].getbuffer())
+    image_buffers.pop(filename)
+
+    if "outbox" in globals(): # The outbox also finds the file during the next wake cycle otherwise
+        outbox.add(filename, FILE_PATH, Outbox.HIGH)
+        if CONNECTED_TO_SERVER:
+            outbox.mark_failed(filename)
+
+def upload_from_memory(filename: str) -> None:
+    '''Upload an image from memory. The image is only written to the SD card if the upload fails or the local archive is enabled.'''
+    image_data = image_buffers[filename]
+    uploaded = False
+
+    try:
+        num_bytes = image_data.getbuffer().nbytes
+        start = monotonic()
+        uploaded = CONNECTED_TO_SERVER and fileserver.upload_file_from_bytes(filename, image_data)
+
+        if uploaded:
+            image_buffers.pop(filename)
+            outbox.record_throughput(num_bytes, monotonic() - start)
+
+            if settings.get("localArchive"):
+                makedirs(f"{FILE_PATH}archive/", exist_ok=True)
+                with open(f"{FILE_PATH}archive/{filename}", 'wb') as image_file:
+                    image_file.write(image_data.getbuffer())
+    finally:
+        if not uploaded: # Upload during the next wake cycle
+            save_image_buffer(filename)
+
+def upload_thumbnails():
+    '''Upload the previews of this wake cycle, so they are available even if the full images are not uploaded.'''
+    try:
+        if thumbnail_buffers and CONNECTED_TO_SERVER:
+            fileserver.create_directory(THUMBNAIL_DIRECTORY)
+
+            for filename, thumbnail_data in thumbnail_buffers.items():
+                fileserver.upload_file_from_bytes(f"{THUMBNAIL_DIRECTORY}/{filename}", thumbnail_data)
+    except Exception as e:
+        logging.warning("Could not upload preview image: %s", str(e))
+
+def upload_images():
+    '''Add the images of this wake cycle to the outbox and upload them to the file server.'''
+    upload_thumbnails()
+
+    from outbox import Outbox
+    for filename in image_filenames:
+        try:
+            if filename in image_buffers:
+                upload_from_memory(filename)
+                continue
+
+            outbox.add(filename, FILE_PATH, Outbox.HIGH)
+
+            if CONNECTED_TO_SERVER:
+                upload_from_outbox(filename)
+        except Exception as e:
+            logging.critical("Could not upload image %s to fileserver: %s", filename, str(e))
+
+    try:
+        outbox.save()
+    except Exception as e:
+        logging.warning("Could not save outbox: %s", str(e))
+
+def upload_backlog():
+    '''Upload the images of previous wake cycles (newest first) until the upload budget runs out.'''
+    try:
+        if CONNECTED_TO_SERVER:
+            end_time = monotonic() + settings.get("uploadBudgetSeconds")
+            files = outbox.pending(settings.get("uploadBudgetMegabytes") * 1024 * 1024)
+
+            def within_budget() -> bool:
+                return monotonic() <= end_time and runner.remaining() >= IMAGE_UPLOAD_COST + LOG_UPLOAD_COST
+
+            if files:
+                result = fileserver.upload_files(files, FILE_PATH, True, settings.get("uploadSessions"), within_budget)
+
+                for file in result['uploaded']:
+                    outbox.mark_uploaded(file)
+                for file in result['errors']:
+                    outbox.mark_failed(file)
+
+                if len(result['uploaded']) + len(result['errors']) < len(files):
+                    logging.warning("Upload budget exhausted. Remaining images are uploaded during the next wake cycle.")
+
+                # The throughput of a single session is used to choose the encoding of the next image
+                outbox.record_throughput(result['bytes'], result['transfer_seconds'])
+                data.add('backlog_upload', {'files': len(result['uploaded']), 'errors': len(result['errors']), 'sessions': result['sessions'],
+                                            'throughput': round(result['throughput']), 'session_throughput': round(result['session_throughput'])})
+    except Exception as e:
+        logging.critical("Could not upload image to fileserver: %s", str(e))
+
+    try:
+        outbox.save()
+    except Exception as e:
+        logging.warning("Could not save outbox: %s", str(e))
 
 ###########################
 # Set voltage thresholds
 ###########################
-try:
-    if settings.get("overwriteVoltageThresholds"):
-        wittyPi.set_low_voltage_threshold(settings.get("lowVoltageThreshold"))
-        wittyPi.set_recovery_voltage_threshold(settings.get("recoveryVoltageThreshold"))
-except Exception as e:
-    logging.warning("Could not set voltage thresholds: %s", str(e))
+def set_voltage_thresholds():
+    '''Overwrite the voltage thresholds of the Witty Pi 4 if enabled and the settings changed since they were last written.'''
+    try:
+        if settings.get("overwriteVoltageThresholds"):
+            APPLIED_SETTINGS_FILE = f"{FILE_PATH}applied_settings.txt" # Hash of the settings last written to the Witty Pi 4
+            settings_hash = settings.get_hash()
+
+            if not SETTINGS_CHANGED and path.exists(APPLIED_SETTINGS_FILE):
+                with open(APPLIED_SETTINGS_FILE, 'r', encoding='utf-8') as f:
+                    if f.read() == settings_hash:
+                        logging.info("Settings did not change. Voltage thresholds are already set.")
+                        return
+
+            low_voltage_threshold_set = wittyPi.set_low_voltage_threshold(settings.get("lowVoltageThreshold"))
+            recovery_voltage_threshold_set = wittyPi.set_recovery_voltage_threshold(settings.get("recoveryVoltageThreshold"))
+
+            if low_voltage_threshold_set and recovery_voltage_threshold_set:
+                with open(APPLIED_SETTINGS_FILE, 'w', encoding='utf-8') as f:
+                    f.write(settings_hash)
+    except Exception as e:
+        logging.warning("Could not set voltage thresholds: %s", str(e))
 
 ###########################
 # Get readings
 ###########################
-try:
-    data.add('temperature', wittyPi.get_temperature())
-    data.add('signal_quality', sim7600.get_signal_quality())
-except Exception as e:
-    logging.warning("Could not get readings: %s", str(e))
+def get_witty_pi_readings():
+    '''Get the readings of the Witty Pi 4.'''
+    try:
+        data.add('temperature', wittyPi.get_temperature())
+    except Exception as e:
+        logging.warning("Could not get readings: %s", str(e))
+
+def get_modem_readings():
+    '''Get the readings of the 4G module.'''
+    global signal_quality
+    try:
+        signal_quality = sim7600.get_signal_quality()
+        data.add('signal_quality', signal_quality)
+    except Exception as e:
+        logging.warning("Could not get readings: %s", str(e))
 
 ###########################
 # Get GPS position
 ###########################
-try:
-    if settings.get("enableGPS"):
-        latitude, longitude, height, _ = sim7600.get_gps_position()
-        sim7600.stop_gps_session()
-        data.add('latitude', latitude)
-        data.add('longitude', longitude)
-        data.add('height', height)
-except Exception as e:
-    logging.warning("Could not get GPS coordinates: %s", str(e))
+def get_gps_position():
+    '''Get the GPS position, retrying only as long as the time budget allows.'''
+    try:
+        if settings.get("enableGPS"):
+            max_attempts = int(min(GPS_MAX_ATTEMPTS, runner.remaining() // GPS_ATTEMPT_COST))
+            latitude, longitude, height, _ = sim7600.get_gps_position(max_attempts=max(max_attempts, 1))
+            data.add('latitude', latitude)
+            data.add('longitude', longitude)
+            data.add('height', height)
+    except Exception as e:
+        logging.warning("Could not get GPS coordinates: %s", str(e))
 
-try:
-    sim7600.close()
-except Exception as e:
-    logging.warning("Could not close serial connection with 4G module: %s", str(e))
+def close_modem():
+    '''Stop the GPS session and close the serial connection with the 4G module.'''
+    try:
+        if settings.get("enableGPS"):
+            sim7600.stop_gps_session()
+    except Exception as e:
+        logging.warning("Could not stop GPS: %s", str(e))
+
+    try:
+        sim7600.close()
+    except Exception as e:
+        logging.warning("Could not close serial connection with 4G module: %s", str(e))
 
 ###########################
-# Uploading sensor data
+# Sensor sampling
 ###########################
+def start_sampler():
+    '''Read the sensors continuously in the background while the camera is awake if enabled.'''
+    global sampler
+    try:
+        if settings.get("sensorSampling"):
+            from sampler import Sampler
+            sampler = Sampler(settings.get("sampleInterval"), wittyPi.MAX_DURATION_MINUTES * 60)
+            sampler.add_channel('battery_voltage', wittyPi.get_battery_voltage)
+            sampler.add_channel('internal_current', wittyPi.get_internal_current)
+            sampler.add_channel('temperature', wittyPi.get_temperature)
 
-try: # Append new measurements to log or create new log file if none exists
-    DIAGNOSTICS_FILENAME = "diagnostics.yaml"
-    diagnostics_filepath = f"{FILE_PATH}{DIAGNOSTICS_FILENAME}"
+            if "sim7600" in globals():
+                def read_signal_quality():
+                    with sim7600.lock: # The 4G module is closed before the sampling stops
+                        value = sim7600.get_signal_quality() if sim7600.is_open() else None
+                    return None if value == 99 else value # 99 if not known or the reading failed
 
-    # Check if is connected to file server
-    if CONNECTED_TO_SERVER:
-        data.load_diagnostics()
-        fileserver.append_file_from_bytes(DIAGNOSTICS_FILENAME, data.get_data_as_bytes())
-    else:
-        # Append new measurement to local YAML file
-        data.append_diagnostics_to_file()
-except Exception as e:
-    logging.warning("Could not append new measurements to log: %s", str(e))
+                # Reading the signal quality takes about a second
+                sampler.add_channel('signal_quality', read_signal_quality, every=max(int(SIGNAL_QUALITY_INTERVAL / sampler.interval), 1))
+
+            sampler.start()
+    except Exception as e:
+        logging.warning("Could not start sensor sampling: %s", str(e))
+
+def stop_sampler():
+    '''Stop the sensor sampling, add the summary to the diagnostics and append the samples to samples.bin.'''
+    try:
+        if sampler is not None:
+            sampler.stop()
+            data.add('sensor_samples', sampler.summary())
+
+            # Kept on the SD card until they were uploaded
+            with open(f"{FILE_PATH}samples.bin", 'ab') as samples_file:
+                samples_file.write(sampler.to_bytes())
+
+            if CONNECTED_TO_SERVER:
+                fileserver.append_file("samples.bin", FILE_PATH, delete_after_upload=True)
+    except Exception as e:
+        logging.warning("Could not save sensor samples: %s", str(e))
 
 ###########################
 # Upload log data
 ###########################
-try:
-    if CONNECTED_TO_SERVER:
-        fileserver.append_file("log.txt", FILE_PATH, delete_after_upload=True)
+def stop_at_deadline(filename: str, sent_bytes: int, total_bytes: int) -> None:
+    '''Stop an optional transfer when the deadline is reached (the logs are kept and appended during the next wake cycle).'''
+    if runner.remaining() <= 0:
+        from fileserver import TransferAborted
+        raise TransferAborted(f"Deadline reached after {sent_bytes} of {total_bytes} bytes of {filename}")
+
+def upload_logs():
+    '''Upload the log file to the file server.'''
+    try:
+        if CONNECTED_TO_SERVER:
+            fileserver.progress = stop_at_deadline
+            try:
+                fileserver.append_file("log.txt", FILE_PATH, delete_after_upload=True, compress=settings.get("compressLogs"))
+            finally:
+                fileserver.progress = None
+    except Exception as e:
+        logging.warning("Could not upload diagnostics data: %s", str(e))
+
+def upload_extended_logs():
+    '''Upload the Witty Pi 4 log files to the file server if enabled.'''
+    try:
+        if settings.get("uploadExtendedDiagnostics") and CONNECTED_TO_SERVER:
+            fileserver.progress = stop_at_deadline
+            try:
+                fileserver.append_file("wittyPi.log", f"{FILE_PATH}wittypi/", delete_after_upload=True, compress=settings.get("compressLogs"))
+                fileserver.append_file("schedule.log", f"{FILE_PATH}wittypi/", delete_after_upload=True, compress=settings.get("compressLogs"))
+            finally:
+                fileserver.progress = None
+    except Exception as e:
+        logging.warning("Could not upload diagnostics data: %s", str(e))
 
-    if settings.get("uploadExtendedDiagnostics") and CONNECTED_TO_SERVER:
-        fileserver.append_file("wittyPi.log", f"{FILE_PATH}wittypi/", delete_after_upload=True)
-        fileserver.append_file("schedule.log", f"{FILE_PATH}wittypi/", delete_after_upload=True)
-except Exception as e:
-    logging.warning("Could not upload diagnostics data: %s", str(e))
+###########################
+# Uploading sensor data
+###########################
+def upload_diagnostics():
+    '''Append new measurements to log or create new log file if none exists.'''
+    try: # Duration of each stage in seconds
+        data.add('timings', {'config': CONFIG_DURATION, **runner.timings})
+
+        if runner.skipped:
+            data.add('skipped_stages', runner.skipped)
+    except Exception as e:
+        logging.warning("Could not add stage timings: %s", str(e))
+
+    try: # Outcome and duration of the connection to the file server
+        data.add('connect_outcome', fileserver.connect_outcome)
+        data.add('connect_latency', fileserver.connect_latency)
+        data.add('connect_attempts', fileserver.connect_attempts)
+    except Exception as e:
+        logging.warning("Could not add connection outcome: %s", str(e))
+
+    try: # Bytes sent to the file server during this wake cycle, the performance of the transfers and the compression of the logs
+        data.add('uploaded_bytes', fileserver.bytes_sent)
+        data.add('transfers', fileserver.get_transfer_summary())
+        if fileserver.compression['raw_bytes'] > 0:
+            data.add('compression', {'raw_bytes': fileserver.compression['raw_bytes'], 'compressed_bytes': fileserver.compression['compressed_bytes'],
+                                     'seconds': round(fileserver.compression['seconds'], 3)})
+    except Exception as e:
+        logging.warning("Could not add uploaded bytes: %s", str(e))
+
+    try: # Images waiting to be uploaded
+        data.add('outbox_files', len(outbox.files))
+        data.add('outbox_bytes', outbox.size())
+    except Exception as e:
+        logging.warning("Could not add outbox size: %s", str(e))
+
+    try:
+        # The diagnostics are kept in the local JSON Lines file until they were uploaded
+        # Old records are downsampled, so the local file stays bounded while the camera is offline
+        data.append_diagnostics_to_file()
+        data.downsample_local_diagnostics()
+    except Exception as e:
+        logging.warning("Could not save new measurements: %s", str(e))
+
+    try:
+        DIAGNOSTICS_FILENAME = "diagnostics.jsonl"
+
+        # Check if is connected to file server
+        # The newest records are uploaded first, a large backlog is uploaded in chunks during the next wake cycles
+        if CONNECTED_TO_SERVER:
+            chunk_bytes = DIAGNOSTICS_CHUNK_BYTES
+            throughput = outbox.throughput if "outbox" in globals() else None
+            if throughput:
+                chunk_bytes = int(min(max(throughput * DIAGNOSTICS_UPLOAD_SECONDS, DIAGNOSTICS_MIN_CHUNK_BYTES), DIAGNOSTICS_CHUNK_BYTES))
+
+            chunk = data.get_local_chunk(chunk_bytes)
+            if fileserver.append_file_from_bytes(DIAGNOSTICS_FILENAME, chunk, compress=settings.get("compressLogs")):
+                data.remove_local_chunk(chunk)
+    except Exception as e:
+        logging.warning("Could not append new measurements to log: %s", str(e))
 
 ###########################
 # Quit file server session
 ###########################
+def quit_fileserver():
+    '''Close the file server session.'''
+    try:
+        if CONNECTED_TO_SERVER:
+            fileserver.quit()
+    except Exception as e:
+        logging.warning("Could not close file server session: %s", str(e))
+
+###########################
+# Run wake cycle
+###########################
+# Expected duration of the optional stages in seconds
+IMAGE_UPLOAD_COST = 15
+LOG_UPLOAD_COST = 5
+EXTENDED_LOG_UPLOAD_COST = 10
+GPS_MAX_ATTEMPTS = 7
+GPS_ATTEMPT_COST = 6 # AT command and delay between attempts
+CONNECT_TIMEOUT = 45 # Maximum time to connect to the file server before continuing offline
+SHUTDOWN_RESERVE = 20 # Time reserved for the diagnostics and the shutdown
+DIAGNOSTICS_CHUNK_BYTES = 256 * 1024 # Maximum size of the diagnostics uploaded in a wake cycle (before the compression)
+DIAGNOSTICS_MIN_CHUNK_BYTES = 16 * 1024
+DIAGNOSTICS_UPLOAD_SECONDS = 5 # Time for the upload of the diagnostics at the average throughput
+SIGNAL_QUALITY_INTERVAL = 5 # Time between two signal quality readings of the sensor sampling in seconds
+
+try: # Time (of time.monotonic) when the optional stages have to be finished, before the Witty Pi 4 cuts the power
+    from witty_pi_4 import WittyPi4
+    DEADLINE = monotonic() + WittyPi4().get_remaining_on_time() - SHUTDOWN_RESERVE
+except Exception as e:
+    DEADLINE = None
+    logging.warning("Could not get deadline: %s", str(e))
+
+# Independent stages run at the same time, e.g. the camera is set up while connecting to the file server
+# and the Witty Pi 4 is read while the 4G module is set up
+# The images are captured while connecting to the file server and renamed with the timestamp of the wake cycle,
+# which is taken after the time synchronization
+# The file server, the Witty Pi 4 and the 4G module can only be used by one stage at a time
+# The logs are uploaded before the diagnostics, so the diagnostics contain the timings of all upload stages
+# The sensors are sampled in the background from the time synchronization until the diagnostics
+# Optional stages are skipped if there is not enough time left until the power is cut
 try:
-    if CONNECTED_TO_SERVER:
-        fileserver.quit()
+    from stage_runner import StageRunner
+    runner = StageRunner(DEADLINE)
+    runner.add("local_settings", read_local_settings)
+    runner.add("witty_pi", setup_witty_pi, after=["local_settings"])
+    runner.add("connect", connect_to_fileserver)
+    runner.add("modem", setup_modem)
+    runner.add("camera", setup_cameras, after=["local_settings"])
+    runner.add("settings", update_settings, after=["connect", "local_settings"])
+    runner.add("time_sync", synchronize_time, after=["settings", "witty_pi"])
+    runner.add("timestamp", get_timestamp, after=["time_sync"])
+    runner.add("capture", capture_images, after=["camera"])
+    runner.add("rename", rename_images, after=["capture", "timestamp"])
+    runner.add("schedule", generate_and_apply_schedule, after=["time_sync", "timestamp"])
+    runner.add("modem_readings", get_modem_readings, after=["modem"], priority=StageRunner.OPTIONAL, cost=1)
+    runner.add("gps_start", start_gps, after=["modem_readings", "settings"])
+    runner.add("outbox", load_outbox, after=["rename"])
+    runner.add("thumbnail", create_thumbnails, after=["rename", "settings"])
+    runner.add("encode", encode_images, after=["outbox", "thumbnail", "modem_readings"])
+    runner.add("upload", upload_images, after=["encode"])
+    runner.add("backlog", upload_backlog, after=["upload"], priority=StageRunner.OPTIONAL, cost=IMAGE_UPLOAD_COST)
+    runner.add("thresholds", set_voltage_thresholds, after=["schedule"], priority=StageRunner.OPTIONAL, cost=2)
+    runner.add("witty_pi_readings", get_witty_pi_readings, after=["witty_pi"], priority=StageRunner.OPTIONAL, cost=1)
+    runner.add("gps", get_gps_position, after=["gps_start"], priority=StageRunner.OPTIONAL, cost=GPS_ATTEMPT_COST)
+    runner.add("modem_close", close_modem, after=["gps"])
+    runner.add("logs", upload_logs, after=["backlog", "witty_pi_readings", "modem_close"], priority=StageRunner.OPTIONAL, cost=LOG_UPLOAD_COST)
+    runner.add("extended_logs", upload_extended_logs, after=["logs"], priority=StageRunner.OPTIONAL, cost=EXTENDED_LOG_UPLOAD_COST)
+    runner.add("sampler_start", start_sampler, after=["time_sync", "modem"])
+    runner.add("sampler_stop", stop_sampler, after=["sampler_start", "extended_logs"])
+    runner.add("diagnostics", upload_diagnostics, after=["sampler_stop"])
+    runner.add("quit", quit_fileserver, after=["diagnostics"])
+    runner.run()
 except Exception as e:
-    logging.warning("Could not close file server session: %s", str(e))
+    logging.critical("Could not run wake cycle: %s", str(e))
+
+# Images which are still in memory (e.g. if the upload stage did not run) are uploaded during the next wake cycle
+if image_buffers:
+    for filename in list(image_buffers):
+        try:
+            save_image_buffer(filename)
+        except Exception as e:
+            logging.critical("Could not save image %s: %s", filename, str(e))
+
+    try:
+        outbox.save()
+    except Exception as e:
+        logging.warning("Could not save outbox: %s", str(e))
 
 ###########################
 # Shutdown Raspberry Pi if enabled
@@ -0,0 +1,100 @@
+'''Persistent index of the files waiting to be uploaded to the file server.'''
+from os import path, listdir
+import logging
+from yaml import safe_load, safe_dump
+
+class Outbox:
+    '''A class to keep track of the files waiting to be uploaded, so the most important files are uploaded first.'''
+
+    # Priorities (lower values are uploaded first)
+    HIGH = 0
+    NORMAL = 1
+
+    MAX_ATTEMPTS = 3 # Files which failed more often are uploaded last
+    THROUGHPUT_WEIGHT = 0.5 # Weight of the newest measurement in the average throughput
+
+    def __init__(self, index_filepath: str = "outbox.yaml") -> None:
+        '''Load the outbox index from a local file.'''
+        self.index_filepath = index_filepath
+        self.files = {}
+        self.throughput = None # Average upload throughput in bytes/s
+
+        try:
+            if path.exists(self.index_filepath):
+                with open(self.index_filepath, 'r', encoding='utf-8') as yaml_file:
+                    index = safe_load(yaml_file) or {}
+                self.files = index.get('files', {})
+                self.throughput = index.get('throughput')
+        except Exception as e:
+            logging.warning("Could not open outbox index: %s", str(e))
+
+    def add(self, filename: str, local_file_path: str = "", priority: int = NORMAL) -> None:
+        '''Add a file to the outbox or update its size and priority.'''
+        local_path = f"{local_file_path}{filename}"
+        entry = self.files.get(filename, {'priority': priority, 'attempts': 0})
+
+        self.files[filename] = {
+            'path': local_file_path,
+            'size': path.getsize(local_path),
+            'created': path.getmtime(local_path),
+            'priority': min(priority, entry['priority']),
+            'attempts': entry['attempts'],
+        }
+
+    def scan(self, local_file_path: str = "", extension: str = ".jpg") -> None:
+        '''Add new files in a directory and remove files which no longer exist.'''
+        for filename in listdir(local_file_path or "."):
+            if filename.endswith(extension) and filename not in self.files:
+                self.add(filename, local_file_path)
+
+        for filename, entry in list(self.files.items()):
+            if not path.exists(f"{entry['path']}{filename}"):
+                del self.files[filename]
+
+    def pending(self, max_bytes: int = None) -> list:
+        '''Return the files to upload by priority and newest first, limited to max_bytes in total.'''
+        order = sorted(self.files, key=lambda filename: (self.files[filename]['priority'],
+                                                         self.files[filename]['attempts'] >= self.MAX_ATTEMPTS,
+                                                         -self.files[filename]['created']))
+
+        if max_bytes is None:
+            return order
+
+        batch = []
+        total_bytes = 0
+        for filename in order: # Smaller files after a file which does not fit are still uploaded
+            if total_bytes + self.files[filename]['size'] > max_bytes:
+                continue
+            total_bytes += self.files[filename]['size']
+            batch.append(filename)
+
+        return batch
+
+    def mark_uploaded(self, filename: str) -> None:
+        '''Remove an uploaded file from the outbox.'''
+        self.files.pop(filename, None)
+
+    def mark_failed(self, filename: str) -> None:
+        '''Count a failed upload attempt.'''
+        if filename in self.files:
+            self.files[filename]['attempts'] += 1
+
+    def record_throughput(self, num_bytes: int, duration: float) -> None:
+        '''Update the average upload throughput with a successful upload.'''
+        if duration <= 0:
+            return
+
+        throughput = num_bytes / duration
+        if self.throughput is None:
+            self.throughput = throughput
+        else:
+            self.throughput = self.THROUGHPUT_WEIGHT * throughput + (1 - self.THROUGHPUT_WEIGHT) * self.throughput
+
+    def size(self) -> int:
+        '''Return the total size of the files in the outbox in bytes.'''
+        return sum(entry['size'] for entry in self.files.values())
+
+    def save(self) -> None:
+        '''Save the outbox index to a local file.'''
+        with open(self.index_filepath, 'w', encoding='utf-8') as yaml_file:
+            safe_dump({'files': self.files, 'throughput': self.throughput}, yaml_file)
@@ -0,0 +1,159 @@
+'''Sample sensor readings in the background while the camera is awake.'''
+from array import array
+from threading import Thread, Event, current_thread
+from time import monotonic
+import logging
+import math
+import struct
+import sys
+
+class RingBuffer:
+    '''A fixed-size buffer of samples (time and one value per channel) backed by a single float array.
+    If the buffer is full, the oldest samples are overwritten.'''
+
+    def __init__(self, channels: list, capacity: int) -> None:
+        self.channels = list(channels)
+        self.capacity = capacity
+        self.width = len(self.channels) + 1 # Time and channels
+        self.samples = array('f', [math.nan]) * (capacity * self.width)
+        self.next = 0 # Index of the next sample
+        self.count = 0 # Number of samples in the buffer
+
+    def append(self, seconds: float, values: list) -> None:
+        '''Add a sample. Missing values are stored as NaN.'''
+        start = self.next * self.width
+        self.samples[start] = seconds
+        for index, value in enumerate(values, start + 1):
+            self.samples[index] = math.nan if value is None else value
+
+        self.next = (self.next + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def rows(self) -> list:
+        '''Return the samples oldest first as tuples of time and values.'''
+        first = (self.next - self.count) % self.capacity
+        return [tuple(self.samples[((first + row) % self.capacity) * self.width:((first + row) % self.capacity + 1) * self.width])
+                for row in range(self.count)]
+
+    def summary(self) -> dict:
+        '''Return the minimum, maximum and mean of each channel and the number of valid values.'''
+        summary = {}
+        rows = self.rows()
+        for index, channel in enumerate(self.channels, 1):
+            values = [row[index] for row in rows if not math.isnan(row[index])]
+            if values:
+                summary[channel] = {'min': round(min(values), 3), 'max': round(max(values), 3),
+                                    'mean': round(sum(values) / len(values), 3), 'count': len(values)}
+
+        return summary
+
+    MAGIC = b'GCS1' # Version 1 of the block format
+
+    def to_bytes(self) -> bytes:
+        '''Return the samples as a block: magic, length of the channel names, number of samples, channel names (comma separated)
+        and the samples (float32, little endian), oldest first. Blocks can be concatenated.'''
+        names = ",".join(self.channels).encode('utf-8')
+        samples = array('f', [value for row in self.rows() for value in row])
+        if sys.byteorder == 'big':
+            samples.byteswap()
+
+        return self.MAGIC + struct.pack('<HI', len(names), self.count) + names + samples.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> list:
+        '''Read concatenated blocks. Returns the channels and samples (tuples of time and values) of each block.'''
+        blocks = []
+        offset = 0
+        while offset < len(data):
+            if data[offset:offset + 4] != cls.MAGIC:
+                raise ValueError(f"Invalid sample block at byte {offset}")
+
+            names_length, count = struct.unpack_from('<HI', data, offset + 4)
+            offset += 10
+            channels = data[offset:offset + names_length].decode('utf-8').split(",")
+            offset += names_length
+
+            width = len(channels) + 1
+            samples = array('f')
+            samples.frombytes(data[offset:offset + count * width * 4])
+            if sys.byteorder == 'big':
+                samples.byteswap()
+            offset += count * width * 4
+
+            blocks.append({'channels': channels, 'samples': [tuple(samples[row * width:(row + 1) * width]) for row in range(count)]})
+
+        return blocks
+
+class Sampler:
+    '''A class to read sensors at a fixed interval in a background thread into a ring buffer.
+    Readings which take longer than the interval delay the next sample. Info messages of the readings are not logged.'''
+
+    def __init__(self, interval: float = 0.5, max_duration: float = 300) -> None:
+        '''Initialize the sampler with the interval between samples and the maximum duration kept in the buffer in seconds.'''
+        self.interval = interval
+        self.capacity = max(int(max_duration / interval), 1)
+        self.channels = {}
+        self.buffer = None
+        self.thread = None
+        self.stopped = Event()
+        self.start_time = None
+
+    def add_channel(self, name: str, getter, every: int = 1) -> None:
+        '''Add a sensor, which is read with getter every nth sample (e.g. for slow readings). Getter may return None if there is no reading.'''
+        if self.thread is not None:
+            raise RuntimeError("Channels can only be added before the sampler is started")
+
+        self.channels[name] = {'getter': getter, 'every': max(every, 1)}
+
+    def __filter(self, record: logging.LogRecord) -> bool:
+        '''Only log warnings and errors of the sampler thread, as a reading is logged every interval otherwise.'''
+        return record.levelno >= logging.WARNING or record.thread != self.thread.ident
+
+    def __sample(self) -> None:
+        sample = 0
+        while not self.stopped.is_set():
+            sample_start = monotonic()
+            values = []
+            for channel in self.channels.values():
+                value = None
+                if sample % channel['every'] == 0:
+                    try:
+                        value = channel['getter']()
+                    except Exception as e:
+                        logging.warning("Could not read sensor: %s", str(e))
+                values.append(value)
+
+            self.buffer.append(sample_start - self.start_time, values)
+            sample += 1
+            self.stopped.wait(max(self.interval - (monotonic() - sample_start), 0))
+
+    def start(self) -> None:
+        '''Start sampling in the background.'''
+        self.buffer = RingBuffer(list(self.channels), self.capacity)
+        self.start_time = monotonic()
+        self.thread = Thread(target=self.__sample, name="sampler", daemon=True)
+        logging.getLogger().addFilter(self.__filter)
+        self.thread.start()
+
+    def stop(self) -> None:
+        '''Stop sampling and wait for the current sample to finish.'''
+        if self.thread is None or self.stopped.is_set():
+            return
+
+        self.stopped.set()
+        if self.thread is not current_thread():
+            self.thread.join()
+        logging.getLogger().removeFilter(self.__filter)
+
+    def summary(self) -> dict:
+        '''Return the summary of each channel, the number of samples and the duration in seconds.'''
+        rows = self.buffer.rows()
+        return {
+            'samples': len(rows),
+            'seconds': round(rows[-1][0] - rows[0][0], 1) if rows else 0.0,
+            **self.buffer.summary(),
+        }
+
+    def to_bytes(self) -> bytes:
+        '''Return the samples as binary block (see RingBuffer.to_bytes).'''
+        return self.buffer.to_bytes()
@@ -1,5 +1,6 @@
 """Read and validate the GlacierCam settings from a YAML file"""
 from dataclasses import dataclass
+from hashlib import sha256
 import logging
 from yaml import safe_load, dump
 
@@ -28,6 +29,17 @@ class Settings:
         'lowVoltageThreshold': {'type': float, 'min': 0.0, 'max': 30.0, 'default': 0.0},
         'recoveryVoltageThreshold': {'type': float, 'min': 0.0, 'max': 30.0, 'default': 0.0},
         'batteryVoltageHalf' : {'type': float, 'min': 0.0, 'max': 30.0, 'default': 12.0},
+        'uploadThumbnails': {'type': bool, 'default': True},
+        'streamUpload': {'type': bool, 'default': False},
+        'localArchive': {'type': bool, 'default': False},
+        'adaptiveEncoding': {'type': bool, 'default': True},
+        'uploadBudgetMegabytes': {'type': int, 'min': 1, 'max': 10000, 'default': 50},
+        'uploadBudgetSeconds': {'type': int, 'min': 1, 'max': 240, 'default': 60},
+        'uploadSessions': {'type': int, 'min': 1, 'max': 4, 'default': 2},
+        'compressLogs': {'type': bool, 'default': True},
+        'sensorSampling': {'type': bool, 'default': False},
+        'sampleInterval': {'type': float, 'min': 0.1, 'max': 60.0, 'default': 0.5},
+        'wittyPiBackend': {'type': str, 'valid_values': ['shell', 'coprocess', 'i2c'], 'default': 'coprocess'},
         'shutdown': {'type': bool, 'default': True},
     }
 
@@ -76,6 +88,10 @@ class Settings:
 
         return False
 
+    def get_hash(self) -> str:
+        '''Return a hash of the effective settings, e.g. to check if they changed.'''
+        return sha256(dump(self.settings, sort_keys=True).encode('utf-8')).hexdigest()
+
     def is_valid(self) -> bool:
         '''Return if the settings are valid.'''
         return self.valid_settings
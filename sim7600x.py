@@ -1,12 +1,14 @@
 '''Class for the SIM7600X 4G module'''
 from time import sleep
 from datetime import datetime
+from threading import RLock
 import logging
 import serial
 
 class SIM7600X:
     '''Class for the SIM7600X 4G module.'''
     def __init__(self, port: str = '/dev/ttyUSB2', baudrate: int = 115200, timeout: int = 10):
+        self.lock = RLock() # Only one AT command at a time (e.g. while a background sampler reads the signal quality)
         try:
             self.ser = serial.Serial(port, baudrate, timeout=timeout) # USB connection
             self.ser.flushInput()
@@ -16,11 +18,12 @@ class SIM7600X:
     def send_at_command(self, command: str, back: str = 'OK', timeout: int = 1) -> str:
         '''Send an AT command to SIM7600X.'''
         rec_buff = ''
-        self.ser.write((command+'\r\n').encode())
-        sleep(timeout)
-        if self.ser.inWaiting():
-            sleep(0.01)
-            rec_buff = self.ser.read(self.ser.inWaiting())
+        with self.lock:
+            self.ser.write((command+'\r\n').encode())
+            sleep(timeout)
+            if self.ser.inWaiting():
+                sleep(0.01)
+                rec_buff = self.ser.read(self.ser.inWaiting())
         if back not in rec_buff.decode():
             logging.error("Error: AT command %s returned %s", command, rec_buff.decode())
             return ""
@@ -111,10 +114,15 @@ class SIM7600X:
         except Exception as e:
             logging.error("Could not stop GPS session: %s", str(e))
 
+    def is_open(self) -> bool:
+        '''Return if the serial connection is open.'''
+        return self.ser.is_open
+
     def close(self):
         '''Close the serial connection.'''
         try:
-            self.ser.close()
+            with self.lock:
+                self.ser.close()
         except Exception as e:
             logging.error("Could not close serial connection: %s", str(e))
 
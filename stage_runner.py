@@ -0,0 +1,68 @@
+'''Run the stages of a wake cycle concurrently while respecting their dependencies and the time budget.'''
+from concurrent.futures import ThreadPoolExecutor, wait
+from time import monotonic
+import logging
+
+class StageRunner:
+    '''A class to run independent stages at the same time. A stage starts as soon as all stages it depends on have finished.
+    Optional stages are skipped if their expected duration exceeds the remaining time until the deadline.'''
+
+    # Stage priorities
+    CRITICAL = 0 # Always runs
+    OPTIONAL = 1 # Skipped if there is not enough time left
+
+    def __init__(self, deadline: float = None) -> None:
+        '''Initialize the runner with an optional deadline (in seconds of time.monotonic).'''
+        self.deadline = deadline
+        self.stages = {}
+        self.timings = {} # Duration of each stage in seconds
+        self.skipped = [] # Optional stages skipped because of the deadline
+
+    def add(self, name: str, function, after: list = None, priority: int = CRITICAL, cost: float = 0) -> None:
+        '''Add a stage which runs after all stages listed in after have finished. The cost is the expected duration in seconds.'''
+        after = after or []
+
+        for dependency in after:
+            if dependency not in self.stages:
+                raise ValueError(f"Stage {name} depends on unknown stage {dependency}")
+
+        self.stages[name] = {'function': function, 'after': after, 'priority': priority, 'cost': cost}
+
+    def remaining(self) -> float:
+        '''Return the remaining time until the deadline in seconds.'''
+        if self.deadline is None:
+            return float('inf')
+
+        return self.deadline - monotonic()
+
+    def __run_stage(self, name: str, futures: dict) -> None:
+        '''Wait for the dependencies of a stage and run it.'''
+        stage = self.stages[name]
+        wait([futures[dependency] for dependency in stage['after']])
+
+        if stage['priority'] == self.OPTIONAL and self.remaining() < stage['cost']:
+            logging.warning("Skipping stage %s: %.1f s left, %.1f s needed.", name, self.remaining(), stage['cost'])
+            self.skipped.append(name)
+            return
+
+        start = monotonic()
+        try:
+            stage['function']()
+        except Exception as e:
+            logging.error("Stage %s failed: %s", name, str(e))
+        self.timings[name] = round(monotonic() - start, 3)
+
+    def run(self) -> None:
+        '''Run all stages and wait until they have finished.'''
+        if not self.stages:
+            return
+
+        futures = {}
+
+        # Stages are submitted in the order they were added, so all dependencies are already submitted
+        # Every stage gets its own worker, so waiting for dependencies can't block the pool
+        with ThreadPoolExecutor(max_workers=len(self.stages)) as executor:
+            for name in self.stages:
+                futures[name] = executor.submit(self.__run_stage, name, futures)
+
+            wait(futures.values())
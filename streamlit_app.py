@@ -1,6 +1,7 @@
 """Webserver for the Eagleshot GlacierCam - https://github.com/Eagleshot/GlacierCam"""
 from io import BytesIO
 from datetime import datetime
+from threading import Lock
 import hmac
 from PIL import Image
 import streamlit as st
@@ -9,9 +10,10 @@ import altair as alt
 import pytz
 from suntime import Sun
 import requests
-import yaml
 from settings import Settings
 from fileserver import FileServer
+from data import Data, DiagnosticsRecord
+from archive import Archive
 import logging # TODO
 
 timezone = pytz.timezone('Europe/Zurich')
@@ -49,17 +51,21 @@ FTP_HOST = st.secrets["FTP_HOST"]
 FTP_USERNAME = st.secrets["FTP_USERNAME"]
 FTP_PASSWORD = st.secrets["FTP_PASSWORD"]
 
-fileserver = FileServer(FTP_HOST, FTP_USERNAME, FTP_PASSWORD)
+fileserver = FileServer(FTP_HOST, FTP_USERNAME, FTP_PASSWORD, protocol=st.secrets.get("FTP_PROTOCOL", "ftp"))
 fileserver.change_directory(FTP_FOLDER)
 
 # Get the list of files from the FTP server
-fileserver.change_directory("save") # TODO
-files = fileserver.list_files()
-fileserver.change_directory("..") # TODO
+files = fileserver.list_files("save") # TODO
 LOG_FILENAMES = fileserver.list_files() # TODO
 
+# Previews are uploaded before the full images
+THUMBNAIL_DIRECTORY = "thumbs"
+thumbnail_files = []
+if THUMBNAIL_DIRECTORY in LOG_FILENAMES:
+    thumbnail_files = fileserver.list_files(THUMBNAIL_DIRECTORY)
+
 # Only show the image files
-imgFiles = [file for file in files if file.endswith(".jpg")]
+imgFiles = sorted({file for file in files + thumbnail_files if file.endswith(".jpg")})
 
 # Load settings from server
 fileserver.download_file("settings.yaml")
@@ -70,17 +76,76 @@ cameraname = settings.get("cameraName")
 st.title(cameraname, anchor=False)
 img_placeholder = st.empty()
 
-# Download diagnostics file
-fileserver.download_file("diagnostics.yaml")
-
-with open("diagnostics.yaml", 'r', encoding='utf-8') as file:
-    data = yaml.safe_load(file)
-
-# Convert the data into a Pandas DataFrame
-df = pd.DataFrame(data)
-if 'timestamp' in df.columns:
-    df['timestamp'] = pd.to_datetime(df['timestamp'], format='%Y-%m-%d %H:%MZ')
-elif df.empty:
+@st.cache_resource(show_spinner=False)
+def get_diagnostics_cache(host: str, folder: str) -> dict:
+    '''Return the diagnostics of a camera which were already downloaded and the size of the files they were read from.'''
+    return {'sizes': {}, 'df': pd.DataFrame(), 'lock': Lock()}
+
+def apply_schema(df_diagnostics: pd.DataFrame) -> pd.DataFrame:
+    '''Add the missing fields of the diagnostics schema and convert the columns to the types of the fields.'''
+    for field, field_type in DiagnosticsRecord.FIELDS.items():
+        if field not in df_diagnostics.columns:
+            df_diagnostics[field] = None
+
+        if field_type in (int, float):
+            df_diagnostics[field] = pd.to_numeric(df_diagnostics[field], errors='coerce').astype(DiagnosticsRecord.DTYPES[field_type])
+        elif field_type is bool:
+            df_diagnostics[field] = df_diagnostics[field].astype(DiagnosticsRecord.DTYPES[field_type])
+
+    return df_diagnostics
+
+def load_diagnostics(server: FileServer, host: str, folder: str) -> pd.DataFrame:
+    '''Download only the diagnostics appended since the last rerun (uncompressed and compressed part) and add them to the cached DataFrame.'''
+    cache = get_diagnostics_cache(host, folder)
+
+    with cache['lock']:
+        replaced, tables = Data.read_appended_diagnostics(server, cache['sizes'])
+        if replaced: # Read everything again
+            cache['df'] = pd.DataFrame()
+
+        new_frames = [pd.DataFrame(rows, columns=columns) for columns, rows in tables]
+        if new_frames:
+            df_new = apply_schema(pd.concat(new_frames, ignore_index=True))
+            df_new['timestamp'] = pd.to_datetime(df_new['timestamp'], format='%Y-%m-%d %H:%MZ', errors='coerce')
+
+            cache['df'] = pd.concat([cache['df'], df_new], ignore_index=True)
+            if 'timestamp' in cache['df'].columns:
+                cache['df'] = cache['df'].sort_values('timestamp', kind='stable').reset_index(drop=True)
+
+        return cache['df'].copy()
+
+@st.cache_data(show_spinner=False)
+def load_archived_month(_archive: Archive, host: str, folder: str, month: str, facts: dict) -> pd.DataFrame:
+    '''Download a month of the diagnostics archive (cached until the facts of the file change).'''
+    df_month = apply_schema(_archive.read_month(month).to_pandas())
+    df_month['timestamp'] = df_month['timestamp'].astype('datetime64[ns]')
+    return df_month
+
+def load_archived_months(months: list) -> pd.DataFrame:
+    '''Add the archived months which are not loaded yet to the diagnostics.'''
+    df_months = []
+    for month in months:
+        if month in archived_months and month not in loaded_months:
+            try:
+                df_months.append(load_archived_month(archive, FTP_HOST, FTP_FOLDER, month, archived_months[month]))
+                loaded_months.add(month)
+            except Exception as e:
+                logging.warning("Could not read archived diagnostics of %s: %s", month, str(e))
+
+    if not df_months:
+        return df
+
+    return pd.concat(df_months + [df], ignore_index=True).sort_values('timestamp', kind='stable').reset_index(drop=True)
+
+# Download new diagnostics, older diagnostics are read from the monthly archive when the selected period needs them
+df = load_diagnostics(fileserver, FTP_HOST, FTP_FOLDER)
+archive = Archive(fileserver)
+archived_months = archive.months()
+loaded_months = set()
+if df.empty and archived_months: # Everything was archived, show the latest month
+    df = load_archived_months(list(archived_months)[-1:])
+
+if df.empty:
     st.info("No data available at the moment.", icon="📊")
 
 ##############################################
@@ -112,6 +177,7 @@ with st.sidebar:
                 st.error("Das Enddatum muss nach dem Startdatum liegen.")
             else:
                 # Filter the dataframe
+                df = load_archived_months(Archive.months_between(start_dateTime, end_dateTime))
                 df = df[(df['timestamp'] >= start_dateTime)
                         & (df['timestamp'] <= end_dateTime)]
 
@@ -159,22 +225,34 @@ elif len(imgFiles) == 1:
 else:
     img_placeholder.info("No images available at the moment.", icon="📷")
 
-# Get the image file from the FTP server
+def get_original_image(filename: str, server: FileServer = fileserver) -> bytes:
+    '''Get the full image from the FTP server.'''
+    server.change_directory("save") # TODO
+    original_data = server.get_file_as_bytes(filename)
+    server.change_directory("..") # TODO
+    return original_data.getvalue()
+
+# Get the image file from the FTP server (preview if available)
 if len(imgFiles) > 0:
-    fileserver.change_directory("save") # TODO
-    image_data = fileserver.get_file_as_bytes(selected_file)
-    fileserver.change_directory("..") # TODO
+    if selected_file in thumbnail_files:
+        fileserver.change_directory(THUMBNAIL_DIRECTORY)
+        image_data = fileserver.get_file_as_bytes(selected_file)
+        fileserver.change_directory("..")
+    else:
+        image_data = BytesIO(get_original_image(selected_file))
 
     # Display the image with the corresponding timestamp
     img_placeholder.image(Image.open(image_data), use_column_width=True)
 
-    # Download button for image
+    # Download button for image (the full image is only downloaded on click)
     st.download_button(
         label="Bild herunterladen 📷",
-        data=image_data,
+        data=lambda: get_original_image(selected_file),
         file_name=selected_file,
         mime="image/jpeg",
-        use_container_width=True
+        use_container_width=True,
+        disabled=selected_file not in files,
+        help=None if selected_file in files else "Das Originalbild wurde noch nicht hochgeladen."
     )
 
     st.text("")
@@ -185,18 +263,23 @@ if len(imgFiles) > 0:
 if 'selected_file' in locals() or 'selected_file' in globals():
     timestampSelectedImage = datetime.strptime(selected_file[0:13], '%Y%m%d_%H%M')
     df['timestamp'] = df['timestamp'].dt.floor('min')  # Remove seconds from timestamp
-    index = df[df['timestamp'] == timestampSelectedImage].index[0]
+    matching_rows = df[df['timestamp'] == timestampSelectedImage].index
+    index = matching_rows[0] if len(matching_rows) > 0 else -1 # The diagnostics are uploaded after the images
 else:
     index = -1
 
+def has_data(*columns) -> bool:
+    '''Return if there are values for all columns (the fields of the diagnostics schema always exist, but may be empty).'''
+    return all(column in df.columns and df[column].notna().any() for column in columns)
+
 col1, col2, col3, col4 = st.columns(4)
-if 'battery_voltage' in df.columns:
+if has_data('battery_voltage'):
     col1.metric("Batterie", f"{df['battery_voltage'].iloc[index]} V")
-if 'temperature' in df.columns:
+if has_data('temperature'):
     col2.metric("Temperatur", f"{df['temperature'].iloc[index]} °C")
-if 'signal_quality' in df.columns:
+if has_data('signal_quality') and pd.notna(df['signal_quality'].iloc[index]):
     col3.metric("Signalqualität", int(df['signal_quality'].iloc[index]))
-if 'version' in df.columns:
+if has_data('version'):
     col4.metric("Firmware", f"{df['version'].iloc[index]}")
 
 ##############################################
@@ -230,8 +313,8 @@ if 'timestamp' in df.columns:
         next_last_startup_text += "weniger als eine Minute"
 
     # Print next startup relative to now
-    next_startup_time = df['next_startup_time'].iloc[-1]
-    next_startup_time = datetime.strptime(next_startup_time, '%Y-%m-%d %H:%M:%SZ') or datetime(1970, 1, 1, 0, 0)
+    next_startup_times = pd.to_datetime(df['next_startup_time'], format='%Y-%m-%d %H:%M:%SZ', errors='coerce').dropna()
+    next_startup_time = next_startup_times.iloc[-1] if not next_startup_times.empty else datetime(1970, 1, 1, 0, 0)
     next_startup_time = next_startup_time + pd.Timedelta(minutes=1)
 
     # Check if next startup is in the future
@@ -261,7 +344,7 @@ dfMap = pd.DataFrame()
 if settings.get("locationOverwrite"):
     latitude = settings.get("latitude")
     longitude = settings.get("longitude")
-elif 'latitude' in df.columns and 'longitude' in df.columns:
+elif has_data('latitude', 'longitude'):
     # Get the last entry of df latitude that is not null
     last_latitude = df['latitude'].iloc[::-1].dropna().iloc[0]
 
@@ -387,7 +470,7 @@ def plot_chart(chart_title: str, y: str, unit: str = None):
     '''Create an Altair chart.'''
     y_label = f"{chart_title} ({unit})" if unit else chart_title
     subtitle = f"Last measurement: {df[y].iloc[-1]:.2f} {unit}" if unit else f"Last measurement: {df[y].iloc[-1]}"
-    if "timestamp" in df.columns and y in df.columns:
+    if has_data("timestamp", y):
         st.header(chart_title, anchor=False)
         st.write(subtitle)
         chart = alt.Chart(df).mark_line().encode(
@@ -400,6 +483,52 @@ def plot_chart(chart_title: str, y: str, unit: str = None):
 plot_chart("Battery Voltage", 'battery_voltage', "V")
 plot_chart("Temperature", 'temperature', "°C")
 plot_chart("Signal Quality", 'signal_quality')
+
+def plot_stage_timings():
+    '''Create an Altair chart with the duration of each stage of the wake cycle.'''
+    if has_data("timestamp", "timings"):
+        df_timings = df[df['timings'].notnull()]
+        df_timings = pd.concat([df_timings['timestamp'].reset_index(drop=True), pd.json_normalize(df_timings['timings'].tolist())], axis=1)
+        df_timings = df_timings.melt(id_vars="timestamp", var_name="stage", value_name="duration")
+
+        st.header("Stage Durations", anchor=False)
+        chart = alt.Chart(df_timings).mark_line().encode(
+            x=alt.X(f'{"timestamp"}:T', axis=alt.Axis(
+                title="Time", labelAngle=-45)),
+            y=alt.Y('duration:Q', axis=alt.Axis(title="Duration (s)")),
+            color=alt.Color('stage:N', title="Stage"),
+        ).interactive()
+        st.altair_chart(chart, use_container_width=True)
+
+plot_stage_timings()
+
+def plot_transfer_throughput():
+    '''Create Altair charts with the upload throughput depending on the signal quality and the time of day.'''
+    if has_data("timestamp", "transfers", "signal_quality"):
+        df_transfers = df[df['transfers'].notnull()]
+        df_transfers = pd.concat([df_transfers[['timestamp', 'signal_quality']].reset_index(drop=True),
+                                  pd.json_normalize(df_transfers['transfers'].tolist())], axis=1)
+        df_transfers = df_transfers[df_transfers['count'] > 0]
+        df_transfers['throughput'] = df_transfers['throughput'] / 1024 # KB/s
+        df_transfers['hour'] = df_transfers['timestamp'].dt.hour
+
+        st.header("Upload Throughput", anchor=False)
+        col1, col2 = st.columns(2)
+
+        chart = alt.Chart(df_transfers).mark_circle().encode(
+            x=alt.X('signal_quality:Q', axis=alt.Axis(title="Signal Quality")),
+            y=alt.Y('throughput:Q', axis=alt.Axis(title="Throughput (KB/s)")),
+            tooltip=['timestamp:T', 'throughput:Q', 'first_byte_seconds:Q', 'retries:Q'],
+        ).interactive()
+        col1.altair_chart(chart, use_container_width=True)
+
+        chart = alt.Chart(df_transfers).mark_bar().encode(
+            x=alt.X('hour:O', axis=alt.Axis(title="Hour (UTC)")),
+            y=alt.Y('mean(throughput):Q', axis=alt.Axis(title="Mean Throughput (KB/s)")),
+        )
+        col2.altair_chart(chart, use_container_width=True)
+
+plot_transfer_throughput()
 # See: https://www.waveshare.com/w/upload/5/54/SIM7500_SIM7600_Series_AT_Command_Manual_V1.08.pdf
 
 ##############################################
@@ -521,13 +650,9 @@ with st.expander("Fehlermeldungen"):
 
     LOG_FILENAME = "log.txt"
 
-    if LOG_FILENAME in LOG_FILENAMES:
-        fileserver.download_file(LOG_FILENAME)
-
+    if LOG_FILENAME in LOG_FILENAMES or f"{LOG_FILENAME}.gz" in LOG_FILENAMES:
         # Show the log file as st code
-        with open(LOG_FILENAME, 'r', encoding='utf-8') as file:
-            log = file.read()
-
+        log = fileserver.get_file_as_text(LOG_FILENAME)
         st.code(log, language="log", line_numbers=True)
     else:
         st.info("No log data available.", icon="📊")
@@ -565,20 +690,20 @@ with st.expander("Fehlermeldungen"):
 
     LOG_FILENAME = "wittyPi.log"
 
-    if LOG_FILENAME in LOG_FILENAMES:
-
-        # Retrieve the file data
-        fileserver.download_file(LOG_FILENAME)
+    if LOG_FILENAME in LOG_FILENAMES or f"{LOG_FILENAME}.gz" in LOG_FILENAMES:
 
         # Get last modification date
-        last_modified = fileserver.get_file_last_modified_date(LOG_FILENAME)
+        last_modified = fileserver.get_file_last_modified_date(f"{LOG_FILENAME}.gz" if f"{LOG_FILENAME}.gz" in LOG_FILENAMES else LOG_FILENAME)
         last_modified = timezone.localize(last_modified) # Convert date to local timezone
 
-        with open(LOG_FILENAME, encoding='utf-8') as file:
+        # Retrieve the file data (uncompressed and compressed part)
+        log = fileserver.get_file_as_text(LOG_FILENAME)
+
+        if log:
             # Download wittyPiDiagnostics.txt
             st.download_button(
                 label="Logdateien herunterladen 📝",
-                data=file,
+                data=log,
                 file_name=LOG_FILENAME,
                 mime="text/plain",
                 use_container_width=True,
@@ -0,0 +1,68 @@
+import json
+from io import BytesIO
+from datetime import datetime
+import pytest
+from fileserver import FileServer
+from archive import Archive
+from data import Data
+
+pytest.importorskip("pyarrow")
+
+def record(timestamp: str, temperature) -> dict:
+    return {'timestamp': timestamp, 'temperature': temperature, 'timings': {'capture': 2.5}}
+
+@pytest.fixture
+def fileserver(tmp_path):
+    '''Return a file server in a local directory with a diagnostics log in both formats.'''
+    (tmp_path / "server").mkdir()
+    fileserver = FileServer(str(tmp_path / "server"), "user", "password", f"{tmp_path}/uploads.yaml", protocol="local")
+    fileserver.append_file_from_bytes("diagnostics.yaml", BytesIO(b"- timestamp: 2023-12-31 08:00Z\n  temperature: -5\n"))
+    records = [record("2024-01-15 08:00Z", 1), record("2024-01-16 08:00Z", "n/a"), record("2024-02-20 08:00Z", 3), {'temperature': 4}]
+    fileserver.append_file_from_bytes("diagnostics.jsonl", BytesIO("".join(json.dumps(r) + "\n" for r in records).encode()), compress=True)
+    return fileserver
+
+@pytest.mark.parametrize("file_format", ["parquet", "feather"])
+def test_compact(fileserver, file_format):
+    '''Test that old records are moved into monthly files and the recent records stay in the log.'''
+    archive = Archive(fileserver, file_format=file_format)
+    assert archive.compact(keep_days=10, now=datetime(2024, 2, 21)) == {'archived': 3, 'kept': 2, 'months': ['2023-12', '2024-01']}
+    assert sorted(fileserver.list_files()) == ["archive", "diagnostics.jsonl"]
+    assert list(archive.months()) == ["2023-12", "2024-01"]
+
+    table = archive.read_month("2024-01")
+    assert table.num_rows == 2
+    assert str(table.schema.field("timestamp").type).startswith("timestamp") # Parquet stores them in ms
+    assert table.column("temperature").to_pylist() == ["1", "n/a"] # Mixed types are stored as text
+    assert table.column("timings").to_pylist() == [{'capture': 2.5}, {'capture': 2.5}]
+
+    log = Data.parse_diagnostics(fileserver.get_file_as_text("diagnostics.jsonl"))
+    assert log == [{**record("2024-02-20 08:00Z", 3), 'temperature': 3.0}, {'temperature': 4.0}]
+
+def test_compact_merges_month(fileserver):
+    '''Test that compacting again adds new records to an archived month without duplicates.'''
+    archive = Archive(fileserver)
+    archive.compact(keep_days=10, now=datetime(2024, 2, 21))
+    fileserver.append_file_from_bytes("diagnostics.jsonl", BytesIO(json.dumps(record("2024-01-20 08:00Z", 2)).encode() + b"\n"))
+
+    assert archive.compact(keep_days=10, now=datetime(2024, 2, 21))['months'] == ["2024-01"]
+    assert archive.read_month("2024-01").num_rows == 3
+    assert archive.compact(keep_days=10, now=datetime(2024, 2, 21))['archived'] == 0
+
+def test_compact_log_changed(fileserver):
+    '''Test that the log is not rewritten if the camera appends to it during the compaction.'''
+    archive = Archive(fileserver)
+    upload_file_from_bytes = fileserver.upload_file_from_bytes
+    def upload_and_append(filename, file_data, *args, **kwargs):
+        if filename == Archive.TEMPORARY_FILENAME: # The camera appends while the recent records are uploaded
+            fileserver.append_file_from_bytes("diagnostics.jsonl", BytesIO(json.dumps(record("2024-02-21 08:00Z", 5)).encode() + b"\n"))
+        return upload_file_from_bytes(filename, file_data, *args, **kwargs)
+    fileserver.upload_file_from_bytes = upload_and_append
+
+    assert archive.compact(keep_days=10, now=datetime(2024, 2, 21))['archived'] == 0
+    assert sorted(fileserver.list_files()) == ["archive", "diagnostics.jsonl", "diagnostics.jsonl.gz", "diagnostics.yaml"]
+    log = Data.parse_diagnostics(fileserver.get_file_as_text("diagnostics.jsonl"))
+    assert len(log) == 5 and {**record("2024-02-21 08:00Z", 5), 'temperature': 5.0} in log
+
+def test_months_between():
+    '''Test the months of a period over the turn of the year.'''
+    assert Archive.months_between(datetime(2023, 11, 30), datetime(2024, 2, 1)) == ["2023-11", "2023-12", "2024-01", "2024-02"]
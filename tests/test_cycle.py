@@ -0,0 +1,21 @@
+import sys
+from os import path
+import pytest
+
+pytest.importorskip("PIL")
+pytest.importorskip("pyftpdlib")
+pytest.importorskip("serial")
+
+sys.path.insert(0, path.join(path.dirname(path.dirname(path.abspath(__file__))), "benchmarks"))
+from cycle import SCENARIOS, run_scenario
+
+# Warnings of a wake cycle which ran without problems on a freshly installed camera
+EXPECTED_WARNINGS = ["WARNING Schedule file not found. Writing new schedule file."]
+
+def test_wake_cycle():
+    '''Test that a wake cycle with the real stages and fake hardware runs without warnings or errors.'''
+    result = run_scenario("good_link", SCENARIOS["good_link"])
+    assert [line for line in result['log'] if line not in EXPECTED_WARNINGS] == []
+    assert result['skipped'] == []
+    assert result['uploaded_images'] == 1
+    assert {"witty_pi", "time_sync", "capture", "rename", "schedule", "thresholds", "witty_pi_readings", "diagnostics"} <= set(result['timings'])
@@ -1,10 +1,13 @@
 import os
+import json
 from sys import path
 from io import BytesIO
+from datetime import datetime
 path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from data import Data
+from data import Data, DiagnosticsRecord, SCHEMA_VERSION
 import fileserver as fs
 import streamlit as st
+import pytest
 
 def test_init():
     """Test the initialization of the Data class."""
@@ -98,3 +101,147 @@ def test_get_data_as_bytes():
     # file_server = fs.FileServer(FTP_HOST, FTP_USERNAME, FTP_PASSWORD)
     # file_server.change_directory(FTP_FOLDER[0])
     # file_server.append_file_from_bytes(temp_filename, bytes_data)
+
+def test_json_lines(tmp_path):
+    """Test appending to and loading a JSON Lines diagnostics file."""
+    temp_filename = f"{tmp_path}/diagnostics.jsonl"
+    data = Data(temp_filename)
+    data.add("temperature", 25)
+    data.append_diagnostics_to_file()
+
+    data2 = Data(temp_filename)
+    data2.add("string", "test")
+    data2.append_diagnostics_to_file()
+
+    with open(temp_filename, 'r', encoding='utf-8') as file:
+        rows = [json.loads(line) for line in file]
+    assert rows[0] == [SCHEMA_VERSION] + [None] * 8 + [25.0] # Compact row of the schema
+    assert rows[1][-1] == {'string': 'test'} # Unknown field
+
+    new_data = Data(temp_filename)
+    new_data.load_diagnostics()
+    assert not os.path.exists(temp_filename)
+    assert new_data.diagnostics == [{'temperature': 25}, {'string': 'test'}, {}]
+
+def test_json_lines_with_legacy_yaml(tmp_path):
+    """Test that the diagnostics of a YAML file from an older version are uploaded with the JSON Lines."""
+    legacy = Data(f"{tmp_path}/diagnostics.yaml")
+    legacy.add("temperature", 3)
+    legacy.save_diagnostics()
+
+    data = Data(f"{tmp_path}/diagnostics.jsonl")
+    data.add("temperature", 25)
+    data.append_diagnostics_to_file()
+    data.downsample_local_diagnostics() # Converts the YAML file
+
+    chunk = data.get_local_chunk(1024)
+    assert Data.parse_diagnostics(chunk.getvalue().decode('utf-8')) == [{'temperature': 3}, {'temperature': 25}]
+
+    data.remove_local_chunk(chunk)
+    assert not os.listdir(tmp_path)
+
+def test_parse_diagnostics():
+    """Test parsing diagnostics in both formats."""
+    assert Data.parse_diagnostics("- temperature: 25\n- temperature: 3\n") == [{'temperature': 25}, {'temperature': 3}]
+    assert Data.parse_diagnostics('{"temperature":25}\n\n{"temperature":3}\n') == [{'temperature': 25}, {'temperature': 3}]
+    assert Data.parse_diagnostics("") == []
+
+def test_diagnostics_record():
+    """Test the conversion of the fields to their type and of unknown fields."""
+    record = DiagnosticsRecord.from_dict({'battery_voltage': 12, 'signal_quality': "n/a", 'humidity': 50})
+    assert record.battery_voltage == 12.0 and isinstance(record.battery_voltage, float)
+    assert record.signal_quality is None
+    assert record.extra == {'signal_quality': "n/a", 'humidity': 50}
+    assert DiagnosticsRecord.from_row(json.loads(json.dumps(record.to_row()))).to_dict() == record.to_dict()
+
+    with pytest.raises(AttributeError): # Fixed fields
+        record.humidity = 50
+
+    with pytest.raises(ValueError):
+        DiagnosticsRecord.from_row([SCHEMA_VERSION + 1])
+
+def test_parse_table():
+    """Test parsing diagnostics of all versions into columns and rows."""
+    text = '{"temperature":3,"humidity":50}\n' + json.dumps(DiagnosticsRecord.from_dict({'version': "1.0.0", 'temperature': 25}).to_row()) + "\n"
+    columns, rows = Data.parse_table(text)
+    assert columns == list(DiagnosticsRecord.FIELDS) + ['humidity']
+    assert [dict(zip(columns, row))['temperature'] for row in rows] == [3.0, 25.0]
+    assert [dict(zip(columns, row))['humidity'] for row in rows] == [50, None]
+    assert all(len(row) == len(columns) for row in rows)
+
+    columns, rows = Data.parse_table('{"signal_quality":"n/a"}\n') # Invalid value of a schema field
+    assert columns.count('signal_quality') == 1
+    assert dict(zip(columns, rows[0]))['signal_quality'] is None
+    assert dict(zip(columns, rows[0]))['signal_quality_raw'] == "n/a"
+
+    columns, rows = Data.parse_table("- temperature: 25\n") # YAML
+    assert dict(zip(columns, rows[0]))['temperature'] == 25.0
+
+def test_downsample_local_diagnostics(tmp_path):
+    """Test the hourly and daily aggregates of old records and the maximum number of local records."""
+    now = datetime(2024, 3, 31, 12, 0)
+    data = Data(f"{tmp_path}/diagnostics.jsonl")
+    for timestamp, temperature in [("2024-02-01 10:00Z", 1.0), ("2024-02-01 20:00Z", 3.0), # Daily
+                                   ("2024-03-20 08:00Z", 2.0), ("2024-03-20 08:30Z", 4.0), ("2024-03-20 09:00Z", 5.0), # Hourly
+                                   ("2024-03-30 08:00Z", 6.0)]: # Full resolution
+        data.diagnostics = [{'timestamp': timestamp, 'temperature': temperature, 'timings': {'boot': 1.0}}]
+        data.append_diagnostics_to_file()
+
+    assert data.downsample_local_diagnostics(now=now) is None # Small enough
+    assert data.downsample_local_diagnostics(now=now, min_bytes=0) == 4
+    with open(f"{tmp_path}/diagnostics.jsonl", 'r', encoding='utf-8') as diagnostics_file:
+        records = Data.parse_diagnostics(diagnostics_file.read())
+
+    assert [record['timestamp'] for record in records] == ["2024-02-01 00:00Z", "2024-03-20 08:00Z", "2024-03-20 09:00Z", "2024-03-30 08:00Z"]
+    assert records[0]['temperature'] == 2.0 and 'timings' not in records[0]
+    assert records[0]['aggregate'] == {'resolution': "day", 'records': 2, 'min': {'temperature': 1.0}, 'max': {'temperature': 3.0}}
+    assert records[1]['aggregate']['records'] == 2 and 'aggregate' not in records[2] # A single record is kept
+
+    # The aggregates are weighted by their number of records
+    data.MAX_LOCAL_RECORDS = 2
+    assert data.downsample_local_diagnostics(now=datetime(2024, 5, 1), min_bytes=0) == 2
+    with open(f"{tmp_path}/diagnostics.jsonl", 'r', encoding='utf-8') as diagnostics_file:
+        records = Data.parse_diagnostics(diagnostics_file.read())
+    assert records[0]['timestamp'] == "2024-03-20 00:00Z"
+    assert records[0]['temperature'] == pytest.approx(11 / 3, abs=0.001)
+    assert records[0]['aggregate']['records'] == 3 and records[0]['aggregate']['min'] == {'temperature': 2.0}
+
+def test_local_chunks(tmp_path):
+    """Test uploading the newest local records in chunks."""
+    data = Data(f"{tmp_path}/diagnostics.jsonl")
+    for temperature in range(3):
+        data.diagnostics = [{'temperature': temperature}]
+        data.append_diagnostics_to_file()
+    with open(f"{tmp_path}/diagnostics.jsonl", 'rb') as diagnostics_file:
+        lines = diagnostics_file.readlines()
+
+    chunk = data.get_local_chunk(len(lines[2]) + len(lines[1]) + 1)
+    assert chunk.getvalue() == lines[1] + lines[2]
+    data.remove_local_chunk(chunk)
+
+    chunk = data.get_local_chunk(1) # At least one line
+    assert chunk.getvalue() == lines[0]
+    data.remove_local_chunk(chunk)
+    assert not os.listdir(tmp_path)
+
+def test_read_appended_diagnostics(tmp_path):
+    """Test reading only the new diagnostics and reading everything again after a file shrank."""
+    os.makedirs(tmp_path / "server")
+    fileserver = fs.FileServer(str(tmp_path / "server"), "user", "password", f"{tmp_path}/uploads.yaml", protocol="local")
+    fileserver.append_file_from_bytes("diagnostics.jsonl", BytesIO(b'{"temperature":1}\n{"temperature":2}\n'))
+    sizes = {}
+
+    replaced, tables = Data.read_appended_diagnostics(fileserver, sizes)
+    assert not replaced and [len(rows) for _, rows in tables] == [2]
+
+    fileserver.append_file_from_bytes("diagnostics.jsonl", BytesIO(b'{"temperature":3}\n'))
+    fileserver.invalidate_listing()
+    replaced, tables = Data.read_appended_diagnostics(fileserver, sizes)
+    assert not replaced and [len(rows) for _, rows in tables] == [1]
+
+    # Compacted
+    fileserver.upload_file_from_bytes("diagnostics.jsonl", BytesIO(b'{"temperature":3}\n'))
+    fileserver.invalidate_listing()
+    replaced, tables = Data.read_appended_diagnostics(fileserver, sizes)
+    assert replaced and [len(rows) for _, rows in tables] == [1]
+    assert sizes == {'diagnostics.jsonl': 18}
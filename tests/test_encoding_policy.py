@@ -0,0 +1,91 @@
+import os
+from io import BytesIO
+from PIL import Image
+from encoding_policy import EncodingPolicy
+
+MB = 1024 * 1024
+
+def test_original_on_good_link():
+    '''Test that the original image is uploaded on a good link.'''
+    policy = EncodingPolicy(signal_quality=25, throughput=1 * MB)
+    assert policy.choose(4 * MB)['quality'] is None
+
+def test_smaller_image_on_poor_link():
+    '''Test that a smaller image is uploaded on a poor link.'''
+    good = EncodingPolicy(throughput=200 * 1024).choose(4 * MB)
+    poor = EncodingPolicy(throughput=20 * 1024).choose(4 * MB)
+    assert poor['size_ratio'] < good['size_ratio'] < 1.0
+
+def test_smallest_level_if_nothing_fits():
+    '''Test that the smallest level is used if no level fits the time limit.'''
+    policy = EncodingPolicy(throughput=1)
+    assert policy.choose(4 * MB) == EncodingPolicy.LEVELS[-1]
+
+def test_estimate_throughput_from_signal_quality():
+    '''Test that the throughput is estimated from the signal quality if it was never measured.'''
+    assert EncodingPolicy(signal_quality=5).throughput < EncodingPolicy(signal_quality=15).throughput < EncodingPolicy(signal_quality=25).throughput
+    assert EncodingPolicy(signal_quality=99).throughput == EncodingPolicy(signal_quality=0).throughput
+
+def test_smaller_image_with_large_backlog():
+    '''Test that a large backlog reduces the image size.'''
+    policy = EncodingPolicy(throughput=1 * MB, outbox_bytes=EncodingPolicy.BACKLOG_LIMIT + 1)
+    assert policy.choose(4 * MB) == EncodingPolicy.LEVELS[1]
+
+def test_encode(tmp_path):
+    '''Test that the image is re-encoded and the original is kept.'''
+    directory = f"{tmp_path}/"
+    Image.effect_noise((400, 300), 32).convert('RGB').save(f"{directory}image.jpg", "JPEG", quality=95)
+    original_size = os.path.getsize(f"{directory}image.jpg")
+
+    policy = EncodingPolicy(throughput=1, max_upload_seconds=1)
+    level = policy.encode("image.jpg", directory)
+
+    assert level == EncodingPolicy.LEVELS[-1]
+    assert os.path.getsize(f"{directory}originals/image.jpg") == original_size
+    with Image.open(f"{directory}image.jpg") as image:
+        assert image.size == (100, 75)
+
+def test_encode_keeps_original_on_good_link(tmp_path):
+    '''Test that the image is not changed on a good link.'''
+    directory = f"{tmp_path}/"
+    Image.new('RGB', (40, 30)).save(f"{directory}image.jpg", "JPEG")
+    EncodingPolicy(throughput=1 * MB).encode("image.jpg", directory)
+    assert os.path.exists(f"{directory}image.jpg")
+    assert not os.path.exists(f"{directory}originals")
+
+def test_encode_bytes(tmp_path):
+    '''Test that an image in memory is re-encoded and only the original is written to the SD card.'''
+    directory = f"{tmp_path}/"
+    image_data = BytesIO()
+    Image.effect_noise((400, 300), 32).convert('RGB').save(image_data, "JPEG", quality=95)
+
+    policy = EncodingPolicy(throughput=1, max_upload_seconds=1)
+    level, encoded_data = policy.encode_bytes("image.jpg", image_data, directory)
+
+    assert level == EncodingPolicy.LEVELS[-1]
+    assert os.listdir(directory) == ["originals"]
+    assert os.path.getsize(f"{directory}originals/image.jpg") == image_data.getbuffer().nbytes
+    with Image.open(encoded_data) as image:
+        assert image.size == (100, 75)
+
+def test_encode_bytes_keeps_original_on_good_link(tmp_path):
+    '''Test that an image in memory is not changed or written on a good link.'''
+    directory = f"{tmp_path}/"
+    image_data = BytesIO()
+    Image.new('RGB', (40, 30)).save(image_data, "JPEG")
+
+    level, encoded_data = EncodingPolicy(throughput=1 * MB).encode_bytes("image.jpg", image_data, directory)
+    assert level['quality'] is None
+    assert encoded_data is image_data
+    assert os.listdir(directory) == []
+
+def test_create_thumbnail(tmp_path):
+    '''Test creating a preview from a file and from memory.'''
+    Image.new('RGB', (1920, 1080)).save(f"{tmp_path}/image.jpg", "JPEG")
+    with Image.open(EncodingPolicy.create_thumbnail(f"{tmp_path}/image.jpg")) as thumbnail:
+        assert thumbnail.size == (640, 360)
+
+    image_data = BytesIO()
+    Image.new('RGB', (320, 240)).save(image_data, "JPEG")
+    with Image.open(EncodingPolicy.create_thumbnail(image_data)) as thumbnail:
+        assert thumbnail.size == (320, 240) # Small images are not enlarged
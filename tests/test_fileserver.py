@@ -0,0 +1,409 @@
+from io import BytesIO
+import gzip
+from ftplib import error_perm, error_reply
+import pytest
+from fileserver import FileServer, TransferAborted
+
+class FakeDataConnection:
+    '''A data connection of the fake file server which can drop during an upload.'''
+    def __init__(self, filename):
+        self.filename = filename
+
+    def sendall(self, block):
+        files = FakeFTP.files
+        if FakeFTP.fail_after is not None and len(files[self.filename]) + len(block) > FakeFTP.fail_after:
+            files[self.filename] += block[:FakeFTP.fail_after - len(files[self.filename])]
+            raise TimeoutError("Connection lost")
+        files[self.filename] += block
+
+    def close(self):
+        pass
+
+class FakeFTP:
+    '''A file server in memory which can drop the connection during an upload.'''
+    files = {}
+    fail_after = None # Number of bytes after which the connection drops
+    connect_error = None # Exception raised when connecting
+    password = "password"
+    timeout = None # Timeout of the last connection
+
+    def __init__(self, *args, **kwargs):
+        self.commands = []
+        self.reply = None # Reply of a transfer which was not read yet
+        FakeFTP.timeout = kwargs.get('timeout')
+
+    def connect(self, host):
+        if self.connect_error:
+            raise self.connect_error
+
+    def login(self, username, password):
+        if password != self.password:
+            raise error_perm("530 Login incorrect.")
+
+    def check_reply(self):
+        '''The next command receives the reply of an interrupted transfer if it was not read.'''
+        if self.reply is not None:
+            raise error_reply(self.reply)
+
+    def transfercmd(self, cmd, rest=None):
+        self.check_reply()
+        self.commands.append(cmd)
+        command, filename = cmd.split(" ", 1)
+        if command == "STOR" or filename not in self.files:
+            self.files[filename] = b''
+        self.reply = "226 Transfer complete." # Sent after the data connection was closed
+        return FakeDataConnection(filename)
+
+    def getresp(self):
+        reply, self.reply = self.reply, None
+        return reply
+
+    def voidresp(self):
+        return self.getresp()
+
+    def retrbinary(self, cmd, callback, blocksize=8192, rest=None):
+        self.commands.append(cmd)
+        callback(self.files[cmd.split(" ", 1)[1]][rest or 0:])
+        return "226 Transfer complete."
+
+    def mlsd(self, path="", facts=None):
+        self.commands.append("MLSD")
+        yield ".", {'type': 'cdir'}
+        for filename, data in self.files.items():
+            yield filename, {'type': 'file', 'size': str(len(data)), 'modify': '20240101120000'}
+
+    def nlst(self, *args):
+        self.commands.append("NLST")
+        return list(self.files)
+
+    def sendcmd(self, cmd):
+        self.check_reply()
+        self.commands.append(cmd)
+        return "213 20240101120000"
+
+    def pwd(self):
+        return "/"
+
+    def cwd(self, directory):
+        pass
+
+    def quit(self):
+        pass
+
+    def voidcmd(self, cmd):
+        self.check_reply()
+        return "200 OK"
+
+    def rename(self, fromname, toname):
+        self.check_reply()
+        self.commands.append(f"RNFR {fromname}")
+        self.files[toname] = self.files.pop(fromname)
+
+    def size(self, filename):
+        self.check_reply()
+        if filename not in self.files:
+            raise Exception("550 No such file")
+        return len(self.files[filename])
+
+@pytest.fixture
+def fileserver(mocker, tmp_path):
+    '''Return a file server connected to an empty fake FTP server.'''
+    FakeFTP.files = {}
+    FakeFTP.fail_after = None
+    FakeFTP.connect_error = None
+    mocker.patch('transport.FTP', FakeFTP)
+    mocker.patch('fileserver.socket.getaddrinfo', return_value=[(None, None, None, '', ('127.0.0.1', 0))])
+    return FileServer("host", "user", "password", f"{tmp_path}/uploads.yaml")
+
+def test_connect(fileserver):
+    '''Test that the outcome of the connection is exposed.'''
+    assert fileserver.connected()
+    assert fileserver.connect_outcome == "connected"
+    assert fileserver.connect_attempts == 1
+
+def test_connect_auth_failed(fileserver, mocker):
+    '''Test that a wrong password is not retried.'''
+    sleep = mocker.patch('fileserver.sleep')
+    fileserver = FileServer("host", "user", "wrong")
+    assert not fileserver.connected()
+    assert fileserver.connect_outcome == "auth_failed"
+    assert fileserver.connect_attempts == 1
+    sleep.assert_not_called()
+
+def test_connect_backoff(fileserver, mocker):
+    '''Test that the delay between the attempts grows and the timeout is respected.'''
+    FakeFTP.connect_error = ConnectionRefusedError("Connection refused")
+    sleep = mocker.patch('fileserver.sleep')
+    fileserver = FileServer("host", "user", "password", timeout=60)
+    assert not fileserver.connected()
+    assert fileserver.connect_outcome == "unreachable"
+    assert fileserver.connect_attempts == 5
+    delays = [call.args[0] for call in sleep.call_args_list]
+    assert len(delays) == 4
+    assert all(0.5 <= delay <= 1 for delay in delays[:1]) and all(4 <= delay <= 8 for delay in delays[3:])
+
+    sleep.reset_mock()
+    fileserver = FileServer("host", "user", "password", timeout=0.1)
+    assert not fileserver.connected()
+    assert fileserver.connect_attempts == 1
+    sleep.assert_not_called()
+
+def test_connect_without_time_left(fileserver):
+    '''Test that the connection is tried with a positive timeout even if there is no time left.'''
+    fileserver = FileServer("host", "user", "password", timeout=0)
+    assert fileserver.connect_outcome == "connected"
+    assert FakeFTP.timeout == fileserver.MIN_ATTEMPT_TIMEOUT
+
+def test_upload_file_from_bytes(fileserver):
+    '''Test a complete upload.'''
+    assert fileserver.upload_file_from_bytes("image.jpg", BytesIO(b'0123456789'))
+    assert FakeFTP.files["image.jpg"] == b'0123456789'
+
+def test_resume_upload(fileserver, tmp_path):
+    '''Test that an interrupted upload is resumed from the size on the server.'''
+    (tmp_path / "image.jpg").write_bytes(b'0123456789')
+
+    FakeFTP.fail_after = 4
+    assert not fileserver.upload_file("image.jpg", f"{tmp_path}/")
+    assert FakeFTP.files["image.jpg"] == b'0123'
+
+    # After a reboot
+    FakeFTP.fail_after = None
+    fileserver = FileServer("host", "user", "password", f"{tmp_path}/uploads.yaml")
+    assert fileserver.upload_file("image.jpg", f"{tmp_path}/", delete_after_upload=True)
+    assert fileserver.transport.ftp.commands == ["APPE image.jpg"]
+    assert FakeFTP.files["image.jpg"] == b'0123456789'
+    assert not (tmp_path / "image.jpg").exists()
+
+def test_resume_upload_old_state(fileserver, tmp_path):
+    '''Test that the upload state of older versions (only the size of a file) is read.'''
+    (tmp_path / "uploads.yaml").write_text("image.jpg: 10\n")
+    FakeFTP.files["image.jpg"] = b'0123'
+    assert fileserver.upload_file_from_bytes("image.jpg", BytesIO(b'0123456789'))
+    assert fileserver.transport.ftp.commands == ["APPE image.jpg"]
+    assert FakeFTP.files["image.jpg"] == b'0123456789'
+
+def test_do_not_resume_unknown_file(fileserver, tmp_path):
+    '''Test that a file on the server which was not uploaded by this device is overwritten.'''
+    FakeFTP.files["image.jpg"] = b'abc'
+    assert fileserver.upload_file_from_bytes("image.jpg", BytesIO(b'0123456789'))
+    assert fileserver.transport.ftp.commands == ["STOR image.jpg"]
+    assert FakeFTP.files["image.jpg"] == b'0123456789'
+
+def test_upload_files(fileserver, tmp_path):
+    '''Test uploading files over multiple sessions.'''
+    for i in range(6):
+        (tmp_path / f"image{i}.jpg").write_bytes(b'0' * 100)
+
+    result = fileserver.upload_files([f"image{i}.jpg" for i in range(6)] + ["missing.jpg"], f"{tmp_path}/", delete_after_upload=True, sessions=3)
+    assert result['sessions'] == 3
+    assert sorted(result['uploaded']) == [f"image{i}.jpg" for i in range(6)]
+    assert list(result['errors']) == ["missing.jpg"]
+    assert result['bytes'] == 600
+    assert not (tmp_path / "image0.jpg").exists()
+
+def test_upload_files_budget(fileserver, tmp_path):
+    '''Test that no more files are started once the budget is exhausted.'''
+    for i in range(3):
+        (tmp_path / f"image{i}.jpg").write_bytes(b'0' * 100)
+
+    result = fileserver.upload_files([f"image{i}.jpg" for i in range(3)], f"{tmp_path}/", sessions=1, should_continue=lambda: len(FakeFTP.files) < 2)
+    assert result['uploaded'] == ["image0.jpg", "image1.jpg"]
+    assert result['errors'] == {}
+
+def test_cached_listing(fileserver):
+    '''Test that the directory listing is cached until the directory changes.'''
+    FakeFTP.files["settings.yaml"] = b'abc'
+    assert fileserver.list_files() == ["settings.yaml"]
+    assert fileserver.list_files() == ["settings.yaml"]
+    assert fileserver.list_directory()["settings.yaml"]['size'] == '3'
+    assert fileserver.get_file_last_modified_date("settings.yaml").year == 2024
+    assert fileserver.transport.ftp.commands == ["MLSD"]
+
+    # Uploads invalidate the listing
+    fileserver.upload_file_from_bytes("image.jpg", BytesIO(b'0123'))
+    assert sorted(fileserver.list_files()) == ["image.jpg", "settings.yaml"]
+    assert fileserver.transport.ftp.commands.count("MLSD") == 2
+
+def test_listing_without_mlsd(fileserver, mocker):
+    '''Test the fallback to NLST and MDTM if the server does not support MLSD.'''
+    FakeFTP.files["settings.yaml"] = b'abc'
+    mocker.patch.object(FakeFTP, 'mlsd', side_effect=error_perm("500 Unknown command."))
+    assert fileserver.list_files() == ["settings.yaml"]
+    assert not fileserver.transport.mlsd_supported
+    assert fileserver.get_file_last_modified_date("settings.yaml").year == 2024
+    assert fileserver.transport.ftp.commands == ["NLST", "MDTM settings.yaml"]
+
+def test_append_file_streamed(fileserver, tmp_path):
+    '''Test that a file is appended in blocks and the progress is reported.'''
+    (tmp_path / "log.txt").write_bytes(b'1' * 20000)
+    FakeFTP.files["log.txt"] = b'0'
+    progress = []
+    fileserver.progress = lambda filename, sent, total: progress.append((filename, sent, total))
+
+    assert fileserver.append_file("log.txt", f"{tmp_path}/", delete_after_upload=True)
+    assert FakeFTP.files["log.txt"] == b'0' + b'1' * 20000
+    assert progress == [("log.txt", 8192, 20000), ("log.txt", 16384, 20000), ("log.txt", 20000, 20000)]
+    assert fileserver.bytes_sent == 20000
+    assert not (tmp_path / "log.txt").exists()
+
+def test_append_file_failed(fileserver, tmp_path):
+    '''Test that the local file is kept if the append fails.'''
+    (tmp_path / "log.txt").write_bytes(b'1' * 100)
+    FakeFTP.fail_after = 10
+    assert not fileserver.append_file("log.txt", f"{tmp_path}/", delete_after_upload=True)
+    assert (tmp_path / "log.txt").exists()
+
+def test_append_interrupted(fileserver, mocker):
+    '''Test that an interrupted append is removed, so the gzip members appended after it can be read.'''
+    assert fileserver.append_file_from_bytes("log.txt", BytesIO(b'old\n'), compress=True)
+    old_size = len(FakeFTP.files["log.txt.gz"])
+
+    # The interrupted append can not be removed before the next wake cycle
+    FakeFTP.fail_after = old_size + 10
+    get_file_as_bytes = mocker.patch.object(fileserver, 'get_file_as_bytes', return_value=BytesIO())
+    assert not fileserver.append_file_from_bytes("log.txt", BytesIO(b'lost\n' * 100), compress=True)
+    assert len(FakeFTP.files["log.txt.gz"]) == old_size + 10
+    mocker.stop(get_file_as_bytes)
+
+    FakeFTP.fail_after = None
+    assert fileserver.append_file_from_bytes("log.txt", BytesIO(b'new\n'), compress=True)
+    assert fileserver.get_file_as_text("log.txt") == 'old\nnew\n'
+
+    # Removed right away
+    FakeFTP.fail_after = len(FakeFTP.files["log.txt.gz"]) + 10
+    assert not fileserver.append_file_from_bytes("log.txt", BytesIO(b'lost\n' * 100), compress=True)
+    FakeFTP.fail_after = None
+    assert fileserver.get_file_as_text("log.txt") == 'old\nnew\n'
+    assert sorted(FakeFTP.files) == ["log.txt.gz"]
+
+    # The file is not changed if the removal fails
+    FakeFTP.fail_after = len(FakeFTP.files["log.txt.gz"]) + 10
+    rename = mocker.patch.object(fileserver.transport, 'rename', side_effect=TimeoutError("Connection lost"))
+    assert not fileserver.append_file_from_bytes("log.txt", BytesIO(b'lost\n' * 100), compress=True)
+    assert len(FakeFTP.files["log.txt.gz"]) == FakeFTP.fail_after
+    mocker.stop(rename)
+
+    FakeFTP.fail_after = None
+    assert fileserver.append_file_from_bytes("log.txt", BytesIO(b'last\n'), compress=True)
+    assert fileserver.get_file_as_text("log.txt") == 'old\nnew\nlast\n'
+
+def test_append_interrupted_large_file(fileserver):
+    '''Test that an interrupted append is kept in a large file and skipped when reading it.'''
+    fileserver.MAX_REPAIR_BYTES = 10
+    assert fileserver.append_file_from_bytes("log.txt", BytesIO(b'old\n'), compress=True)
+
+    FakeFTP.fail_after = len(FakeFTP.files["log.txt.gz"]) + 10
+    assert not fileserver.append_file_from_bytes("log.txt", BytesIO(b'lost\n' * 100), compress=True)
+    FakeFTP.fail_after = None
+    assert fileserver.transport.ftp.commands.count("RETR log.txt.gz") == 0 # Not downloaded
+
+    assert fileserver.append_file_from_bytes("log.txt", BytesIO(b'new\n'), compress=True)
+    assert fileserver.get_file_as_text("log.txt") == 'old\nnew\n'
+
+def test_decompress():
+    '''Test that partial gzip members are skipped.'''
+    members = [gzip.compress(text) for text in (b'a\n', b'b\n' * 100, b'c\n')]
+    assert FileServer.decompress(b"".join(members)) == b'a\n' + b'b\n' * 100 + b'c\n'
+    assert FileServer.decompress(members[0] + members[1][:20] + members[2]) == b'a\nc\n'
+    assert FileServer.decompress(members[0] + members[1][:20]) == b'a\n'
+    assert FileServer.decompress(b'') == b''
+
+def test_append_aborted(fileserver, tmp_path):
+    '''Test that the progress callback can stop an append, which is removed before the next append.'''
+    assert fileserver.append_file_from_bytes("log.txt", BytesIO(b'old'))
+    (tmp_path / "log.txt").write_bytes(b'1' * 20000)
+
+    def stop(filename, sent_bytes, total_bytes):
+        raise TransferAborted("No time left")
+
+    fileserver.progress = stop
+    assert not fileserver.append_file("log.txt", f"{tmp_path}/", delete_after_upload=True)
+    assert FakeFTP.files["log.txt"] == b'old' + b'1' * 8192 # Not removed, as there is no time left
+    assert (tmp_path / "log.txt").exists()
+
+    fileserver.progress = None # The diagnostics are appended on the same session after the logs
+    assert fileserver.append_file_from_bytes("diagnostics.jsonl", BytesIO(b'{}\n'))
+    assert FakeFTP.files["diagnostics.jsonl"] == b'{}\n'
+
+    assert fileserver.append_file("log.txt", f"{tmp_path}/", delete_after_upload=True)
+    assert FakeFTP.files["log.txt"] == b'old' + b'1' * 20000
+
+def test_append_compressed(tmp_path):
+    '''Test that compressed appends are gzip members which are read together with the uncompressed part.'''
+    (tmp_path / "server").mkdir()
+    (tmp_path / "server" / "log.txt").write_bytes(b'old\n')
+    fileserver = FileServer(str(tmp_path / "server"), "user", "password", f"{tmp_path}/uploads.yaml", protocol="local")
+
+    (tmp_path / "log.txt").write_bytes(b'new\n' * 1000)
+    assert fileserver.append_file("log.txt", f"{tmp_path}/", delete_after_upload=True, compress=True)
+    assert fileserver.append_file_from_bytes("log.txt", BytesIO(b'newest\n'), compress=True)
+
+    assert fileserver.compression['raw_bytes'] == 4007
+    assert fileserver.compression['compressed_bytes'] == (tmp_path / "server" / "log.txt.gz").stat().st_size < 200
+    assert fileserver.get_file_as_text("log.txt") == 'old\n' + 'new\n' * 1000 + 'newest\n'
+
+def test_download_file_if_changed(tmp_path):
+    '''Test that a file is only downloaded if it changed on the server or locally.'''
+    (tmp_path / "server").mkdir()
+    (tmp_path / "server" / "settings.yaml").write_text("cameraName: A\n")
+    fileserver = FileServer(str(tmp_path / "server"), "user", "password", f"{tmp_path}/uploads.yaml", protocol="local")
+    manifest = f"{tmp_path}/manifest.yaml"
+
+    assert fileserver.download_file_if_changed("settings.yaml", f"{tmp_path}/", manifest)
+    assert not fileserver.download_file_if_changed("settings.yaml", f"{tmp_path}/", manifest)
+
+    # Changed locally
+    (tmp_path / "settings.yaml").write_text("cameraName: B\n")
+    assert fileserver.download_file_if_changed("settings.yaml", f"{tmp_path}/", manifest)
+    assert (tmp_path / "settings.yaml").read_text() == "cameraName: A\n"
+
+    # Changed on the server
+    (tmp_path / "server" / "settings.yaml").write_text("cameraName: CC\n")
+    fileserver.invalidate_listing()
+    assert fileserver.download_file_if_changed("settings.yaml", f"{tmp_path}/", manifest)
+    assert (tmp_path / "settings.yaml").read_text() == "cameraName: CC\n"
+
+def test_download_file_if_changed_incomplete(tmp_path):
+    '''Test that an incomplete download does not replace the local file and is downloaded again.'''
+    (tmp_path / "server").mkdir()
+    (tmp_path / "server" / "settings.yaml").write_text("cameraName: A\n")
+    (tmp_path / "settings.yaml").write_text("cameraName: B\n")
+    fileserver = FileServer(str(tmp_path / "server"), "user", "password", f"{tmp_path}/uploads.yaml", protocol="local")
+    manifest = f"{tmp_path}/manifest.yaml"
+
+    get = fileserver.transport.get
+    fileserver.transport.get = lambda filename, write, **kwargs: write(b"camera") # Connection closed early
+    assert not fileserver.download_file_if_changed("settings.yaml", f"{tmp_path}/", manifest)
+    assert (tmp_path / "settings.yaml").read_text() == "cameraName: B\n"
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["server", "settings.yaml"]
+
+    fileserver.transport.get = get
+    assert fileserver.download_file_if_changed("settings.yaml", f"{tmp_path}/", manifest)
+    assert (tmp_path / "settings.yaml").read_text() == "cameraName: A\n"
+
+def test_transfer_summary(fileserver, tmp_path):
+    '''Test that every transfer is measured, including retried uploads.'''
+    (tmp_path / "image.jpg").write_bytes(b'0' * 100)
+    FakeFTP.fail_after = 40
+    assert not fileserver.upload_file("image.jpg", f"{tmp_path}/")
+    FakeFTP.fail_after = None
+    assert fileserver.upload_file("image.jpg", f"{tmp_path}/")
+    assert fileserver.append_file_from_bytes("log.txt", BytesIO(b'0' * 20))
+
+    assert [(t['direction'], t['bytes'], t['retries'], t['success']) for t in fileserver.transfers] == \
+        [("upload", 0, 0, False), ("upload", 60, 1, True), ("append", 20, 0, True)]
+
+    summary = fileserver.get_transfer_summary()
+    assert summary['count'] == 3
+    assert summary['failed'] == 1
+    assert summary['bytes'] == 80
+    assert summary['retries'] == 1
+    assert summary['first_byte_seconds'] is not None
+
+def test_get_file_from_offset(tmp_path):
+    '''Test downloading only the data appended since the last download.'''
+    (tmp_path / "diagnostics.yaml").write_bytes(b'- a: 1\n')
+    fileserver = FileServer(str(tmp_path), "user", "password", f"{tmp_path}/uploads.yaml", protocol="local")
+    fileserver.append_file_from_bytes("diagnostics.yaml", BytesIO(b'- a: 2\n'))
+    assert fileserver.get_file_as_bytes("diagnostics.yaml", 7).getvalue() == b'- a: 2\n'
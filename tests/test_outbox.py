@@ -0,0 +1,85 @@
+import os
+from os import utime
+import pytest
+from outbox import Outbox
+
+@pytest.fixture
+def directory(tmp_path):
+    '''Return a directory with three images of different age and size.'''
+    for i, size in enumerate([100, 200, 300]):
+        filename = tmp_path / f"image{i}.jpg"
+        filename.write_bytes(b'0' * size)
+        utime(filename, (1000 + i, 1000 + i))
+    (tmp_path / "log.txt").write_text("log")
+    return f"{tmp_path}/"
+
+def test_scan(directory):
+    '''Test adding the images in a directory.'''
+    outbox = Outbox(f"{directory}outbox.yaml")
+    outbox.scan(directory)
+    assert sorted(outbox.files) == ["image0.jpg", "image1.jpg", "image2.jpg"]
+    assert outbox.files["image1.jpg"]['size'] == 200
+    assert outbox.size() == 600
+
+    os.remove(f"{directory}image0.jpg")
+    outbox.scan(directory)
+    assert sorted(outbox.files) == ["image1.jpg", "image2.jpg"]
+
+def test_pending_order(directory):
+    '''Test that high priority files come first and the backlog is uploaded newest first.'''
+    outbox = Outbox(f"{directory}outbox.yaml")
+    outbox.scan(directory)
+    assert outbox.pending() == ["image2.jpg", "image1.jpg", "image0.jpg"]
+
+    outbox.add("image0.jpg", directory, Outbox.HIGH)
+    assert outbox.pending() == ["image0.jpg", "image2.jpg", "image1.jpg"]
+
+def test_pending_failed_files_last(directory):
+    '''Test that files which failed too often are uploaded last.'''
+    outbox = Outbox(f"{directory}outbox.yaml")
+    outbox.scan(directory)
+    for _ in range(Outbox.MAX_ATTEMPTS):
+        outbox.mark_failed("image2.jpg")
+    assert outbox.pending() == ["image1.jpg", "image0.jpg", "image2.jpg"]
+
+def test_pending_byte_budget(directory):
+    '''Test that the pending files are limited by the byte budget.'''
+    outbox = Outbox(f"{directory}outbox.yaml")
+    outbox.scan(directory)
+    assert outbox.pending(max_bytes=500) == ["image2.jpg", "image1.jpg"]
+    assert outbox.pending(max_bytes=400) == ["image2.jpg", "image0.jpg"]
+    assert outbox.pending(max_bytes=100) == ["image0.jpg"]
+    assert outbox.pending(max_bytes=50) == []
+
+def test_save_and_load(directory):
+    '''Test that the outbox is persisted across wake cycles.'''
+    outbox = Outbox(f"{directory}outbox.yaml")
+    outbox.scan(directory)
+    outbox.mark_failed("image1.jpg")
+    outbox.mark_uploaded("image0.jpg")
+    outbox.save()
+
+    new_outbox = Outbox(f"{directory}outbox.yaml")
+    assert sorted(new_outbox.files) == ["image1.jpg", "image2.jpg"]
+    assert new_outbox.files["image1.jpg"]['attempts'] == 1
+
+def test_add_updates_size(directory):
+    '''Test that adding a file again updates its size and keeps the higher priority.'''
+    outbox = Outbox(f"{directory}outbox.yaml")
+    outbox.add("image0.jpg", directory, Outbox.HIGH)
+    with open(f"{directory}image0.jpg", 'wb') as f:
+        f.write(b'0' * 50)
+    outbox.add("image0.jpg", directory)
+    assert outbox.files["image0.jpg"]['size'] == 50
+    assert outbox.files["image0.jpg"]['priority'] == Outbox.HIGH
+
+def test_record_throughput(directory):
+    '''Test the average upload throughput.'''
+    outbox = Outbox(f"{directory}outbox.yaml")
+    assert outbox.throughput is None
+    outbox.record_throughput(1000, 1)
+    assert outbox.throughput == 1000
+    outbox.record_throughput(3000, 1)
+    assert outbox.throughput == 2000
+    outbox.save()
+    assert Outbox(f"{directory}outbox.yaml").throughput == 2000
@@ -0,0 +1,56 @@
+import logging
+import math
+from time import sleep
+from sampler import RingBuffer, Sampler
+
+def test_ring_buffer():
+    '''Test that the oldest samples are overwritten if the buffer is full.'''
+    buffer = RingBuffer(["voltage", "current"], 3)
+    for i in range(5):
+        buffer.append(i, [12.0 + i, None if i % 2 else 0.5])
+
+    assert [row[0] for row in buffer.rows()] == [2.0, 3.0, 4.0]
+    assert math.isnan(buffer.rows()[1][2])
+    assert buffer.summary() == {'voltage': {'min': 14.0, 'max': 16.0, 'mean': 15.0, 'count': 3},
+                                'current': {'min': 0.5, 'max': 0.5, 'mean': 0.5, 'count': 2}}
+
+def test_to_bytes():
+    '''Test that concatenated blocks can be read again.'''
+    buffer = RingBuffer(["voltage"], 10)
+    buffer.append(0.0, [12.5])
+    buffer.append(0.5, [12.25])
+    data = buffer.to_bytes()
+    assert len(data) == 10 + len("voltage") + 2 * 2 * 4
+
+    blocks = RingBuffer.from_bytes(data + data)
+    assert len(blocks) == 2
+    assert blocks[1] == {'channels': ["voltage"], 'samples': [(0.0, 12.5), (0.5, 12.25)]}
+
+def test_sampler(caplog):
+    '''Test sampling in the background without the info messages of the readings.'''
+    readings = []
+    def get_voltage():
+        logging.info("Battery voltage: 12.0 V")
+        readings.append(12.0)
+        return 12.0
+
+    def get_signal_quality():
+        raise Exception("Serial connection closed")
+
+    sampler = Sampler(interval=0.01, max_duration=10)
+    sampler.add_channel("battery_voltage", get_voltage)
+    sampler.add_channel("signal_quality", get_signal_quality, every=5)
+
+    with caplog.at_level(logging.INFO):
+        sampler.start()
+        sleep(0.2)
+        sampler.stop()
+        logging.info("Sampling stopped")
+
+    summary = sampler.summary()
+    assert summary['samples'] == len(readings) > 5
+    assert summary['battery_voltage']['mean'] == 12.0
+    assert 'signal_quality' not in summary
+    assert "Battery voltage: 12.0 V" not in caplog.text
+    assert "Serial connection closed" in caplog.text
+    assert "Sampling stopped" in caplog.text
@@ -102,3 +102,12 @@ def test_save_to_file():
     os.remove(temp_filename)
 
     assert saved_settings == settings.settings
+
+def test_get_hash():
+    """Test that the hash only changes if the effective settings change"""
+    settings = Settings()
+    other_settings = Settings()
+    assert settings.get_hash() == other_settings.get_hash()
+
+    settings.set('cameraName', 'NewCamera')
+    assert settings.get_hash() != other_settings.get_hash()
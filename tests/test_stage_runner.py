@@ -0,0 +1,71 @@
+from time import sleep, monotonic
+import pytest
+from stage_runner import StageRunner
+
+def test_run_in_dependency_order():
+    '''Test that a stage only runs after its dependencies have finished.'''
+    order = []
+    runner = StageRunner()
+    runner.add("first", lambda: (sleep(0.1), order.append("first")))
+    runner.add("second", lambda: order.append("second"), after=["first"])
+    runner.add("third", lambda: order.append("third"), after=["second"])
+    runner.run()
+    assert order == ["first", "second", "third"]
+
+def test_run_independent_stages_concurrently():
+    '''Test that independent stages run at the same time.'''
+    runner = StageRunner()
+    runner.add("first", lambda: sleep(0.3))
+    runner.add("second", lambda: sleep(0.3))
+    runner.add("third", lambda: sleep(0.3))
+
+    start = monotonic()
+    runner.run()
+    assert monotonic() - start < 0.6
+
+def test_failing_stage_does_not_stop_others():
+    '''Test that a failing stage does not prevent the dependent stages from running.'''
+    order = []
+
+    def fail():
+        raise RuntimeError("Test error")
+
+    runner = StageRunner()
+    runner.add("first", fail)
+    runner.add("second", lambda: order.append("second"), after=["first"])
+    runner.run()
+    assert order == ["second"]
+
+def test_unknown_dependency():
+    '''Test adding a stage with an unknown dependency.'''
+    runner = StageRunner()
+    with pytest.raises(ValueError):
+        runner.add("first", lambda: None, after=["unknown"])
+
+def test_timings():
+    '''Test that the duration of each stage is recorded.'''
+    runner = StageRunner()
+    runner.add("first", lambda: sleep(0.1))
+    runner.add("second", lambda: None, after=["first"])
+    runner.run()
+    assert set(runner.timings) == {"first", "second"}
+    assert runner.timings["first"] >= 0.1
+    assert runner.timings["second"] < 0.1
+
+def test_skip_optional_stage_near_deadline():
+    '''Test that optional stages are skipped if there is not enough time left.'''
+    order = []
+    runner = StageRunner(deadline=monotonic() + 1)
+    runner.add("critical", lambda: order.append("critical"), cost=10)
+    runner.add("optional", lambda: order.append("optional"), priority=StageRunner.OPTIONAL, cost=10)
+    runner.add("cheap", lambda: order.append("cheap"), priority=StageRunner.OPTIONAL, cost=0.1)
+    runner.add("last", lambda: order.append("last"), after=["optional"])
+    runner.run()
+    assert sorted(order) == ["cheap", "critical", "last"]
+    assert runner.skipped == ["optional"]
+    assert "optional" not in runner.timings
+
+def test_remaining():
+    '''Test the remaining time until the deadline.'''
+    assert StageRunner().remaining() == float('inf')
+    assert 9 < StageRunner(deadline=monotonic() + 10).remaining() <= 10
@@ -0,0 +1,209 @@
+from io import BytesIO
+from os import path, makedirs, listdir, remove, replace
+from email.utils import formatdate
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from threading import Thread
+from urllib.parse import unquote, urlsplit
+import pytest
+from transport import Transport, create_transport, AuthenticationError
+from fileserver import FileServer
+
+class WebDAVHandler(BaseHTTPRequestHandler):
+    '''A minimal WebDAV server with Basic authentication serving a directory.'''
+    protocol_version = "HTTP/1.1"
+    root = None
+    requests = []
+    content_range = True # Servers which do not support Content-Range replace the whole file
+
+    def log_message(self, *args):
+        pass
+
+    def __path(self):
+        return path.join(self.root, unquote(self.path).lstrip("/"))
+
+    def __respond(self, status, body=b'', headers=None):
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def __authorized(self):
+        self.requests.append(self.command)
+        if self.headers.get("Authorization") != "Basic dXNlcjpwYXNzd29yZA==": # user:password
+            self.__respond(401)
+            return False
+        return True
+
+    def do_PROPFIND(self):
+        if not self.__authorized():
+            return
+        local_path = self.__path()
+        if not path.exists(local_path):
+            return self.__respond(404)
+        entries = [""] + (listdir(local_path) if self.headers.get("Depth") == "1" else [])
+        body = '<?xml version="1.0"?><D:multistatus xmlns:D="DAV:">'
+        for name in entries:
+            entry_path = path.join(local_path, name)
+            resource_type = "<D:collection/>" if path.isdir(entry_path) else ""
+            body += (f"<D:response><D:href>{self.path.rstrip('/')}/{name}</D:href><D:propstat><D:prop>"
+                     f"<D:resourcetype>{resource_type}</D:resourcetype><D:getcontentlength>{path.getsize(entry_path)}</D:getcontentlength>"
+                     f"<D:getlastmodified>{formatdate(path.getmtime(entry_path), usegmt=True)}</D:getlastmodified></D:prop></D:propstat></D:response>")
+        self.__respond(207, (body + "</D:multistatus>").encode())
+
+    def do_MKCOL(self):
+        if self.__authorized():
+            makedirs(self.__path())
+            self.__respond(201)
+
+    def do_HEAD(self):
+        if not self.__authorized():
+            return
+        if not path.isfile(self.__path()):
+            return self.__respond(404)
+        self.send_response(200)
+        self.send_header("Content-Length", str(path.getsize(self.__path())))
+        self.send_header("Last-Modified", formatdate(path.getmtime(self.__path()), usegmt=True))
+        self.end_headers()
+
+    def do_GET(self):
+        if not self.__authorized():
+            return
+        with open(self.__path(), 'rb') as f:
+            data = f.read()
+        if "Range" in self.headers:
+            return self.__respond(206, data[int(self.headers["Range"][6:-1]):])
+        self.__respond(200, data)
+
+    def do_DELETE(self):
+        if not self.__authorized():
+            return
+        if not path.isfile(self.__path()):
+            return self.__respond(404)
+        remove(self.__path())
+        self.__respond(204)
+
+    def do_MOVE(self):
+        if not self.__authorized():
+            return
+        if not path.isfile(self.__path()):
+            return self.__respond(404)
+        replace(self.__path(), path.join(self.root, unquote(urlsplit(self.headers["Destination"]).path).lstrip("/")))
+        self.__respond(204)
+
+    def do_PUT(self):
+        if not self.__authorized():
+            return
+        data = self.rfile.read(int(self.headers["Content-Length"]))
+        offset = int(self.headers["Content-Range"].split()[1].split("-")[0]) if "Content-Range" in self.headers and self.content_range else 0
+        with open(self.__path(), 'r+b' if offset else 'wb') as f:
+            f.seek(offset)
+            f.write(data)
+        self.__respond(201 if not offset else 204)
+
+@pytest.fixture(params=["local", "http"])
+def server(request, tmp_path):
+    '''Return the protocol and address of an empty file server.'''
+    root = tmp_path / "server"
+    root.mkdir()
+
+    if request.param == "local":
+        yield "local", str(root)
+        return
+
+    WebDAVHandler.root = str(root)
+    WebDAVHandler.requests = []
+    WebDAVHandler.content_range = True
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), WebDAVHandler)
+    Thread(target=httpd.serve_forever, daemon=True).start()
+    yield "http", f"127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+
+def test_transport(server):
+    '''Test the operations of the transports.'''
+    protocol, address = server
+    transport = create_transport(protocol)
+    transport.connect(address, "user", "password", 5)
+
+    transport.mkd("save")
+    transport.cwd("save")
+    transport.put("image.jpg", BytesIO(b'0123'))
+    transport.put("image.jpg", BytesIO(b'456789'), offset=4) # Resumed upload
+    transport.append("image.jpg", BytesIO(b'abc'))
+    assert transport.size("image.jpg") == 13
+
+    assert transport.list()["image.jpg"]['size'] == "13"
+    assert transport.mtime("image.jpg").year >= 2024
+
+    data = BytesIO()
+    transport.get("image.jpg", data.write, offset=10)
+    assert data.getvalue() == b'abc'
+
+    transport.put("old.jpg", BytesIO(b'0'))
+    transport.delete("old.jpg")
+    assert "old.jpg" not in transport.list()
+
+    transport.put("new.jpg", BytesIO(b'0'))
+    transport.rename("new.jpg", "image.jpg") # Replaces the existing file
+    assert sorted(transport.list()) == ["image.jpg"]
+    assert transport.size("image.jpg") == 1
+
+    transport.cwd("..")
+    assert transport.list()["save"]['type'] == "dir"
+    with pytest.raises(Exception):
+        transport.size("missing.jpg")
+    transport.close()
+
+def test_fileserver_with_transport(server, tmp_path):
+    '''Test the file server with other protocols than FTP.'''
+    protocol, address = server
+    fileserver = FileServer(address, "user", "password", f"{tmp_path}/uploads.yaml", protocol=protocol)
+    assert fileserver.connected()
+
+    fileserver.change_directory("save", create=True)
+    assert fileserver.upload_file_from_bytes("image.jpg", BytesIO(b'0' * 20000))
+    assert fileserver.append_file_from_bytes("log.txt", BytesIO(b'log'))
+    assert fileserver.append_file_from_bytes("log.txt", BytesIO(b'log'))
+    assert sorted(fileserver.list_files()) == ["image.jpg", "log.txt"]
+    assert fileserver.get_file_as_bytes("log.txt").getvalue() == b'loglog'
+    fileserver.quit()
+
+def test_http_without_content_range(tmp_path):
+    '''Test that an append fails if the server replaced the file instead of appending to it.'''
+    WebDAVHandler.root = str(tmp_path)
+    WebDAVHandler.content_range = False
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), WebDAVHandler)
+    Thread(target=httpd.serve_forever, daemon=True).start()
+
+    transport = create_transport("http")
+    transport.connect(f"127.0.0.1:{httpd.server_address[1]}", "user", "password", 5)
+    transport.put("log.txt", BytesIO(b'old'))
+    with pytest.raises(Exception):
+        transport.append("log.txt", BytesIO(b'new'))
+    transport.close()
+    WebDAVHandler.content_range = True
+    httpd.shutdown()
+
+def test_http_auth_failed(tmp_path):
+    '''Test that a wrong password is reported as authentication error.'''
+    WebDAVHandler.root = str(tmp_path)
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), WebDAVHandler)
+    Thread(target=httpd.serve_forever, daemon=True).start()
+
+    with pytest.raises(AuthenticationError):
+        create_transport("http").connect(f"127.0.0.1:{httpd.server_address[1]}", "user", "wrong", 5)
+
+    fileserver = FileServer(f"127.0.0.1:{httpd.server_address[1]}", "user", "wrong", f"{tmp_path}/uploads.yaml", protocol="http")
+    assert fileserver.connect_outcome == "auth_failed"
+    httpd.shutdown()
+
+def test_transport_is_abstract():
+    '''Test that a transport has to implement all operations.'''
+    with pytest.raises(TypeError):
+        Transport()
+
+def test_unknown_protocol():
+    '''Test that an unknown protocol is rejected.'''
+    with pytest.raises(ValueError):
+        create_transport("gopher")
@@ -274,3 +274,61 @@ def test_generate_invalid_schedule():
 
     # Delete schedule file
     remove(witty_pi.SCHEDULE_FILE_PATH)
+
+def test_get_remaining_on_time():
+    '''Test the remaining time until the power is cut.'''
+    witty_pi = WittyPi4()
+    assert witty_pi.get_remaining_on_time() < witty_pi.MAX_DURATION_MINUTES * 60
+
+UTILITIES_SH = '''
+get_temperature() { echo "21.5°C / 70.7°F"; }
+get_low_voltage_threshold() { echo "disabled"; }
+count() { COUNT=$((COUNT+1)); echo $COUNT; }
+fail() { echo "failed"; return 1; }
+quit() { exit 1; }
+'''
+
+def test_coprocess(tmp_path):
+    '''Test running the commands in one shell which is kept open.'''
+    with open(tmp_path / "utilities.sh", "w", encoding="utf-8") as file:
+        file.write(UTILITIES_SH)
+
+    witty_pi = WittyPi4("coprocess")
+    witty_pi.WITTYPI_DIRECTORY = str(tmp_path)
+    assert witty_pi.get_temperature() == 21.5
+    assert witty_pi.get_low_voltage_threshold() == 0.0
+    assert [witty_pi.run_command("count") for _ in range(2)] == ["1", "2"] # Same shell
+    assert witty_pi.run_command("fail") == "ERROR"
+    assert witty_pi.run_command("count") == "3"
+    assert witty_pi.run_command("quit") == "ERROR"
+    assert witty_pi.run_command("count") == "1" # Restarted
+    witty_pi.close()
+
+class FakeSMBus:
+    '''Registers of the Witty Pi 4 microcontroller.'''
+
+    def __init__(self):
+        self.registers = {1: 12, 2: 34, 3: 5, 4: 1, 5: 0, 6: 40, 19: 255, 22: 75, 50: 0x40FA} # -5.75 °C
+
+    def read_byte_data(self, address, register):
+        return self.registers[register]
+
+    def read_word_data(self, address, register):
+        return self.registers[register]
+
+    def write_byte_data(self, address, register, value):
+        self.registers[register] = value
+
+def test_i2c():
+    '''Test reading the registers of the Witty Pi 4 directly.'''
+    witty_pi = WittyPi4("i2c")
+    witty_pi.backend = "i2c"
+    witty_pi.bus = FakeSMBus()
+    assert witty_pi.get_battery_voltage() == 12.34
+    assert witty_pi.get_internal_voltage() == 5.01
+    assert witty_pi.get_internal_current() == 0.4
+    assert witty_pi.get_temperature() == -5.75
+    assert witty_pi.get_low_voltage_threshold() == 0.0
+    assert witty_pi.get_recovery_voltage_threshold() == 7.5
+    assert witty_pi.set_low_voltage_threshold(7.0)
+    assert witty_pi.bus.registers[19] == 70
@@ -0,0 +1,467 @@
+"""Protocols used by the file server to list, download and upload files (FTP, SFTP, HTTP(S) and a local directory)."""
+from abc import ABC, abstractmethod
+from ftplib import FTP, error_perm, error_temp
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from base64 import b64encode
+from urllib.parse import quote, unquote, urlsplit
+from xml.etree import ElementTree
+from os import path, makedirs, scandir, remove, replace
+import http.client
+import logging
+import posixpath
+import socket
+import stat
+
+class AuthenticationError(Exception):
+    """The file server rejected the username or password. Retrying does not help."""
+
+class Transport(ABC):
+    """Base class of the protocols. Paths are relative to the current directory of the transport.
+    Modification times are naive datetimes in UTC and listed as YYYYMMDDHHMMSS like FTP MLSD."""
+
+    RESOLVE_HOST = True # Resolve the host name once before connecting
+
+    @abstractmethod
+    def connect(self, address: str, username: str, password: str, timeout: float) -> None:
+        """Connect and log in to the file server."""
+
+    @abstractmethod
+    def cwd(self, directory: str) -> None:
+        """Change the current directory."""
+
+    @abstractmethod
+    def pwd(self) -> str:
+        """Return the current directory."""
+
+    @abstractmethod
+    def mkd(self, directory: str) -> None:
+        """Create a directory."""
+
+    @abstractmethod
+    def list(self, directory: str = None) -> dict:
+        """List the files in the current or specified directory with their facts (type, size and modify, as far as available)."""
+
+    @abstractmethod
+    def get(self, filename: str, write, offset: int = 0, block_size: int = 8192) -> None:
+        """Download a file from offset and call write with every block."""
+
+    @abstractmethod
+    def put(self, filename: str, file_data, offset: int = 0, block_size: int = 8192, callback = None) -> None:
+        """Upload a file object from its current position. The file on the server is overwritten if offset is 0,
+        otherwise the data is written from offset on. callback is called with every block sent."""
+
+    @abstractmethod
+    def append(self, filename: str, file_data, block_size: int = 8192, callback = None) -> None:
+        """Append a file object from its current position to a file on the server."""
+
+    @abstractmethod
+    def delete(self, filename: str) -> None:
+        """Delete a file."""
+
+    @abstractmethod
+    def rename(self, filename: str, new_filename: str) -> None:
+        """Rename a file. An existing file with the new name is replaced."""
+
+    @abstractmethod
+    def size(self, filename: str) -> int:
+        """Return the size of a file in bytes. Raises an exception if the file does not exist."""
+
+    @abstractmethod
+    def mtime(self, filename: str) -> datetime:
+        """Return the last modification time of a file."""
+
+    def close(self) -> None:
+        """Close the connection."""
+
+    @staticmethod
+    def _format_time(timestamp: float) -> str:
+        """Format a POSIX timestamp like the modify fact of MLSD."""
+        return datetime.fromtimestamp(timestamp, timezone.utc).strftime('%Y%m%d%H%M%S')
+
+    @staticmethod
+    def _copy(source, write, block_size: int, callback = None) -> None:
+        """Copy a file object in blocks."""
+        while block := source.read(block_size):
+            write(block)
+            if callback is not None:
+                callback(block)
+
+###########################
+# FTP
+###########################
+class FTPTransport(Transport):
+    """Plain FTP with ftplib. Uses MLSD for listings if the server supports it."""
+
+    def __init__(self) -> None:
+        self.ftp = None
+        self.mlsd_supported = True
+
+    def connect(self, address: str, username: str, password: str, timeout: float) -> None:
+        self.ftp = FTP(timeout=timeout)
+        self.ftp.connect(address)
+        try:
+            self.ftp.login(username, password)
+        except error_perm as e:
+            raise AuthenticationError(str(e)) from e
+
+    def cwd(self, directory: str) -> None:
+        self.ftp.cwd(directory)
+
+    def pwd(self) -> str:
+        return self.ftp.pwd()
+
+    def mkd(self, directory: str) -> None:
+        self.ftp.mkd(directory)
+
+    def list(self, directory: str = None) -> dict:
+        if self.mlsd_supported:
+            try:
+                return {name: facts for name, facts in self.ftp.mlsd(directory or "", ["type", "size", "modify"])
+                        if facts.get('type') not in ('cdir', 'pdir')}
+            except error_perm: # MLSD is not supported by the server
+                self.mlsd_supported = False
+
+        return {posixpath.basename(name): {} for name in self.ftp.nlst(*([directory] if directory else []))}
+
+    def get(self, filename: str, write, offset: int = 0, block_size: int = 8192) -> None:
+        self.ftp.retrbinary(f"RETR {filename}", write, block_size, rest=offset or None)
+
+    def __store(self, command: str, file_data, block_size: int, callback) -> str:
+        """Send a file object on a data connection like FTP.storbinary. If the transfer is interrupted (e.g. by the callback),
+        the reply of the transfer is read, so the next command does not receive it as its reply."""
+        self.ftp.voidcmd("TYPE I")
+        connection = self.ftp.transfercmd(command)
+        try:
+            self._copy(file_data, connection.sendall, block_size, callback)
+        except Exception:
+            connection.close()
+            try:
+                self.ftp.getresp() # 226 or 426 after the data connection was closed
+            except (error_temp, error_perm):
+                pass
+            except Exception as e:
+                logging.warning("Could not read the reply of the interrupted transfer: %s", str(e))
+            raise
+
+        connection.close()
+        return self.ftp.voidresp()
+
+    def put(self, filename: str, file_data, offset: int = 0, block_size: int = 8192, callback = None) -> None:
+        # Resumed uploads are appended, as APPE is supported by more servers than REST with STOR
+        response = self.__store(f"{'APPE' if offset > 0 else 'STOR'} {filename}", file_data, block_size, callback)
+        if not response.startswith('226'):
+            raise Exception(f"Failed to upload file: {response}")
+
+    def append(self, filename: str, file_data, block_size: int = 8192, callback = None) -> None:
+        self.__store(f"APPE {filename}", file_data, block_size, callback)
+
+    def delete(self, filename: str) -> None:
+        self.ftp.delete(filename)
+
+    def rename(self, filename: str, new_filename: str) -> None:
+        try:
+            self.ftp.rename(filename, new_filename)
+        except error_perm: # Some servers do not replace existing files
+            self.ftp.delete(new_filename)
+            self.ftp.rename(filename, new_filename)
+
+    def size(self, filename: str) -> int:
+        self.ftp.voidcmd("TYPE I") # SIZE is not allowed in ASCII mode by some servers
+        return self.ftp.size(filename)
+
+    def mtime(self, filename: str) -> datetime:
+        response = self.ftp.sendcmd(f"MDTM {filename}")
+        return datetime.strptime(response[4:18], '%Y%m%d%H%M%S')
+
+    def close(self) -> None:
+        try:
+            self.ftp.quit()
+        except Exception:
+            self.ftp.close()
+
+###########################
+# SFTP
+###########################
+class SFTPTransport(Transport):
+    """SFTP with paramiko (optional dependency, only imported if SFTP is used)."""
+
+    PORT = 22
+
+    def __init__(self) -> None:
+        self.ssh = None
+        self.sftp = None
+
+    def connect(self, address: str, username: str, password: str, timeout: float) -> None:
+        import paramiko
+
+        self.ssh = paramiko.Transport(socket.create_connection((address, self.PORT), timeout=timeout))
+        try:
+            self.ssh.connect(username=username, password=password)
+        except paramiko.AuthenticationException as e:
+            self.ssh.close()
+            raise AuthenticationError(str(e)) from e
+
+        self.sftp = paramiko.SFTPClient.from_transport(self.ssh)
+        self.sftp.get_channel().settimeout(timeout)
+        self.sftp.chdir(".")
+
+    def cwd(self, directory: str) -> None:
+        self.sftp.chdir(directory)
+
+    def pwd(self) -> str:
+        return self.sftp.getcwd()
+
+    def mkd(self, directory: str) -> None:
+        self.sftp.mkdir(directory)
+
+    def list(self, directory: str = None) -> dict:
+        return {attributes.filename: {'type': 'dir' if stat.S_ISDIR(attributes.st_mode) else 'file',
+                                      'size': str(attributes.st_size), 'modify': self._format_time(attributes.st_mtime)}
+                for attributes in self.sftp.listdir_attr(directory or ".")}
+
+    def get(self, filename: str, write, offset: int = 0, block_size: int = 8192) -> None:
+        with self.sftp.open(filename, 'rb') as remote_file:
+            remote_file.seek(offset)
+            self._copy(remote_file, write, block_size)
+
+    def put(self, filename: str, file_data, offset: int = 0, block_size: int = 8192, callback = None) -> None:
+        with self.sftp.open(filename, 'r+b' if offset > 0 else 'wb') as remote_file:
+            remote_file.seek(offset)
+            self._copy(file_data, remote_file.write, block_size, callback)
+
+    def append(self, filename: str, file_data, block_size: int = 8192, callback = None) -> None:
+        with self.sftp.open(filename, 'ab') as remote_file:
+            self._copy(file_data, remote_file.write, block_size, callback)
+
+    def delete(self, filename: str) -> None:
+        self.sftp.remove(filename)
+
+    def rename(self, filename: str, new_filename: str) -> None:
+        try:
+            self.sftp.posix_rename(filename, new_filename)
+        except IOError: # The posix-rename extension is not supported, SFTP rename does not replace existing files
+            self.sftp.remove(new_filename)
+            self.sftp.rename(filename, new_filename)
+
+    def size(self, filename: str) -> int:
+        return self.sftp.stat(filename).st_size
+
+    def mtime(self, filename: str) -> datetime:
+        return datetime.strptime(self._format_time(self.sftp.stat(filename).st_mtime), '%Y%m%d%H%M%S')
+
+    def close(self) -> None:
+        self.sftp.close()
+        self.ssh.close()
+
+###########################
+# HTTP(S)
+###########################
+class HTTPTransport(Transport):
+    """WebDAV over HTTP(S) with a single keep-alive connection. Partial uploads use PUT with Content-Range
+    and partial downloads use GET with Range."""
+
+    RESOLVE_HOST = False # The host name is needed to verify the certificate
+
+    def __init__(self, secure: bool = True) -> None:
+        self.secure = secure
+        self.connection = None
+        self.headers = {}
+        self.directory = "/"
+
+    def connect(self, address: str, username: str, password: str, timeout: float) -> None:
+        url = urlsplit(address if "://" in address else f"//{address}")
+        connection_class = http.client.HTTPSConnection if self.secure else http.client.HTTPConnection
+        self.connection = connection_class(url.netloc, timeout=timeout)
+        self.headers = {'Authorization': "Basic " + b64encode(f"{username}:{password}".encode()).decode()}
+        self.directory = posixpath.join("/", url.path or "/")
+        self.__request("PROPFIND", self.directory, headers={'Depth': "0"}, expected=(207,))
+
+    def __url(self, filename: str = "") -> str:
+        return quote(posixpath.normpath(posixpath.join(self.directory, filename)))
+
+    def __request(self, method: str, url: str, body = None, headers: dict = None, expected: tuple = (200,), read: bool = True):
+        """Send a request on the keep-alive connection and check the status of the response."""
+        self.connection.request(method, url, body=body, headers={**self.headers, **(headers or {})})
+        response = self.connection.getresponse()
+
+        if response.status in (401, 403):
+            response.read()
+            raise AuthenticationError(f"{response.status} {response.reason}")
+        if response.status == 404:
+            response.read()
+            raise FileNotFoundError(f"{url} not found")
+        if response.status not in expected:
+            response.read()
+            raise Exception(f"{method} {url} failed: {response.status} {response.reason}")
+
+        if read:
+            response.read() # The connection can only be reused after the response was read
+        return response
+
+    def cwd(self, directory: str) -> None:
+        self.__request("PROPFIND", self.__url(directory) + "/", headers={'Depth': "0"}, expected=(207,))
+        self.directory = posixpath.normpath(posixpath.join(self.directory, directory))
+
+    def pwd(self) -> str:
+        return self.directory
+
+    def mkd(self, directory: str) -> None:
+        self.__request("MKCOL", self.__url(directory), expected=(201,))
+
+    def list(self, directory: str = None) -> dict:
+        url = self.__url(directory or "") + "/"
+        response = self.__request("PROPFIND", url, headers={'Depth': "1"}, expected=(207,), read=False)
+        tree = ElementTree.fromstring(response.read())
+
+        entries = {}
+        for item in tree.findall("{DAV:}response"):
+            href = unquote(urlsplit(item.findtext("{DAV:}href", "")).path).rstrip("/")
+            if href == url.rstrip("/") or not href:
+                continue # The directory itself
+
+            prop = item.find("{DAV:}propstat/{DAV:}prop")
+            facts = {'type': 'dir' if prop is not None and prop.find("{DAV:}resourcetype/{DAV:}collection") is not None else 'file'}
+            if prop is not None and prop.findtext("{DAV:}getcontentlength"):
+                facts['size'] = prop.findtext("{DAV:}getcontentlength")
+            if prop is not None and prop.findtext("{DAV:}getlastmodified"):
+                facts['modify'] = self._format_time(parsedate_to_datetime(prop.findtext("{DAV:}getlastmodified")).timestamp())
+            entries[posixpath.basename(href)] = facts
+
+        return entries
+
+    def get(self, filename: str, write, offset: int = 0, block_size: int = 8192) -> None:
+        headers = {'Range': f"bytes={offset}-"} if offset > 0 else {}
+        response = self.__request("GET", self.__url(filename), headers=headers, expected=(200, 206), read=False)
+        if offset > 0 and response.status == 200:
+            response.read(offset) # Range not supported by the server
+        self._copy(response, write, block_size)
+
+    def __put(self, filename: str, file_data, offset: int, block_size: int, callback) -> None:
+        """Upload the rest of a file object to the server from offset on."""
+        start = file_data.tell()
+        file_data.seek(0, 2)
+        length = file_data.tell() - start
+        file_data.seek(start)
+
+        headers = {'Content-Length': str(length)}
+        if offset > 0:
+            headers['Content-Range'] = f"bytes {offset}-{offset + length - 1}/*"
+
+        class Reader:
+            """Report the progress while the body is sent."""
+            def read(self, size: int = block_size) -> bytes:
+                block = file_data.read(min(size, block_size))
+                if block and callback is not None:
+                    callback(block)
+                return block
+
+        self.connection.blocksize = block_size
+        self.__request("PUT", self.__url(filename), body=Reader(), headers=headers, expected=(200, 201, 204))
+
+        # Servers which ignore Content-Range replace the whole file with the data
+        if offset > 0 and self.size(filename) != offset + length:
+            raise Exception(f"{filename} was not written from byte {offset} on (Content-Range is not supported by the server)")
+
+    def put(self, filename: str, file_data, offset: int = 0, block_size: int = 8192, callback = None) -> None:
+        self.__put(filename, file_data, offset, block_size, callback)
+
+    def append(self, filename: str, file_data, block_size: int = 8192, callback = None) -> None:
+        try:
+            offset = self.size(filename)
+        except FileNotFoundError:
+            offset = 0
+        self.__put(filename, file_data, offset, block_size, callback)
+
+    def delete(self, filename: str) -> None:
+        self.__request("DELETE", self.__url(filename), expected=(200, 202, 204))
+
+    def rename(self, filename: str, new_filename: str) -> None:
+        destination = f"{'https' if self.secure else 'http'}://{self.connection.host}:{self.connection.port}{self.__url(new_filename)}"
+        self.__request("MOVE", self.__url(filename), headers={'Destination': destination, 'Overwrite': "T"}, expected=(201, 204))
+
+    def size(self, filename: str) -> int:
+        return int(self.__request("HEAD", self.__url(filename)).getheader('Content-Length'))
+
+    def mtime(self, filename: str) -> datetime:
+        modified = parsedate_to_datetime(self.__request("HEAD", self.__url(filename)).getheader('Last-Modified'))
+        return modified.astimezone(timezone.utc).replace(tzinfo=None)
+
+    def close(self) -> None:
+        self.connection.close()
+
+###########################
+# Local directory
+###########################
+class LocalTransport(Transport):
+    """A directory on the local file system (e.g. a mounted network share, for tests or benchmarks).
+    The address is the path of the directory."""
+
+    RESOLVE_HOST = False
+
+    def __init__(self) -> None:
+        self.directory = None
+
+    def connect(self, address: str, username: str, password: str, timeout: float) -> None:
+        if not path.isdir(address):
+            raise FileNotFoundError(f"Directory {address} does not exist")
+        self.directory = path.abspath(address)
+
+    def __path(self, filename: str = "") -> str:
+        return path.normpath(path.join(self.directory, filename))
+
+    def cwd(self, directory: str) -> None:
+        if not path.isdir(self.__path(directory)):
+            raise FileNotFoundError(f"Directory {directory} does not exist")
+        self.directory = self.__path(directory)
+
+    def pwd(self) -> str:
+        return self.directory
+
+    def mkd(self, directory: str) -> None:
+        makedirs(self.__path(directory))
+
+    def list(self, directory: str = None) -> dict:
+        with scandir(self.__path(directory or "")) as entries:
+            return {entry.name: {'type': 'dir' if entry.is_dir() else 'file', 'size': str(entry.stat().st_size),
+                                 'modify': self._format_time(entry.stat().st_mtime)} for entry in entries}
+
+    def get(self, filename: str, write, offset: int = 0, block_size: int = 8192) -> None:
+        with open(self.__path(filename), 'rb') as local_file:
+            local_file.seek(offset)
+            self._copy(local_file, write, block_size)
+
+    def put(self, filename: str, file_data, offset: int = 0, block_size: int = 8192, callback = None) -> None:
+        with open(self.__path(filename), 'r+b' if offset > 0 else 'wb') as local_file:
+            local_file.seek(offset)
+            self._copy(file_data, local_file.write, block_size, callback)
+
+    def append(self, filename: str, file_data, block_size: int = 8192, callback = None) -> None:
+        with open(self.__path(filename), 'ab') as local_file:
+            self._copy(file_data, local_file.write, block_size, callback)
+
+    def delete(self, filename: str) -> None:
+        remove(self.__path(filename))
+
+    def rename(self, filename: str, new_filename: str) -> None:
+        replace(self.__path(filename), self.__path(new_filename))
+
+    def size(self, filename: str) -> int:
+        return path.getsize(self.__path(filename))
+
+    def mtime(self, filename: str) -> datetime:
+        return datetime.strptime(self._format_time(path.getmtime(self.__path(filename))), '%Y%m%d%H%M%S')
+
+TRANSPORTS = {
+    'ftp': FTPTransport,
+    'sftp': SFTPTransport,
+    'http': lambda: HTTPTransport(secure=False),
+    'https': HTTPTransport,
+    'local': LocalTransport,
+}
+
+def create_transport(protocol: str = "ftp") -> Transport:
+    """Create the transport of a protocol (ftp, sftp, http, https or local)."""
+    if protocol not in TRANSPORTS:
+        raise ValueError(f"Unknown protocol {protocol}")
+    return TRANSPORTS[protocol]()
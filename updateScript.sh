@@ -5,3 +5,8 @@ wget -O /home/pi/witty_pi_4.py https://raw.githubusercontent.com/Eagleshot/Glaci
 wget -O /home/pi/settings.py https://raw.githubusercontent.com/Eagleshot/GlacierCam/main/settings.py
 wget -O /home/pi/fileserver.py https://raw.githubusercontent.com/Eagleshot/GlacierCam/main/fileserver.py
 wget -O /home/pi/data.py https://raw.githubusercontent.com/Eagleshot/GlacierCam/main/data.py
+wget -O /home/pi/stage_runner.py https://raw.githubusercontent.com/Eagleshot/GlacierCam/main/stage_runner.py
+wget -O /home/pi/outbox.py https://raw.githubusercontent.com/Eagleshot/GlacierCam/main/outbox.py
+wget -O /home/pi/encoding_policy.py https://raw.githubusercontent.com/Eagleshot/GlacierCam/main/encoding_policy.py
+wget -O /home/pi/transport.py https://raw.githubusercontent.com/Eagleshot/GlacierCam/main/transport.py
+wget -O /home/pi/sampler.py https://raw.githubusercontent.com/Eagleshot/GlacierCam/main/sampler.py
@@ -1,19 +1,60 @@
 '''A python module for interacting with the Witty Pi 4 board.'''
-from subprocess import check_output, STDOUT
+from subprocess import check_output, CalledProcessError, Popen, PIPE, STDOUT
 from datetime import time, datetime
-from time import sleep
-from os import path
+from time import sleep, monotonic
+from os import path, read
+from threading import Lock
 import logging
+import select
 import suntime
 
 class WittyPi4:
-    '''A class for interacting with the Witty Pi 4 board.'''
+    '''A class for interacting with the Witty Pi 4 board.
+    The commands of utilities.sh are run in a new shell each time (shell), in one shell which is kept open (coprocess)
+    or the readings are read from the registers of the microcontroller directly (i2c).'''
 
     # Setup
     WITTYPI_DIRECTORY = "/home/pi/wittypi"
     SCHEDULE_FILE_PATH = f"{WITTYPI_DIRECTORY}/schedule.wpi"
+    LOCK = Lock() # Only one command at a time can use the I2C bus (e.g. while a background sampler reads the sensors)
+    BACKENDS = ["shell", "coprocess", "i2c"]
+    COMMAND_TIMEOUT = 3 # Seconds
+    END_MARKER = "__glaciercam_command_done__" # Printed with the exit status after each command in the coprocess
+
+    # I2C registers of the Witty Pi 4 microcontroller (see utilities.sh)
+    I2C_BUS = 1
+    I2C_MC_ADDRESS = 0x08
+    I2C_READINGS = { # Registers of the integer and decimal part
+        'get_input_voltage': (1, 2),
+        'get_output_voltage': (3, 4),
+        'get_output_current': (5, 6),
+    }
+    I2C_VOLTAGE_THRESHOLDS = { # In 0.1 V, 255 = disabled
+        'low_voltage_threshold': 19,
+        'recovery_voltage_threshold': 22,
+    }
+    I2C_LM75B_TEMPERATURE = 50
+
+    def __init__(self, backend: str = "shell"):
+        if backend not in self.BACKENDS:
+            logging.error("Unknown Witty Pi 4 backend %s, using the shell.", backend)
+            backend = "shell"
+
+        self.backend = backend
+        self.shell = None # Coprocess
+        self.bus = None
+
+        if backend == "i2c":
+            try:
+                try:
+                    from smbus2 import SMBus
+                except ImportError:
+                    from smbus import SMBus
+                self.bus = SMBus(self.I2C_BUS)
+            except Exception as e:
+                logging.warning("Could not open I2C bus, using a coprocess instead: %s", str(e))
+                self.backend = "coprocess"
 
-    def __init__(self):
         # Default schedule settings
         self.start_time = time(8, 0)
         self.end_time = time(20, 0)
@@ -32,13 +73,99 @@ class WittyPi4:
     def run_command(self, command: str) -> str:
         '''Run a Witty Pi 4 command'''
         try:
-            command = f"cd {self.WITTYPI_DIRECTORY} && . ./utilities.sh && {command}"
-            output = check_output(command, shell=True, executable="/bin/bash", stderr=STDOUT, universal_newlines=True, timeout=3)
+            with self.LOCK:
+                output = self.__run_i2c(command) if self.backend == "i2c" else None
+                if output is None and self.backend == "shell":
+                    output = check_output(f"cd {self.WITTYPI_DIRECTORY} && . ./utilities.sh && {command}", shell=True, executable="/bin/bash",
+                                          stderr=STDOUT, universal_newlines=True, timeout=self.COMMAND_TIMEOUT)
+                elif output is None:
+                    output = self.__run_in_coprocess(command)
             return output.strip()
         except Exception as e:
             logging.error("Could not run Witty Pi 4 command: %s", str(e))
         return "ERROR"
 
+    def __run_in_coprocess(self, command: str) -> str:
+        '''Run a command in a shell which is kept open, so bash is started and utilities.sh is sourced only once.
+        The shell is restarted after a timeout or if a command exits it.'''
+        try:
+            if self.shell is None or self.shell.poll() is not None:
+                self.shell = Popen(["/bin/bash"], stdin=PIPE, stdout=PIPE, stderr=STDOUT, cwd=self.WITTYPI_DIRECTORY)
+                self.__communicate(". ./utilities.sh")
+
+            return self.__communicate(command)
+        except CalledProcessError:
+            raise
+        except Exception:
+            self.close()
+            raise
+
+    def __communicate(self, command: str) -> str:
+        # The output of the command is followed by the end marker and the exit status
+        self.shell.stdin.write(f"{{ {command}\n}} </dev/null 2>&1; printf '\\n{self.END_MARKER} %s\\n' $?\n".encode('utf-8'))
+        self.shell.stdin.flush()
+
+        output = b""
+        end_marker = f"\n{self.END_MARKER} ".encode('utf-8')
+        deadline = monotonic() + self.COMMAND_TIMEOUT
+        while not (end_marker in output and output.endswith(b"\n")):
+            if not select.select([self.shell.stdout], [], [], max(deadline - monotonic(), 0))[0]:
+                raise TimeoutError(f"Command '{command}' timed out after {self.COMMAND_TIMEOUT} seconds")
+
+            data = read(self.shell.stdout.fileno(), 4096)
+            if not data:
+                raise EOFError(f"Shell exited while running '{command}'")
+            output += data
+
+        output, status = output.rsplit(end_marker, maxsplit=1)
+        output = output.decode('utf-8', errors='replace')
+        if int(status) != 0:
+            raise CalledProcessError(int(status), command, output)
+
+        return output
+
+    def __run_i2c(self, command: str) -> str:
+        '''Read or write a register of the microcontroller and return the same output as utilities.sh
+        or None if the command is not available over I2C (e.g. the time synchronization).'''
+        name, *arguments = command.split()
+
+        if name in self.I2C_READINGS:
+            integer, decimal = (self.bus.read_byte_data(self.I2C_MC_ADDRESS, register) for register in self.I2C_READINGS[name])
+            return str(round(integer + decimal / 100, 2))
+
+        if name == "get_temperature":
+            # LM75B: 11 bit two's complement in 0.125 °C, the most significant byte first
+            data = self.bus.read_word_data(self.I2C_MC_ADDRESS, self.I2C_LM75B_TEMPERATURE)
+            value = (((data & 0xFF) << 8) | (data >> 8)) >> 5
+            celsius = (value - 2048 if value >= 1024 else value) * 0.125
+            return f"{celsius}°C / {round(celsius * 1.8 + 32, 1)}°F"
+
+        action, _, threshold = name.partition("_")
+        if threshold in self.I2C_VOLTAGE_THRESHOLDS:
+            register = self.I2C_VOLTAGE_THRESHOLDS[threshold]
+            if action == "get":
+                value = self.bus.read_byte_data(self.I2C_MC_ADDRESS, register)
+                return "disabled" if value == 255 else f"{value / 10}V"
+            if action == "set" and len(arguments) == 1:
+                self.bus.write_byte_data(self.I2C_MC_ADDRESS, register, int(arguments[0]))
+                return arguments[0]
+
+        return None
+
+    def close(self) -> None:
+        '''Stop the coprocess (it also exits with the program).'''
+        if self.shell is not None:
+            self.shell.kill()
+            self.shell.wait()
+            self.shell = None
+
+    def get_remaining_on_time(self) -> float:
+        '''Get the time in seconds until the power is cut, based on the uptime of the Raspberry Pi.'''
+        with open('/proc/uptime', 'r', encoding='utf-8') as f:
+            uptime = float(f.read().split()[0]) # Seconds since power on
+
+        return self.MAX_DURATION_MINUTES * 60 - uptime
+
     def sync_time_with_network(self) -> None:
         '''Sync the RTC with network time.'''
         # See: https://www.uugear.com/forums/technial-support-discussion/witty-pi-4-how-to-synchronise-time-with-internet-on-boot/
@@ -119,38 +246,46 @@ class WittyPi4:
         '''Gets the recovery threshold in V.'''
         return self.get_voltage_threshold("get_recovery_voltage_threshold")
 
-    def set_low_voltage_threshold(self, voltage: float) -> float:
-        '''Set the low voltage threshold in V.'''
+    def set_low_voltage_threshold(self, voltage: float) -> bool:
+        '''Set the low voltage threshold in V and return if it is set.'''
         # TODO: Compare with recovery voltage threshold
         try:
             if 2.0 <= voltage <= 25.0 or voltage == 0:
                 if voltage != self.get_low_voltage_threshold():
                     low_voltage_threshold = self.run_command(f"set_low_voltage_threshold {int(voltage*10)}")
+                    if low_voltage_threshold == "ERROR":
+                        return False
                     logging.info("Set low voltage threshold to: %s V", low_voltage_threshold)
                 else:
                     logging.info("Low voltage threshold already set to: %s V", voltage)
-            else:
-                logging.error("Voltage must be between 2.0 and 25.0 V (or 0 to disable).")
+                return True
 
+            logging.error("Voltage must be between 2.0 and 25.0 V (or 0 to disable).")
         except Exception as e:
             logging.error("Could not set low voltage threshold: %s", str(e))
 
-    def set_recovery_voltage_threshold(self, voltage: float) -> None:
-        '''Set the recovery voltage threshold in V.'''
+        return False
+
+    def set_recovery_voltage_threshold(self, voltage: float) -> bool:
+        '''Set the recovery voltage threshold in V and return if it is set.'''
         # TODO Compare to low voltage threshold
         try:
             if 2.0 <= voltage <= 25.0 or voltage == 0:
                 if voltage != self.get_recovery_voltage_threshold():
                     recovery_voltage_threshold = self.run_command(f"set_recovery_voltage_threshold {int(voltage*10)}")
+                    if recovery_voltage_threshold == "ERROR":
+                        return False
                     logging.info("Set recovery voltage threshold to: %s V", recovery_voltage_threshold)
                 else:
                     logging.info("Recovery voltage threshold already set to: %s V", voltage)
-            else:
-                logging.error("Voltage must be between 2.0 and 25.0 V (or 0 to disable).")
+                return True
 
+            logging.error("Voltage must be between 2.0 and 25.0 V (or 0 to disable).")
         except Exception as e:
             logging.error("Could not set recovery voltage threshold: %s", str(e))
 
+        return False
+
     def set_start_time(self, start_time: time) -> None:
         '''Set the start time for the schedule.'''
         if start_time < time(23 - self.interval_length_hours, 59 - self.interval_length_minutes):
@@ -293,7 +428,8 @@ class WittyPi4:
             try:
                 # Apply new schedule
                 command = f"cd {self.WITTYPI_DIRECTORY} && sudo ./runScript.sh"
-                output = check_output(command, shell=True, executable="/bin/bash", stderr=STDOUT, universal_newlines=True, timeout=30)
+                with self.LOCK:
+                    output = check_output(command, shell=True, executable="/bin/bash", stderr=STDOUT, universal_newlines=True, timeout=30)
                 output = output.split("\n")[1:3]
 
                 if "Schedule next startup at:" in output[1]: